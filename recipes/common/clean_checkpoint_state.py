@@ -4,6 +4,9 @@ import sys
 
 import torch
 
+sys.path.append("../..")
+from vc_tts_template.checkpoint import clean_checkpoint_state
+
 
 def get_parser():
     parser = argparse.ArgumentParser(
@@ -23,22 +26,8 @@ if __name__ == "__main__":
     size = os.path.getsize(args.input_file)
     print("Processisng:", args.input_file)
     print(f"File size (before): {size / 1024/1024:.3f} MB")
-    for k in ["optimizer_state", "lr_scheduler_state"]:
-        if k in checkpoint.keys():
-            del checkpoint[k]
-
-    # For https://github.com/kan-bayashi/ParallelWaveGAN
-    for k in ["optimizer", "lr_scheduler"]:
-        if k in checkpoint.keys():
-            del checkpoint[k]
-    if "model" in checkpoint and "discriminator" in checkpoint["model"]:
-        del checkpoint["model"]["discriminator"]
-
-    # For hifigan
-    if "state_dict" in checkpoint.keys():
-        for k in ["netMPD", "netMSD"]:
-            if k in checkpoint["state_dict"].keys():
-                del checkpoint["state_dict"][k]
+    # optimizer等と, hifiganなどの識別器を消す. 学習時のexport_weightsと同じ.
+    checkpoint = clean_checkpoint_state(checkpoint)
 
     torch.save(checkpoint, args.output_file)
     size = os.path.getsize(args.output_file)
@@ -0,0 +1,43 @@
+import argparse
+import sys
+from functools import partial
+from pathlib import Path
+
+sys.path.append("../..")
+from recipes.common.preprocess_runner import SHARD_HELP, parse_shard, run_preprocess, select_shard
+from vc_tts_template.audio_cache import AudioCache
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Fill the resampled audio cache")
+    parser.add_argument("utt_list", type=str, help="utternace list")
+    parser.add_argument("cache_dir", type=str, help="audio cache directory")
+    parser.add_argument("wav_roots", type=str, nargs="+", help="wav roots. {wav_root}/{utt_id}.wav are cached")
+    parser.add_argument("--sample_rate", type=int, help="target sampling rate")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Number of jobs")
+    parser.add_argument(
+        "--task_chunk_size", type=int, default=8, help="Number of utterances sent to a worker at once"
+    )
+    parser.add_argument("--shard", type=str, help=SHARD_HELP)
+    return parser
+
+
+def process(wav_path, audio_cache):
+    # 既にcacheにあれば, hashを計算するだけで何もしない.
+    audio_cache.build(wav_path)
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args(sys.argv[1:])
+
+    with open(args.utt_list) as f:
+        utt_ids = [utt_id.strip() for utt_id in f if len(utt_id.strip()) > 0]
+    # preprocess.pyと同じshardの発話だけをcacheする.
+    utt_ids = select_shard(utt_ids, parse_shard(args.shard))
+    wav_paths = [Path(wav_root) / f"{utt_id}.wav" for wav_root in args.wav_roots for utt_id in utt_ids]
+    audio_cache = AudioCache(args.cache_dir, args.sample_rate)
+
+    # 読めないwavはここでは表示だけして, 前処理側でerrors.jsonlに記録される.
+    tasks = [(str(wav_path), (wav_path,)) for wav_path in wav_paths]
+    for _ in run_preprocess(partial(process, audio_cache=audio_cache), tasks, args.n_jobs, args.task_chunk_size):
+        pass
@@ -1,33 +1,118 @@
 import argparse
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import List, Optional, Sequence
 
 import joblib
 import numpy as np
 from sklearn.preprocessing import StandardScaler
 from tqdm import tqdm
 
+sys.path.append("../..")
+from vc_tts_template.manifest import find_manifest, load_manifest, stream_moments
+from vc_tts_template.moments import Moments, compute_moments, merge_moments
+
 
 def get_parser():
     parser = argparse.ArgumentParser(description="Fit scalers")
     parser.add_argument("utt_list", type=str, help="utternace list")
-    parser.add_argument("in_dir", type=str, help="in directory")
-    parser.add_argument("out_path", type=str, help="Output path")
-    parser.add_argument("--external_scaler", type=str, help="External scaler")
+    parser.add_argument("in_dir", type=str, nargs="?", help="in directory")
+    parser.add_argument("out_path", type=str, nargs="?", help="Output path")
+    parser.add_argument(
+        "--stream", type=str, nargs=2, action="append", default=[], metavar=("IN_DIR", "OUT_PATH"),
+        help="Additional (in directory, output path) pair. All streams are fitted in one pass over utt_list"
+    )
+    parser.add_argument("--external_scaler", type=str, help="External scaler (only for a single stream)")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Number of jobs")
+    parser.add_argument(
+        "--manifest", action="store_true",
+        help="Use per-utterance moments recorded in the preprocessing manifest instead of reading features"
+    )
     return parser
 
 
+def moments_to_scaler(moments: Moments) -> StandardScaler:
+    """Build a fitted sklearn StandardScaler from moments."""
+    scaler = StandardScaler()
+    scaler.n_samples_seen_ = np.int64(moments.count)
+    scaler.n_features_in_ = len(moments.mean)
+    scaler.mean_ = moments.mean
+    scaler.var_ = moments.m2 / moments.count
+    # sklearnと同じく, 分散がほぼ0の次元はscaleを1にする.
+    scale = np.sqrt(scaler.var_)
+    scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0
+    scaler.scale_ = scale
+    return scaler
+
+
+def scaler_to_moments(scaler: StandardScaler) -> Moments:
+    count = int(np.max(scaler.n_samples_seen_))
+    return Moments(count, scaler.mean_.astype(np.float64), scaler.var_.astype(np.float64) * count)
+
+
+def fit_shard(utt_ids: Sequence[str], in_dirs: Sequence[Path]) -> List[Optional[Moments]]:
+    """Compute moments of every stream over a shard of utterances."""
+    moments: List[Optional[Moments]] = [None] * len(in_dirs)
+    for utt_id in utt_ids:
+        for i, in_dir in enumerate(in_dirs):
+            c = np.load(in_dir / f"{utt_id}-feats.npy")
+            moments[i] = merge_moments(moments[i], compute_moments(c))
+    return moments
+
+
+def save_scaler(scaler: StandardScaler, out_path: Path) -> None:
+    """Save the joblib scaler and its mean/var/scale npy files next to it.
+
+    npyは scaler_joblib2npy.py と同じ {stem}_{mean,var,scale}.npy.
+    """
+    joblib.dump(scaler, out_path)
+    for name in ["mean", "var", "scale"]:
+        np.save(out_path.parent / f"{out_path.stem}_{name}.npy", getattr(scaler, f"{name}_"), allow_pickle=False)
+
+
 if __name__ == "__main__":
     args = get_parser().parse_args(sys.argv[1:])
-    in_dir = Path(args.in_dir)
-    if args.external_scaler is not None:
-        scaler = joblib.load(args.external_scaler)
-    else:
-        scaler = StandardScaler()
+    streams = [(args.in_dir, args.out_path)] if args.in_dir is not None else []
+    streams += [tuple(s) for s in args.stream]
+    assert len(streams) > 0, "Specify in_dir and out_path, or --stream"
+    assert args.external_scaler is None or len(streams) == 1, "--external_scaler supports only a single stream"
+    in_dirs = [Path(in_dir) for in_dir, _ in streams]
+
     with open(args.utt_list) as f:
-        for utt_id in tqdm(f):
-            c = np.load(in_dir / f"{utt_id.strip()}-feats.npy")
-            if len(c.shape) == 1:
-                c = c.reshape(-1, 1)
-            scaler.partial_fit(c)
-        joblib.dump(scaler, args.out_path)
+        utt_ids = [utt_id.strip() for utt_id in f if len(utt_id.strip()) > 0]
+
+    # 発話のshardごとに全streamのmomentsを求めて, 最後にまとめる.
+    n_shards = max(1, min(len(utt_ids), args.n_jobs * 4))
+    shards = [utt_ids[i::n_shards] for i in range(n_shards)]
+    results: List[Optional[Moments]] = [None] * len(streams)
+    if args.external_scaler is not None:
+        results[0] = scaler_to_moments(joblib.load(args.external_scaler))
+
+    # 前処理のmanifestに全発話のmomentsがあるstreamは, 特徴量を読まずにそれをまとめる.
+    file_streams = list(range(len(streams)))
+    if args.manifest:
+        file_streams = []
+        for i, in_dir in enumerate(in_dirs):
+            manifest_path = find_manifest(in_dir)
+            recorded = None
+            if manifest_path is not None:
+                key = in_dir.relative_to(manifest_path.parent).as_posix()
+                recorded = stream_moments(load_manifest(manifest_path), utt_ids, key)
+            if recorded is None:
+                print(f"{in_dir}: moments are not recorded in the manifest. Read features instead.")
+                file_streams.append(i)
+                continue
+            for moments in recorded:
+                results[i] = merge_moments(results[i], moments)
+
+    if len(file_streams) > 0:
+        with ProcessPoolExecutor(args.n_jobs) as executor:
+            futures = [executor.submit(fit_shard, shard, [in_dirs[i] for i in file_streams]) for shard in shards]
+            for future in tqdm(futures):
+                for i, moments in zip(file_streams, future.result()):
+                    if moments is not None:
+                        results[i] = merge_moments(results[i], moments)
+
+    for (_, out_path), moments in zip(streams, results):
+        save_scaler(moments_to_scaler(moments), Path(out_path))
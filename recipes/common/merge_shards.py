@@ -0,0 +1,102 @@
+import argparse
+import json
+import re
+import sys
+from pathlib import Path
+from typing import List
+
+sys.path.append("../..")
+from recipes.common.preprocess_runner import ERRORS_NAME
+from vc_tts_template.length_index import LENGTH_INDEX_NAME, write_length_index
+from vc_tts_template.manifest import (
+    MANIFEST_NAME, length_index_from_entries, load_manifests, prosody_stats, write_manifest
+)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Merge the results of preprocess.py --shard i/N",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("split_dirs", type=str, nargs="+", help="split directories such as dump/xxx/org/train")
+    return parser
+
+
+def shard_files(split_dir: Path, name: str, complete: bool = True) -> List[Path]:
+    """Per-shard files of ``name`` in ``split_dir``.
+
+    Args:
+        split_dir: Split directory.
+        name: File name without sharding such as ``manifest.jsonl``.
+        complete: Check that the files of all shards are present.
+            errors.jsonlは失敗がなければ消されるので, 揃っていなくてもよい.
+
+    Returns:
+        list: Paths sorted by shard index.
+    """
+    path = Path(name)
+    pattern = re.compile(rf"{re.escape(path.stem)}\.(\d+)-of-(\d+){re.escape(path.suffix)}")
+    found = {}
+    for p in split_dir.glob(f"{path.stem}.*-of-*{path.suffix}"):
+        m = pattern.fullmatch(p.name)
+        if m is not None:
+            found[(int(m.group(1)), int(m.group(2)))] = p
+    if len(found) == 0:
+        return []
+    nums = {num for _, num in found}
+    if len(nums) > 1:
+        raise ValueError(f"{split_dir}: shards of different N {sorted(nums)} are mixed")
+    num = nums.pop()
+    missing = [i for i in range(num) if (i, num) not in found]
+    if complete and len(missing) > 0:
+        raise ValueError(f"{split_dir}: shards {missing} of {num} have not finished")
+    return [found[(i, num)] for i in range(num) if (i, num) in found]
+
+
+def merge_split(split_dir: Path) -> None:
+    """Merge per-shard manifests and errors of a split and write its length index etc."""
+    manifests = shard_files(split_dir, MANIFEST_NAME)
+    if len(manifests) == 0:
+        raise ValueError(f"{split_dir}: no shard manifest found")
+    # shardは発話で分けているので, 同じ発話が複数のshardに現れることはない.
+    entries = load_manifests(manifests)
+    write_manifest(split_dir / MANIFEST_NAME, entries)
+
+    errors = []
+    for path in shard_files(split_dir, ERRORS_NAME, complete=False):
+        with open(path) as f:
+            errors += f.readlines()
+    if len(errors) > 0:
+        with open(split_dir / ERRORS_NAME, "w") as f:
+            f.writelines(errors)
+        print(f"{split_dir}: {len(errors)} utterances failed. See {split_dir / ERRORS_NAME}")
+    elif (split_dir / ERRORS_NAME).exists():
+        (split_dir / ERRORS_NAME).unlink()
+
+    length_index = length_index_from_entries(entries)
+    if len(length_index) > 0:
+        write_length_index(split_dir / LENGTH_INDEX_NAME, length_index)
+
+    # fastspeech2VCのsilenceで失敗した発話のlist. 入力の1つ目がsource, 2つ目がtarget.
+    if any("failed_src" in entry["stats"] for entry in entries.values()):
+        for pos, key, name in [(0, "failed_src", "failed_src_lst.txt"), (1, "failed_tgt", "failed_tgt_lst.txt")]:
+            with open(split_dir / name, "w") as f:
+                for entry in entries.values():
+                    if entry["stats"].get(key, False):
+                        f.write(list(entry["inputs"].keys())[pos] + "\n")
+    print(f"{split_dir}: merged {len(manifests)} shards ({len(entries)} utterances)")
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args(sys.argv[1:])
+
+    split_dirs = [Path(split_dir) for split_dir in args.split_dirs]
+    for split_dir in split_dirs:
+        merge_split(split_dir)
+
+    # stats.jsonは前処理と同じく, 同じdumpの全splitのmanifestから作る.
+    for dump_dir in sorted({split_dir.parent for split_dir in split_dirs}):
+        stats = prosody_stats(load_manifests(dump_dir.glob(f"*/{MANIFEST_NAME}")))
+        if stats is not None:
+            with open(dump_dir / "stats.json", "w") as f:
+                f.write(json.dumps(stats))
@@ -10,14 +10,13 @@ import torch.optim as optim
 from hydra.utils import to_absolute_path
 from omegaconf import OmegaConf
 from tqdm import tqdm
-import numpy as np
 
 sys.path.append("../..")
 from vc_tts_template.logger import getLogger
 from vc_tts_template.train_utils import (_get_data_loaders,
                                          set_epochs_based_on_max_steps_,
-                                         get_epochs_with_optional_tqdm,
-                                         check_grad_flow)
+                                         get_epochs_with_optional_tqdm)
+from vc_tts_template.grad_health import GradHealthMonitor
 from vc_tts_template.utils import init_seed
 from recipes.common.train_loop import _train_step
 
@@ -159,7 +158,7 @@ def optuna_train_loop(config, to_device, model, optimizer, lr_scheduler, loss, d
                       logger, trial, use_loss=["total_loss"], train_step=None, epoch_step=False):
     nepochs = config.train.nepochs
     scaler = torch.cuda.amp.GradScaler()
-    grad_checker = check_grad_flow(logger=logger)
+    grad_checker = GradHealthMonitor(logger, interval=config.train.get("grad_check_interval", 1))
 
     for epoch in get_epochs_with_optional_tqdm(config.tqdm, nepochs):
         for phase in data_loaders.keys():
@@ -171,8 +170,8 @@ def optuna_train_loop(config, to_device, model, optimizer, lr_scheduler, loss, d
             else:
                 model.train() if train else model.eval()
             running_losses = {}  # epoch毎のloss. ここでresetしてるし.
-            is_first = 1
-            group_size = 0
+            # max_framesで分けるとgroupごとにsub-batch数が違うので, 実際に回したstep数で割る.
+            num_steps = 0
             for batchs in tqdm(
                 data_loaders[phase], desc=f"{phase} iter", leave=False
             ):
@@ -193,15 +192,12 @@ def optuna_train_loop(config, to_device, model, optimizer, lr_scheduler, loss, d
                     )
                     # lossを一気に足してためておく. 賢い.
                     _update_running_losses_(running_losses, loss_values)
-
-                    if is_first == 1:
-                        # 一番最初のではかる. 最後だと端数になってしまう恐れ.
-                        group_size = len(batchs)
-                    is_first = 0
+                    num_steps += 1
 
             if phase == "dev":
-                target_loss = np.sum([running_losses[loss_] for loss_ in use_loss])
-                ave_loss = target_loss / (len(data_loaders[phase]) * group_size)
+                # loss_valuesは0次元のtensorなので, epochの終わりにだけfloatにする.
+                target_loss = sum(float(running_losses[loss_]) for loss_ in use_loss)
+                ave_loss = target_loss / num_steps
                 trial.report(ave_loss, epoch)
 
             if trial.should_prune():
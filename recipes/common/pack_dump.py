@@ -0,0 +1,37 @@
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.append("../..")
+from vc_tts_template.packed import pack_features
+from vc_tts_template.utils import load_utt_list
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Pack a dump directory of -feats.npy files into memory-mapped shards",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("utt_list", type=str, help="utternace list")
+    parser.add_argument("in_dir", type=str, help="in directory. e.g. dump/xxx/org/train/out_fastspeech2")
+    parser.add_argument("out_dir", type=str, help="out directory")
+    parser.add_argument("--shard_size_mb", type=int, default=1024, help="Approximate size of one shard")
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args(sys.argv[1:])
+
+    utt_ids = load_utt_list(args.utt_list)
+    in_dir = Path(args.in_dir)
+    out_dir = Path(args.out_dir)
+
+    # in_dir直下の-feats.npyと, 1階層下(mel/, pitch/など)の-feats.npyをそれぞれ1つのstreamとしてpackする.
+    feat_dirs = [in_dir] + sorted([d for d in in_dir.iterdir() if d.is_dir()])
+    for feat_dir in feat_dirs:
+        if not any(feat_dir.glob("*-feats.npy")):
+            continue
+        out_feat_dir = out_dir / feat_dir.relative_to(in_dir)
+        n_packed = pack_features(utt_ids, feat_dir, out_feat_dir, args.shard_size_mb)
+        print(f"Packed {n_packed} utterances: {feat_dir} -> {out_feat_dir}")
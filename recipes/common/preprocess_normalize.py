@@ -1,11 +1,13 @@
 import argparse
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import joblib
 import numpy as np
-from tqdm import tqdm
+
+sys.path.append("../..")
+from recipes.common.preprocess_runner import ERRORS_NAME, run_preprocess
 
 
 def get_parser():
@@ -16,6 +18,9 @@ def get_parser():
     parser.add_argument("out_dir", type=str, help="out directory")
     parser.add_argument("--inverse", action="store_true", help="Inverse transform")
     parser.add_argument("--n_jobs", type=int, default=1, help="Number of jobs")
+    parser.add_argument(
+        "--task_chunk_size", type=int, default=32, help="Number of utterances sent to a worker at once"
+    )
 
     return parser
 
@@ -48,10 +53,10 @@ if __name__ == "__main__":
 
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    with ProcessPoolExecutor(args.n_jobs) as executor:
-        futures = [
-            executor.submit(process, path, scaler, args.inverse, out_dir)
-            for path in paths
-        ]
-        for future in tqdm(futures):
-            future.result()
+    # 1発話の処理が軽いので, まとめてworkerに送ってscalerの受け渡しなどを減らす.
+    fn = partial(process, scaler=scaler, inverse=args.inverse, out_dir=out_dir)
+    tasks = [(utt_id, (path,)) for utt_id, path in zip(utt_ids, paths)]
+    for _ in run_preprocess(
+        fn, tasks, args.n_jobs, args.task_chunk_size, errors_path=out_dir / ERRORS_NAME
+    ):
+        pass
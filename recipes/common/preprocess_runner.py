@@ -0,0 +1,153 @@
+import json
+import os
+import traceback
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from tqdm import tqdm
+
+ERRORS_NAME = "errors.jsonl"
+SHARD_HELP = "Process only the i-th of N shards (i/N, 0-origin). merge_shards.py combines the results"
+
+
+class TaskResult(NamedTuple):
+    """Result of one task.
+
+    key: 発話idなど, result: 関数の返り値 (失敗時None), error: 失敗時のtraceback (成功時None).
+    """
+    key: str
+    result: Any
+    error: Optional[str]
+
+
+def parse_shard(shard: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Parse ``--shard i/N``.
+
+    Args:
+        shard: String such as ``0/4``. None or an empty string means no sharding.
+
+    Returns:
+        tuple: (i, N), or None if not sharded.
+    """
+    if not shard:
+        return None
+    index, num = (int(v) for v in shard.split("/"))
+    if not 0 <= index < num:
+        raise ValueError(f"Invalid shard: {shard}. Expected i/N with 0 <= i < N")
+    return index, num
+
+
+def select_shard(utt_ids: Sequence[str], shard: Optional[Tuple[int, int]]) -> List[str]:
+    """Utterances assigned to a shard.
+
+    utt_idのcrc32で割り当てるので, 計算機やutt_listの順番, 他の発話の有無によらず同じ発話は同じshardになる.
+
+    Args:
+        utt_ids: Utterance ids.
+        shard: (i, N) returned by :func:`parse_shard`, or None.
+
+    Returns:
+        list: Utterance ids of the shard in the original order.
+    """
+    if shard is None:
+        return list(utt_ids)
+    index, num = shard
+    return [utt_id for utt_id in utt_ids if zlib.crc32(utt_id.encode()) % num == index]
+
+
+def shard_path(path: Union[str, Path], shard: Optional[Tuple[int, int]]) -> Path:
+    """Per-shard file name such as ``manifest.0-of-4.jsonl``. shardしないなら ``path`` のまま."""
+    path = Path(path)
+    if shard is None:
+        return path
+    return path.with_name(f"{path.stem}.{shard[0]}-of-{shard[1]}{path.suffix}")
+
+
+def _run_chunk(fn: Callable, chunk: Sequence[Tuple[str, tuple]]) -> List[TaskResult]:
+    # 1発話の失敗でchunk全体を失わないよう, 例外は発話ごとに捕まえて返す.
+    results = []
+    for key, args in chunk:
+        try:
+            results.append(TaskResult(key, fn(*args), None))
+        except Exception:
+            results.append(TaskResult(key, None, traceback.format_exc()))
+    return results
+
+
+def run_preprocess(
+    fn: Callable,
+    tasks: Sequence[Tuple[str, tuple]],
+    n_jobs: int = 1,
+    chunk_size: int = 1,
+    max_in_flight: Optional[int] = None,
+    errors_path: Optional[Union[str, Path]] = None,
+    desc: Optional[str] = None,
+) -> Iterator[TaskResult]:
+    """Run a preprocessing function over utterances with bounded in-flight work.
+
+    全taskを最初にsubmitせず, 実行中のchunkを ``max_in_flight`` 個までに抑えて, 終わった順に結果を返す
+    (multiprocessing.Pool.imap_unorderedと同様). 遅い発話が先頭にあっても後ろの結果は待たない.
+    例外は発話ごとに捕まえて ``errors_path`` にjsonlで記録し, 実行は止めない.
+
+    全発話に共通の引数は ``functools.partial`` で ``fn`` に束縛しておくと, chunkごとに1回だけ送られる.
+
+    Args:
+        fn: Function called as ``fn(*args)`` in worker processes. Must be picklable.
+        tasks: Pairs of a key (utt_id) and the arguments of each utterance.
+        n_jobs: Number of worker processes. 1以下ならprocessを作らずにその場で実行する.
+        chunk_size: Number of tasks sent to a worker at once. 短い処理ではプロセス間通信の回数を減らせる.
+        max_in_flight: Max number of chunks submitted but not finished. Defaults to ``2 * n_jobs``.
+        errors_path: Error manifest. 失敗した発話を1行1発話で書く (今回の実行分で上書き).
+        desc: Description of the progress bar.
+
+    Yields:
+        TaskResult: Results in completion order.
+    """
+    assert chunk_size > 0
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+    if max_in_flight is None:
+        max_in_flight = 2 * max(n_jobs, 1)
+
+    errors_file = None
+    if errors_path is not None:
+        Path(errors_path).parent.mkdir(parents=True, exist_ok=True)
+        errors_file = open(errors_path, "w")
+
+    def _emit(results, pbar):
+        for r in results:
+            if r.error is not None:
+                pbar.write(f"{r.key}: {r.error.strip().splitlines()[-1]}")
+                if errors_file is not None:
+                    errors_file.write(json.dumps({"utt_id": r.key, "error": r.error}) + "\n")
+                    errors_file.flush()
+        pbar.update(len(results))
+        return results
+
+    try:
+        with tqdm(total=len(tasks), desc=desc) as pbar:
+            if n_jobs <= 1:
+                for chunk in chunks:
+                    yield from _emit(_run_chunk(fn, chunk), pbar)
+                return
+
+            with ProcessPoolExecutor(n_jobs) as executor:
+                pending = set()
+                next_chunk = 0
+                while next_chunk < len(chunks) or pending:
+                    while next_chunk < len(chunks) and len(pending) < max_in_flight:
+                        pending.add(executor.submit(_run_chunk, fn, chunks[next_chunk]))
+                        next_chunk += 1
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from _emit(future.result(), pbar)
+    finally:
+        if errors_file is not None:
+            errors_file.close()
+            with open(errors_path) as f:
+                n_errors = sum(1 for _ in f)
+            if n_errors > 0:
+                print(f"{n_errors} utterances failed. See {errors_path}")
+            else:
+                os.remove(errors_path)
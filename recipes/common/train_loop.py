@@ -1,13 +1,20 @@
+import time
+
 import torch
 from hydra.utils import to_absolute_path
 from tqdm import tqdm
 from pathlib import Path
 from vc_tts_template.train_utils import (
     get_epochs_with_optional_tqdm,
-    save_checkpoint,
     free_tensors_memory,
-    check_grad_flow
 )
+from vc_tts_template.checkpoint import CheckpointManager, load_resume_state
+from vc_tts_template.distributed import (
+    all_gather_object, get_rank, get_world_size, is_main_process, set_epoch_, unwrap_model
+)
+from vc_tts_template.grad_health import GradHealthMonitor
+from vc_tts_template.metrics import MetricsAggregator, step_timer
+from vc_tts_template.utils import get_rng_state, set_rng_state
 
 
 def _train_step(
@@ -20,42 +27,53 @@ def _train_step(
     logger,
     scaler,
     grad_checker,
+    metrics=None,
 ):
     optimizer.zero_grad()
 
     # Run forwaard
-    with torch.cuda.amp.autocast():
+    with step_timer(metrics, "forward"), torch.cuda.amp.autocast():
         output = model(*batch)
 
         loss, loss_values = loss(batch, output)
 
     # Update
     if train:
-        scaler.scale(loss).backward()
-        grad_checker.set_params(model.named_parameters())
-        free_tensors_memory([loss])
-        scaler.unscale_(optimizer)
-        grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-        if not torch.isfinite(grad_norm):
-            grad_checker.report()
-            if scaler.is_enabled() is True:
-                logger.info("grad norm is NaN. Will Skip updating")
-            else:
-                logger.error("grad norm is NaN. check your model grad flow.")
-                raise ValueError("Please check log.")
-        scaler.step(optimizer)
-        scaler.update()
-        lr_scheduler.step()
+        with step_timer(metrics, "backward"):
+            scaler.scale(loss).backward()
+        with step_timer(metrics, "optimizer"):
+            grad_checker.set_params(model.named_parameters())
+            free_tensors_memory([loss])
+            scaler.unscale_(optimizer)
+            grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            if not torch.isfinite(grad_norm):
+                grad_checker.report()
+                if scaler.is_enabled() is True:
+                    logger.info("grad norm is NaN. Will Skip updating")
+                else:
+                    logger.error("grad norm is NaN. check your model grad flow.")
+                    raise ValueError("Please check log.")
+            scaler.step(optimizer)
+            scaler.update()
+            lr_scheduler.step()
 
     return loss_values
 
 
-def _update_running_losses_(running_losses, loss_values):
-    for key, val in loss_values.items():
-        try:
-            running_losses[key] += val
-        except KeyError:
-            running_losses[key] = val
+def _resume_rank_state(epoch_rng_state, phase_metrics):
+    # rankごとに違うもの. rank 0で保存するために集める (全rankで呼ぶこと).
+    return all_gather_object({
+        "rng_state": get_rng_state(),
+        "epoch_rng_state": epoch_rng_state,
+        "metrics": phase_metrics.state_dict(),
+    })
+
+
+def _unwrap_models(model):
+    # hifiganのようなdictはmodelごとにunwrapする.
+    if isinstance(model, dict):
+        return {key: unwrap_model(m) for key, m in model.items()}
+    return unwrap_model(model)
 
 
 def train_loop(config, to_device, model, optimizer, lr_scheduler, loss, data_loaders,
@@ -65,7 +83,41 @@ def train_loop(config, to_device, model, optimizer, lr_scheduler, loss, data_loa
     train_iter = last_train_iter + 1
     nepochs = config.train.nepochs
     scaler = torch.cuda.amp.GradScaler()
-    grad_checker = check_grad_flow(logger=logger)
+    # epochの途中でresume.pthを書くstep間隔. 0なら書かない.
+    checkpoint_step_interval = config.train.get("checkpoint_step_interval", 0)
+    # resume.pthから再開するなら, 中断したepochのbatchの続きから始める.
+    resume = load_resume_state(config)
+    if resume is not None:
+        assert resume["epoch"] == last_epoch + 1
+        logger.info(f"Resuming epoch {resume['epoch']} after {resume['num_batches']} batches")
+        nepochs = resume["end_epoch"] - last_epoch
+        best_loss = resume["best_loss"]
+        if len(resume["scaler"]) > 0:
+            scaler.load_state_dict(resume["scaler"])
+        if len(resume["ranks"]) != get_world_size():
+            logger.warning(
+                f"resume.pth was saved with {len(resume['ranks'])} processes. "
+                f"Restarting epoch {resume['epoch']} from the first batch"
+            )
+            resume["num_batches"] = 0
+    # parameterごとのgradの確認は, grad normが非有限になったstepだけCPUで行う.
+    grad_checker = GradHealthMonitor(logger, interval=config.train.get("grad_check_interval", 1))
+    # checkpointはCPUにcopyしたら学習に戻り, 別threadで書く.
+    checkpoints = CheckpointManager(
+        out_dir, logger,
+        keep_last=config.train.get("keep_last_checkpoints", -1),
+        async_save=config.train.get("async_checkpoint", True),
+        export_weights=config.train.get("export_weights", False),
+    )
+    # lossはdevice上で足し込み, log_step_interval stepごとの平均を別threadでTensorBoardに書く.
+    # devはepochの平均だけ使うので, writerを渡さない.
+    metrics = {
+        phase: MetricsAggregator(
+            writers[phase] if phase.startswith("train") else None,
+            flush_interval=config.train.get("log_step_interval", 1),
+        )
+        for phase in data_loaders.keys()
+    }
 
     for epoch in get_epochs_with_optional_tqdm(config.tqdm, nepochs, last_epoch=last_epoch):
         for phase in data_loaders.keys():
@@ -76,73 +128,126 @@ def train_loop(config, to_device, model, optimizer, lr_scheduler, loss, data_loa
                     model[key].train() if train else model[key].eval()
             else:
                 model.train() if train else model.eval()
-            running_losses = {}  # epoch毎のloss. ここでresetしてるし.
+            phase_metrics = metrics[phase]
+            phase_metrics.reset_epoch()  # epoch毎のloss. ここでresetしてるし.
+            # distributedのsamplerは, epochごとに全rankで同じ順番にshuffleする.
+            set_epoch_(data_loaders[phase], epoch)
             is_first = 1
-            group_size = 0
+            num_batches = 0
+            if train and resume is not None:
+                num_batches = resume["num_batches"]
+                batch_sampler = getattr(data_loaders[phase], "batch_sampler", None)
+                if num_batches > 0 and not hasattr(batch_sampler, "skip_"):
+                    logger.warning("The data loader can not skip batches. Restarting the epoch from the first batch")
+                    num_batches = 0
+                if num_batches > 0:
+                    rank_state = resume["ranks"][get_rank()]
+                    # epochの最初の乱数に戻してbatchの並びを中断前と同じにし,
+                    # 読み込んでいたbatchを飛ばしたところで中断時点の乱数に戻す.
+                    set_rng_state(rank_state["epoch_rng_state"])
+                    batch_sampler.skip_(num_batches, rank_state["rng_state"])
+                    phase_metrics.load_state_dict(rank_state["metrics"])
+                    is_first = 0
+                resume = None
+            # batchの並びはepochの最初の乱数で決まるので, 途中から再開できるよう覚えておく.
+            epoch_rng_state = get_rng_state() if train and checkpoint_step_interval > 0 else None
+            last_step_checkpoint = train_iter
+            data_start = time.perf_counter()
             for batchs in tqdm(
-                data_loaders[phase], desc=f"{phase} iter", leave=False
+                data_loaders[phase], desc=f"{phase} iter", leave=False, disable=not is_main_process(),
+                initial=num_batches,
             ):
+                # group内のsub-batchは1回の読み込みで来るので, 待ち時間はstep数で割った平均で記録される.
+                phase_metrics.add_time("data_wait", time.perf_counter() - data_start)
                 for batch in batchs:
                     batch = to_device(batch, phase)
                     train_step = _train_step if train_step is None else train_step
-                    loss_values = train_step(
-                        model,
-                        optimizer,
-                        lr_scheduler,
-                        train,
-                        loss,
-                        batch,
-                        logger,
-                        scaler,
-                        grad_checker,
-                    )
-                    if train:
-                        for key, val in loss_values.items():
-                            writers[phase].add_scalar(f"loss_bystep/{key}", val, train_iter)
-                        writers[phase].add_scalar(
-                            "LearningRate", lr_scheduler.get_last_lr()[0], train_iter
+                    # devでgraphを作らない (DistributedDataParallelはbackwardのないforwardを許さない).
+                    with torch.set_grad_enabled(train):
+                        loss_values = train_step(
+                            model,
+                            optimizer,
+                            lr_scheduler,
+                            train,
+                            loss,
+                            batch,
+                            logger,
+                            scaler,
+                            grad_checker,
+                            metrics=phase_metrics,
                         )
+                    if train:
+                        phase_metrics.add_scalar("LearningRate", lr_scheduler.get_last_lr()[0])
+                        # lossを一気に足してためておく. .item()はしないので, ここでは同期しない.
+                        phase_metrics.update(loss_values, train_iter)
                         train_iter += 1
-                    # lossを一気に足してためておく. 賢い.
-                    _update_running_losses_(running_losses, loss_values)
+                    else:
+                        phase_metrics.update(loss_values)
 
                     # 最初の検証用データに対して、中間結果の可視化
                     if (
                         is_first == 1  # 最初
                         and epoch % config.train.eval_epoch_interval == 0
+                        and is_main_process()
                     ):
+                        # rank 0だけがforwardするので, DDPを通さない.
+                        # 通すとBatchNormのbufferのbroadcastが他rankと食い違い, collectiveがずれる.
                         for is_inference in [False, True]:  # 非推論モードでやるの偉い.
                             eval_model(
                                 phase,
                                 train_iter,
-                                model,
+                                _unwrap_models(model),
                                 writers[phase],
                                 batch,
                                 is_inference
                             )
-                    if is_first == 1:
-                        # 一番最初のではかる. 最後だと端数になってしまう恐れ.
-                        group_size = len(batchs)
                     is_first = 0
-
-            # Epoch ごとのロスを出力
-            for key, val in running_losses.items():
-                ave_loss = val / (len(data_loaders[phase]) * group_size)
-                writers[phase].add_scalar(f"loss/{key}", ave_loss, epoch)
-
-            ave_loss = running_losses[list(running_losses.keys())[-1]] / (len(data_loaders[phase]) * group_size)
+                num_batches += 1
+
+                # resume.pthはbatchの切れ目で書く. 再開時はnum_batches個のbatchを飛ばす.
+                if (
+                    train and checkpoint_step_interval > 0
+                    and train_iter - last_step_checkpoint >= checkpoint_step_interval
+                ):
+                    resume_state = {
+                        "epoch": epoch,
+                        "num_batches": num_batches,
+                        "end_epoch": last_epoch + nepochs,
+                        "best_loss": best_loss,
+                        "scaler": scaler.state_dict(),
+                        "ranks": _resume_rank_state(epoch_rng_state, phase_metrics),
+                    }
+                    if is_main_process():
+                        checkpoints.save_step(model, optimizer, lr_scheduler, epoch - 1, train_iter - 1, resume_state)
+                    last_step_checkpoint = train_iter
+                data_start = time.perf_counter()
+
+            # Epoch ごとのロスを出力. 実際に回したstep数で割るので, 端数のgroupがあっても正しい平均になる.
+            # distributedなら全rankの平均なので, best modelの判定は全rankで一致する.
+            epoch_losses = phase_metrics.epoch_means()
+            if writers[phase] is not None:
+                for key, val in epoch_losses.items():
+                    writers[phase].add_scalar(f"loss/{key}", val, epoch)
+
+            ave_loss = epoch_losses[list(epoch_losses.keys())[-1]]
             if not train and ave_loss < best_loss:
                 best_loss = ave_loss
-                save_checkpoint(logger, out_dir, model, optimizer, lr_scheduler, epoch, train_iter, True)
+                if is_main_process():
+                    checkpoints.save(model, optimizer, lr_scheduler, epoch, train_iter, is_best=True)
 
             if epoch_step is True:
                 lr_scheduler.step()
 
-        if epoch % config.train.checkpoint_epoch_interval == 0:
-            save_checkpoint(logger, out_dir, model, optimizer, lr_scheduler, epoch, train_iter, False)
+        if epoch % config.train.checkpoint_epoch_interval == 0 and is_main_process():
+            checkpoints.save(model, optimizer, lr_scheduler, epoch, train_iter)
+
+    for phase_metrics in metrics.values():
+        phase_metrics.close(train_iter - 1)
 
     # save at last epoch
-    save_checkpoint(logger, out_dir, model, optimizer, lr_scheduler, nepochs+last_epoch, train_iter)
+    if is_main_process():
+        checkpoints.save(model, optimizer, lr_scheduler, nepochs+last_epoch, train_iter)
+    checkpoints.close()
     logger.info(f"The best loss was {best_loss}")
 
     return model
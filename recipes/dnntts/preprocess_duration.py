@@ -1,12 +1,16 @@
 import argparse
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 from nnmnkwii.frontend import merlin as fe
 from nnmnkwii.io import hts
-from tqdm import tqdm
+
+sys.path.append("../..")
+from recipes.common.preprocess_runner import (
+    ERRORS_NAME, SHARD_HELP, parse_shard, run_preprocess, select_shard, shard_path
+)
 
 
 def get_parser():
@@ -19,6 +23,8 @@ def get_parser():
     parser.add_argument("qst_file", type=str, help="HTS style question file")
     parser.add_argument("out_dir", type=str, help="out directory")
     parser.add_argument("--n_jobs", type=int, default=1, help="Number of jobs")
+    parser.add_argument("--task_chunk_size", type=int, default=1, help="Number of utterances sent to a worker at once")
+    parser.add_argument("--shard", type=str, help=SHARD_HELP)
     return parser
 
 
@@ -43,6 +49,8 @@ if __name__ == "__main__":
 
     with open(args.utt_list) as f:
         utt_ids = [utt_id.strip() for utt_id in f]
+    shard = parse_shard(args.shard)
+    utt_ids = select_shard(utt_ids, shard)
     lab_files = [Path(args.lab_root) / f"{utt_id}.lab" for utt_id in utt_ids]
     binary_dict, numeric_dict = hts.load_question_set(args.qst_file)
 
@@ -51,12 +59,13 @@ if __name__ == "__main__":
     in_dir.mkdir(parents=True, exist_ok=True)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    with ProcessPoolExecutor(args.n_jobs) as executor:
-        futures = [
-            executor.submit(
-                preprocess, lab_file, binary_dict, numeric_dict, in_dir, out_dir
-            )
-            for lab_file in lab_files
-        ]
-        for future in tqdm(futures):
-            future.result()
+    fn = partial(
+        preprocess,
+        binary_dict=binary_dict, numeric_dict=numeric_dict, in_dir=in_dir, out_dir=out_dir,
+    )
+    tasks = [(utt_id, (lab_file,)) for utt_id, lab_file in zip(utt_ids, lab_files)]
+    # 失敗した発話は{out_dir}/errors.jsonlに記録して, 残りの発話は続ける.
+    for _ in run_preprocess(
+        fn, tasks, args.n_jobs, args.task_chunk_size, errors_path=shard_path(Path(args.out_dir) / ERRORS_NAME, shard)
+    ):
+        pass
@@ -33,7 +33,8 @@ stop_stage=0
 # 後程登場. dumpというフォルダ名. 恐らくpreprocessedと同じように, 加工後のデータをためる場所.
 dumpdir=dump
 dump_org_dir=$dumpdir/${spk}_sr${sample_rate}/org
-dump_norm_dir=$dumpdir/${spk}_sr${sample_rate}/norm
+# resample済みの波形のcache. wavの中身のhashがkeyなので, recipe間で共有できる.
+audio_cache_dir=../audio_cache
 
 # exp name
 # config.yamlに書いた, spkとsamplingrateとtagを利用.
@@ -84,46 +85,38 @@ fi
 if [ ${stage} -le 2 ] && [ ${stop_stage} -ge 2 ]; then
     echo "stage 2: Feature generation for acoustic model"
     for s in ${datasets[@]}; do
+        xrun python $COMMON_ROOT/fill_audio_cache.py data/$s.list $audio_cache_dir $db_root/wav/ \
+            --sample_rate $sample_rate --n_jobs $n_jobs
         xrun python preprocess_acoustic.py data/$s.list $db_root/wav/ $db_root/lab/ \
             $qst_path $dump_org_dir/$s --sample_rate $sample_rate \
-            --n_jobs $n_jobs
+            --n_jobs $n_jobs \
+            --audio_cache_dir $audio_cache_dir
     done
 fi
 
 if [ ${stage} -le 3 ] && [ ${stop_stage} -ge 3 ]; then
     echo "stage 3: feature normalization"
+    streams=""
     for typ in "duration" "acoustic"; do
        for inout in "in" "out"; do
-            xrun python $COMMON_ROOT/fit_scaler.py data/train.list \
-                $dump_org_dir/$train_set/${inout}_${typ} \
-                $dump_org_dir/${inout}_${typ}_scaler.joblib
+            streams="$streams --stream $dump_org_dir/$train_set/${inout}_${typ} $dump_org_dir/${inout}_${typ}_scaler.joblib"
         done
     done
+    xrun python $COMMON_ROOT/fit_scaler.py data/train.list $streams --n_jobs $n_jobs
 
-    mkdir -p $dump_norm_dir
-    cp -v $dump_org_dir/*.joblib $dump_norm_dir/
-
-    for s in ${datasets[@]}; do
-        for typ in "duration" "acoustic"; do
-            for inout in "in" "out"; do
-                xrun python $COMMON_ROOT/preprocess_normalize.py data/$s.list \
-                    $dump_org_dir/${inout}_${typ}_scaler.joblib \
-                    $dump_org_dir/$s/${inout}_${typ}/ \
-                    $dump_norm_dir/$s/${inout}_${typ}/ --n_jobs $n_jobs
-            done
-        done
-    done
+    # 正規化は学習時にcollateでscalerを使って行うので, 正規化した特徴量のdump(norm)は作らない.
 fi
 
 if [ ${stage} -le 4 ] && [ ${stop_stage} -ge 4 ]; then
     echo "stage 4: Training duration model"
     xrun python train_dnntts.py model=$duration_model tqdm=$tqdm \
+        data.scaler_dir=$dump_org_dir \
         data.train.utt_list=data/train.list \
-        data.train.in_dir=$dump_norm_dir/$train_set/in_duration/ \
-        data.train.out_dir=$dump_norm_dir/$train_set/out_duration/ \
+        data.train.in_dir=$dump_org_dir/$train_set/in_duration/ \
+        data.train.out_dir=$dump_org_dir/$train_set/out_duration/ \
         data.dev.utt_list=data/dev.list \
-        data.dev.in_dir=$dump_norm_dir/$dev_set/in_duration/ \
-        data.dev.out_dir=$dump_norm_dir/$dev_set/out_duration/ \
+        data.dev.in_dir=$dump_org_dir/$dev_set/in_duration/ \
+        data.dev.out_dir=$dump_org_dir/$dev_set/out_duration/ \
         train.out_dir=$expdir/${duration_model} \
         train.log_dir=tensorboard/${expname}_${duration_model} \
         train.nepochs=$dnntts_train_nepochs \
@@ -134,12 +127,13 @@ fi
 if [ ${stage} -le 5 ] && [ ${stop_stage} -ge 5 ]; then
     echo "stage 5: Training acoustic model"
     xrun python train_dnntts.py model=$acoustic_model tqdm=$tqdm \
+        data.scaler_dir=$dump_org_dir \
         data.train.utt_list=data/train.list \
-        data.train.in_dir=$dump_norm_dir/$train_set/in_acoustic/ \
-        data.train.out_dir=$dump_norm_dir/$train_set/out_acoustic/ \
+        data.train.in_dir=$dump_org_dir/$train_set/in_acoustic/ \
+        data.train.out_dir=$dump_org_dir/$train_set/out_acoustic/ \
         data.dev.utt_list=data/dev.list \
-        data.dev.in_dir=$dump_norm_dir/$dev_set/in_acoustic/ \
-        data.dev.out_dir=$dump_norm_dir/$dev_set/out_acoustic/ \
+        data.dev.in_dir=$dump_org_dir/$dev_set/in_acoustic/ \
+        data.dev.out_dir=$dump_org_dir/$dev_set/out_acoustic/ \
         train.out_dir=$expdir/${acoustic_model} \
         train.log_dir=tensorboard/${expname}_${acoustic_model} \
         train.nepochs=$dnntts_train_nepochs \
@@ -155,12 +149,12 @@ if [ ${stage} -le 6 ] && [ ${stop_stage} -ge 6 ]; then
             out_dir=$expdir/synthesis_${duration_model}_${acoustic_model}/$s \
             sample_rate=$sample_rate qst_path=$qst_path \
             duration.checkpoint=$expdir/${duration_model}/$duration_eval_checkpoint \
-            duration.in_scaler_path=$dump_norm_dir/in_duration_scaler.joblib \
-            duration.out_scaler_path=$dump_norm_dir/out_duration_scaler.joblib \
+            duration.in_scaler_path=$dump_org_dir/in_duration_scaler.joblib \
+            duration.out_scaler_path=$dump_org_dir/out_duration_scaler.joblib \
             duration.model_yaml=$expdir/${duration_model}/model.yaml \
             acoustic.checkpoint=$expdir/${acoustic_model}/$acoustic_eval_checkpoint \
-            acoustic.in_scaler_path=$dump_norm_dir/in_acoustic_scaler.joblib \
-            acoustic.out_scaler_path=$dump_norm_dir/out_acoustic_scaler.joblib \
+            acoustic.in_scaler_path=$dump_org_dir/in_acoustic_scaler.joblib \
+            acoustic.out_scaler_path=$dump_org_dir/out_acoustic_scaler.joblib \
             acoustic.model_yaml=$expdir/${acoustic_model}/model.yaml \
             post_filter=$post_filter reverse=$reverse num_eval_utts=$num_eval_utts
     done
@@ -201,7 +195,7 @@ EOL
     # Stats
     for typ in "duration" "acoustic"; do
         for inout in "in" "out"; do
-            python $COMMON_ROOT/scaler_joblib2npy.py $dump_norm_dir/${inout}_${typ}_scaler.joblib $dst_dir
+            python $COMMON_ROOT/scaler_joblib2npy.py $dump_org_dir/${inout}_${typ}_scaler.joblib $dst_dir
         done
     done
 
@@ -0,0 +1,113 @@
+"""LengthRegulator.LRを, 以前のphoneme毎のpython loopの実装と比べるためのコード.
+
+- padされた出力とmel_lenが以前のloopと一致するか (max_lenあり/なし)
+- 実行時間
+
+fastspeech2とfastspeech2VCのLengthRegulatorの両方を対象にする.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append("../..")
+from vc_tts_template.fastspeech2.varianceadaptor import LengthRegulator
+from vc_tts_template.fastspeech2VC.varianceadaptor import LengthRegulator as LengthRegulatorVC
+from vc_tts_template.utils import pad
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark LengthRegulator against the previous per-phoneme loop",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--batch_size", type=int, default=16, help="batch size")
+    parser.add_argument("--min_phonemes", type=int, default=20, help="minimum number of phonemes")
+    parser.add_argument("--max_phonemes", type=int, default=150, help="maximum number of phonemes")
+    parser.add_argument("--dim", type=int, default=256, help="encoder hidden dimension")
+    parser.add_argument("--n_trials", type=int, default=20, help="number of random batches")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def make_batch(rng, args, device):
+    # phoneme数は一様, durationは対数正規 (平均6 frame程度) にして, 一部を0にする.
+    # 短い系列のpad部分のdurationは0.
+    n_phonemes = rng.integers(args.min_phonemes, args.max_phonemes + 1, args.batch_size)
+    max_src_len = int(np.max(n_phonemes))
+    duration = np.zeros((args.batch_size, max_src_len), dtype=np.int64)
+    for i, n in enumerate(n_phonemes):
+        d = np.round(rng.lognormal(1.6, 0.6, n))
+        d[rng.random(n) < 0.05] = 0
+        duration[i, :n] = d
+    x = torch.randn(args.batch_size, max_src_len, args.dim, device=device)
+    return x, torch.from_numpy(duration).to(device)
+
+
+def reference_LR(x, duration, max_len):
+    # 以前のLengthRegulator.LR.
+    output = list()
+    mel_len = list()
+    for batch, expand_target in zip(x, duration):
+        out = list()
+        for i, vec in enumerate(batch):
+            expand_size = expand_target[i].item()
+            out.append(vec.expand(max(int(expand_size), 0), -1))
+        expanded = torch.cat(out, 0)
+        output.append(expanded)
+        mel_len.append(expanded.shape[0])
+
+    if max_len is not None:
+        output = pad(output, max_len)
+    else:
+        output = pad(output)
+
+    return output, torch.LongTensor(mel_len).to(x.device)
+
+
+def timeit(fn, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args(sys.argv[1:])
+    device = torch.device(args.device)
+    rng = np.random.default_rng(args.seed)
+    torch.manual_seed(args.seed)
+
+    regulators = {
+        "fastspeech2": LengthRegulator().to(device),
+        "fastspeech2VC": LengthRegulatorVC().to(device),
+    }
+    times = {name: [] for name in ["loop"] + list(regulators.keys())}
+    n_same = {name: 0 for name in regulators.keys()}
+    n_cases = 0
+    with torch.no_grad():
+        for _ in range(args.n_trials):
+            x, duration = make_batch(rng, args, device)
+            # 学習時はtargetのmelの長さ, 推論時はNone. 前者はreferenceの最大長に合わせる.
+            target_len = int(torch.sum(duration, dim=1).max().item())
+            for max_len in [target_len, None]:
+                n_cases += 1
+                ref_out, ref_mel_len = reference_LR(x, duration, max_len)
+                times["loop"].append(timeit(lambda: reference_LR(x, duration, max_len), device))
+                for name, regulator in regulators.items():
+                    out, mel_len = regulator.LR(x, duration, max_len)
+                    n_same[name] += bool(
+                        torch.equal(out, ref_out) and torch.equal(mel_len.long(), ref_mel_len)
+                    )
+                    times[name].append(timeit(lambda: regulator.LR(x, duration, max_len), device))
+
+    for name, n in n_same.items():
+        print(f"{name} outputs and mel_len equal to the previous loop: {n}/{n_cases}")
+    for name, elapsed in times.items():
+        print(f"{name}: {np.mean(elapsed) * 1000:.2f} ms / batch")
@@ -24,12 +24,37 @@ testsets=($eval_set)
 
 stage=0
 stop_stage=0
+# 前処理を複数の計算機に分けるときは, 各計算機で stage 1 を --shard i/N として実行し,
+# 全shardが終わってから stage 1 を --merge_shards 1 として実行してまとめる.
+shard=""
+merge_shards=0
+# 学習のprocess数. 2以上ならtorchrunで起動してDistributedDataParallelで学習する.
+nproc_per_node=1
 
 . $COMMON_ROOT/parse_options.sh || exit 1;
 
 dumpdir=dump
 dump_org_dir=$dumpdir/${spk}_sr${sample_rate}/org
-dump_norm_dir=$dumpdir/${spk}_sr${sample_rate}/norm
+dump_pack_dir=$dumpdir/${spk}_sr${sample_rate}/packed
+# resample済みの波形のcache. wavの中身のhashがkeyなので, recipe間で共有できる.
+audio_cache_dir=../audio_cache
+
+# 学習で読むdumpの場所. pack_dumpならshard化したものを読む.
+# どちらもorgの特徴量で, 学習時にcollateで$dump_org_dirのscalerを使って正規化する.
+if [ ${pack_dump:=0} -ge 1 ]; then
+    train_dump_dir=$dump_pack_dir
+else
+    train_dump_dir=$dump_org_dir
+fi
+
+# 学習の起動方法
+if [ ${nproc_per_node} -ge 2 ]; then
+    train_python="torchrun --standalone --nproc_per_node=$nproc_per_node"
+    distributed=true
+else
+    train_python=python
+    distributed=false
+fi
 
 # exp name
 if [ -z ${tag:=} ]; then
@@ -80,17 +105,24 @@ fi
 
 if [ ${stage} -le 1 ] && [ ${stop_stage} -ge 1 ]; then
     echo "stage 1: Feature generation for fastspeech2"
-    for s in ${datasets[@]}; do
-        xrun python preprocess.py data/$s.list $wav_root $lab_root \
-            $dump_org_dir/$s --n_jobs $n_jobs \
-            --sample_rate $sample_rate --filter_length $filter_length \
-            --hop_length $hop_length --win_length $win_length \
-            --n_mel_channels $n_mel_channels --mel_fmin $mel_fmin --mel_fmax $mel_fmax \
-            --clip $clip --log_base $log_base \
-            --pitch_phoneme_averaging $pitch_phoneme_averaging \
-            --energy_phoneme_averaging $energy_phoneme_averaging  \
-            --accent_info $accent_info
-    done
+    if [ ${merge_shards} -ge 1 ]; then
+        xrun python $COMMON_ROOT/merge_shards.py ${datasets[@]/#/$dump_org_dir/}
+    else
+        for s in ${datasets[@]}; do
+            xrun python $COMMON_ROOT/fill_audio_cache.py data/$s.list $audio_cache_dir $wav_root \
+                --sample_rate $sample_rate --n_jobs $n_jobs ${shard:+--shard $shard}
+            xrun python preprocess.py data/$s.list $wav_root $lab_root \
+                $dump_org_dir/$s --n_jobs $n_jobs \
+                --sample_rate $sample_rate --filter_length $filter_length \
+                --hop_length $hop_length --win_length $win_length \
+                --n_mel_channels $n_mel_channels --mel_fmin $mel_fmin --mel_fmax $mel_fmax \
+                --clip $clip --log_base $log_base \
+                --pitch_phoneme_averaging $pitch_phoneme_averaging \
+                --energy_phoneme_averaging $energy_phoneme_averaging  \
+                --accent_info $accent_info \
+                --audio_cache_dir $audio_cache_dir ${shard:+--shard $shard}
+        done
+    fi
     # preprocess実行時にのみcopyするようにする.
     mkdir -p $expdir/data
     cp -r data/*.list $expdir/data/
@@ -98,44 +130,35 @@ fi
 
 if [ ${stage} -le 2 ] && [ ${stop_stage} -ge 2 ]; then
     echo "stage 2: feature normalization"
+    # 全ての特徴量のscalerを, 発話を1回読むだけでまとめて並列にfitする.
+    streams=""
     for typ in "fastspeech2"; do
        for inout in "out"; do
             for feat in "mel" "pitch" "energy"; do
-                xrun python $COMMON_ROOT/fit_scaler.py data/train.list \
-                    $dump_org_dir/$train_set/${inout}_${typ}/${feat} \
-                    $dump_org_dir/${inout}_${typ}_${feat}_scaler.joblib
+                streams="$streams --stream $dump_org_dir/$train_set/${inout}_${typ}/${feat} $dump_org_dir/${inout}_${typ}_${feat}_scaler.joblib"
             done
         done
     done
+    xrun python $COMMON_ROOT/fit_scaler.py data/train.list $streams --n_jobs $n_jobs --manifest
 
-    mkdir -p $dump_norm_dir
-    cp -v $dump_org_dir/*.joblib $dump_norm_dir/
-
-    for s in ${datasets[@]}; do
-        for typ in "fastspeech2"; do
-            for inout in "out" "in"; do
-                if [ $inout == "in" ]; then
-                    cp -r $dump_org_dir/$s/${inout}_${typ} $dump_norm_dir/$s/
-                    continue
-                fi
-                for feat in "mel" "pitch" "energy" "duration"; do
-                    if [ $feat == "duration" ]; then
-                        cp -r $dump_org_dir/$s/${inout}_${typ}/${feat} $dump_norm_dir/$s/${inout}_${typ}
-                        continue
-                    fi
-                    xrun python $COMMON_ROOT/preprocess_normalize.py data/$s.list \
-                        $dump_org_dir/${inout}_${typ}_${feat}_scaler.joblib \
-                        $dump_org_dir/$s/${inout}_${typ}/${feat} \
-                        $dump_norm_dir/$s/${inout}_${typ}/${feat} --n_jobs $n_jobs
-                done
+    # 正規化は学習, 合成時にscalerで行うので, 正規化した特徴量のdump(norm)は作らない.
+    if [ $pack_dump -ge 1 ]; then
+        for s in ${datasets[@]}; do
+            for inout in "in" "out"; do
+                xrun python $COMMON_ROOT/pack_dump.py data/$s.list \
+                    $dump_org_dir/$s/${inout}_fastspeech2 $dump_pack_dir/$s/${inout}_fastspeech2
             done
+            # 発話長のindexも一緒に置いておく(学習時のbucketingで利用).
+            if [ -e $dump_org_dir/$s/lengths.tsv ]; then
+                cp -v $dump_org_dir/$s/lengths.tsv $dump_pack_dir/$s/
+            fi
         done
-    done
+    fi
 fi
 
 if [ ${stage} -le 3 ] && [ ${stop_stage} -ge 3 ]; then
     echo "stage 3: finetuning hifigan"
-    xrun python train_hifigan.py model=$vocoder_model tqdm=$tqdm \
+    xrun $train_python train_hifigan.py distributed=$distributed model=$vocoder_model tqdm=$tqdm \
         cudnn.benchmark=$cudnn_benchmark cudnn.deterministic=$cudnn_deterministic \
         data.train.utt_list=data/train.list \
         data.train.in_dir=$wav_root \
@@ -143,6 +166,7 @@ if [ ${stage} -le 3 ] && [ ${stop_stage} -ge 3 ]; then
         data.dev.in_dir=$wav_root \
         data.batch_size=$hifigan_data_batch_size \
         data.sampling_rate=$sample_rate \
+        data.audio_cache_dir=$audio_cache_dir \
         data.n_fft=$filter_length \
         data.num_mels=$n_mel_channels \
         data.hop_size=$hop_length \
@@ -159,21 +183,23 @@ fi
 
 if [ ${stage} -le 4 ] && [ ${stop_stage} -ge 4 ]; then
     echo "stage 4: Training fastspeech2"
-    xrun python train_fastspeech2.py model=$acoustic_model tqdm=$tqdm \
+    xrun $train_python train_fastspeech2.py distributed=$distributed model=$acoustic_model tqdm=$tqdm \
         cudnn.benchmark=$cudnn_benchmark cudnn.deterministic=$cudnn_deterministic \
         data.train.utt_list=data/train.list \
-        data.train.in_dir=$dump_norm_dir/$train_set/in_fastspeech2/ \
-        data.train.out_dir=$dump_norm_dir/$train_set/out_fastspeech2/ \
+        data.train.in_dir=$train_dump_dir/$train_set/in_fastspeech2/ \
+        data.train.out_dir=$train_dump_dir/$train_set/out_fastspeech2/ \
         data.dev.utt_list=data/dev.list \
-        data.dev.in_dir=$dump_norm_dir/$dev_set/in_fastspeech2/ \
-        data.dev.out_dir=$dump_norm_dir/$dev_set/out_fastspeech2/ \
+        data.dev.in_dir=$train_dump_dir/$dev_set/in_fastspeech2/ \
+        data.dev.out_dir=$train_dump_dir/$dev_set/out_fastspeech2/ \
         data.batch_size=$fastspeech2_data_batch_size \
+        data.packed=$pack_dump \
+        data.scaler_dir=$dump_org_dir \
         data.accent_info=$accent_info \
         train.out_dir=$expdir/${acoustic_model} \
         train.log_dir=tensorboard/${expname}_${acoustic_model} \
         train.nepochs=$fastspeech2_train_nepochs \
         train.sampling_rate=$sample_rate \
-        train.mel_scaler_path=$dump_norm_dir/out_fastspeech2_mel_scaler.joblib \
+        train.mel_scaler_path=$dump_org_dir/out_fastspeech2_mel_scaler.joblib \
         train.vocoder_name=$vocoder_model \
         train.vocoder_config=$vocoder_config \
         train.vocoder_weight_path=$vocoder_weight_base_path/$vocoder_eval_checkpoint \
@@ -192,12 +218,13 @@ if [ ${stage} -le 5 ] && [ ${stop_stage} -ge 5 ]; then
     echo "stage 5: Synthesis waveforms by hifigan"
     for s in ${testsets[@]}; do
         xrun python synthesis.py utt_list=./data/$s.list tqdm=$tqdm \
-            in_dir=$dump_norm_dir/$s/in_fastspeech2 \
-            in_mel_dir=$dump_norm_dir/$s/out_fastspeech2/mel \
+            in_dir=$dump_org_dir/$s/in_fastspeech2 \
+            in_mel_dir=$dump_org_dir/$s/out_fastspeech2/mel \
+            scaler_dir=$dump_org_dir \
             out_dir=$expdir/synthesis_${acoustic_model}_${vocoder_model}/$s \
             sample_rate=$sample_rate \
             acoustic.checkpoint=$expdir/${acoustic_model}/$acoustic_eval_checkpoint \
-            acoustic.out_scaler_path=$dump_norm_dir/out_fastspeech2_mel_scaler.joblib \
+            acoustic.out_scaler_path=$dump_org_dir/out_fastspeech2_mel_scaler.joblib \
             acoustic.model_yaml=$expdir/${acoustic_model}/model.yaml \
             vocoder.checkpoint=$vocoder_weight_base_path/$vocoder_eval_checkpoint \
             vocoder.model_yaml=$vocoder_config \
@@ -216,18 +243,20 @@ if [ ${stage} -le 90 ] && [ ${stop_stage} -ge 90 ]; then
         tuning.storage=sqlite:///../../../${expdir}/${acoustic_model}/optuna_study.db \
         cudnn.benchmark=$cudnn_benchmark cudnn.deterministic=$cudnn_deterministic \
         data.train.utt_list=data/train.list \
-        data.train.in_dir=$dump_norm_dir/$train_set/in_fastspeech2/ \
-        data.train.out_dir=$dump_norm_dir/$train_set/out_fastspeech2/ \
+        data.train.in_dir=$train_dump_dir/$train_set/in_fastspeech2/ \
+        data.train.out_dir=$train_dump_dir/$train_set/out_fastspeech2/ \
         data.dev.utt_list=data/dev.list \
-        data.dev.in_dir=$dump_norm_dir/$dev_set/in_fastspeech2/ \
-        data.dev.out_dir=$dump_norm_dir/$dev_set/out_fastspeech2/ \
+        data.dev.in_dir=$train_dump_dir/$dev_set/in_fastspeech2/ \
+        data.dev.out_dir=$train_dump_dir/$dev_set/out_fastspeech2/ \
         data.batch_size=$fastspeech2_data_batch_size \
+        data.packed=$pack_dump \
+        data.scaler_dir=$dump_org_dir \
         data.accent_info=$accent_info \
         train.out_dir=$expdir/${acoustic_model} \
         train.log_dir=tensorboard/${expname}_${acoustic_model} \
         train.nepochs=$fastspeech2_train_nepochs \
         train.sampling_rate=$sample_rate \
-        train.mel_scaler_path=$dump_norm_dir/out_fastspeech2_mel_scaler.joblib \
+        train.mel_scaler_path=$dump_org_dir/out_fastspeech2_mel_scaler.joblib \
         train.vocoder_name=$vocoder_model \
         train.vocoder_config=$vocoder_config \
         train.vocoder_weight_path=$vocoder_weight_base_path/$vocoder_eval_checkpoint \
@@ -270,7 +299,7 @@ vocoder_model: ${vocoder_model}
 EOL
 
     # Stats
-    python $COMMON_ROOT/scaler_joblib2npy.py $dump_norm_dir/out_fastspeech2_mel_scaler.joblib $dst_dir
+    python $COMMON_ROOT/scaler_joblib2npy.py $dump_org_dir/out_fastspeech2_mel_scaler.joblib $dst_dir
 
     # Acoustic model
     python $COMMON_ROOT/clean_checkpoint_state.py $expdir/${acoustic_model}/$acoustic_eval_checkpoint \
@@ -84,7 +84,9 @@ def my_app(config: DictConfig) -> None:
 
         for mel_file in optional_tqdm(config.tqdm, desc="Utterance")(mel_files):
             mel_org = np.load(mel_file)
-            mel_org = acoustic_out_scaler.inverse_transform(mel_org)  # type: ignore
+            if not config.get("scaler_dir", None):
+                # 正規化済みのmel (norm) なので元に戻す.
+                mel_org = acoustic_out_scaler.inverse_transform(mel_org)  # type: ignore
             mel_org = torch.Tensor(mel_org).unsqueeze(0).to(device)
             wav = vocoder_model(mel_org.transpose(1, 2)).squeeze(1).cpu().data.numpy()[0]
             utt_id = Path(mel_file).name.replace("-feats.npy", "")
@@ -10,6 +10,8 @@ import matplotlib.pyplot as plt
 sys.path.append("../..")
 from vc_tts_template.fastspeech2.collate_fn import (
     collate_fn_fastspeech2, fastspeech2_get_data_loaders)
+from vc_tts_template.distributed import init_distributed
+from vc_tts_template.metrics import step_timer
 from vc_tts_template.train_utils import setup, get_vocoder, vocoder_infer, free_tensors_memory
 from recipes.common.train_loop import train_loop
 from recipes.fastspeech2.utils import plot_mel_with_prosody
@@ -28,13 +30,14 @@ def fastspeech2_train_step(
     scaler,
     grad_checker,
     trial=False,
+    metrics=None,
 ):
     """dev時にはpredしたp, eで計算してほしいので, オリジナルのtrain_stepに.
     """
     optimizer.zero_grad()
 
     # Run forwaard
-    with torch.cuda.amp.autocast():
+    with step_timer(metrics, "forward"), torch.cuda.amp.autocast():
         if train is True:
             output = model(*batch)
         else:
@@ -49,21 +52,23 @@ def fastspeech2_train_step(
 
     # Update
     if train:
-        scaler.scale(loss).backward()
-        grad_checker.set_params(model.named_parameters())
-        free_tensors_memory([loss])
-        scaler.unscale_(optimizer)
-        grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-        if not torch.isfinite(grad_norm):
-            grad_checker.report(loss_values, trial)
-            if scaler.is_enabled() is True:
-                logger.info("grad norm is NaN. Will Skip updating")
-            else:
-                logger.error("grad norm is NaN. check your model grad flow.")
-                raise ValueError("Please check log.")
-        scaler.step(optimizer)
-        scaler.update()
-        lr_scheduler.step()
+        with step_timer(metrics, "backward"):
+            scaler.scale(loss).backward()
+        with step_timer(metrics, "optimizer"):
+            grad_checker.set_params(model.named_parameters())
+            free_tensors_memory([loss])
+            scaler.unscale_(optimizer)
+            grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            if not torch.isfinite(grad_norm):
+                grad_checker.report(loss_values, trial)
+                if scaler.is_enabled() is True:
+                    logger.info("grad norm is NaN. Will Skip updating")
+                else:
+                    logger.error("grad norm is NaN. check your model grad flow.")
+                    raise ValueError("Please check log.")
+            scaler.step(optimizer)
+            scaler.update()
+            lr_scheduler.step()
 
     return loss_values
 
@@ -166,12 +171,14 @@ def to_device(data, phase, device):
 
 @hydra.main(config_path="conf/train_fastspeech2", config_name="config")
 def my_app(config: DictConfig) -> None:
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # distributed=trueならtorchrunのrankごとのdevice.
+    device = init_distributed(config)
 
     # 以下自由
     collate_fn = partial(
         collate_fn_fastspeech2, batch_size=config.data.batch_size,
         speaker_dict=config.model.netG.speakers, emotion_dict=config.model.netG.emotions,
+        max_frames=config.data.get("max_frames", None),
     )
 
     model, optimizer, lr_scheduler, loss, data_loaders, writers, logger, last_epoch, last_train_iter = setup(
@@ -9,10 +9,12 @@ import torch.nn.functional as F
 
 sys.path.append("../..")
 from recipes.common.train_loop import train_loop
+from vc_tts_template.distributed import init_distributed
+from vc_tts_template.metrics import step_timer
 from vc_tts_template.train_utils import setup
 from vc_tts_template.vocoder.hifigan.collate_fn import (
     collate_fn_hifigan, hifigan_get_data_loaders)
-from vc_tts_template.vocoder.hifigan.collate_fn import mel_spectrogram
+from vc_tts_template.vocoder.hifigan.collate_fn import mel_spectrogram, hifigan_mel_spectrograms
 from vc_tts_template.train_utils import plot_mels
 
 
@@ -24,8 +26,12 @@ def hifigan_train_step(
     loss,
     batch,
     logger,
-    mel_spectrogram_in_train_step
+    scaler,
+    grad_checker,
+    mel_spectrogram_in_train_step,
+    metrics=None,
 ):
+    """train_loopから呼ばれる. scaler, grad_checkerはAMPを使わないので使わない."""
     if train:
         _, y, x, y_mel = batch
         x = torch.autograd.Variable(x)
@@ -47,7 +53,8 @@ def hifigan_train_step(
         loss_disc_all = loss_disc_s + loss_disc_f
 
         loss_disc_all.backward()
-        optimizer.optim_d.step()
+        with step_timer(metrics, "optimizer"):
+            optimizer.optim_d.step()
 
         optimizer.optim_g.zero_grad()
 
@@ -62,12 +69,14 @@ def hifigan_train_step(
         loss_gen_all = loss_gen_s + loss_gen_f + loss_fm_s + loss_fm_f + loss_mel
 
         loss_gen_all.backward()
-        optimizer.optim_g.step()
+        with step_timer(metrics, "optimizer"):
+            optimizer.optim_g.step()
 
+        # .item()せずに返し, 同期はMetricsAggregatorに任せる.
         with torch.no_grad():
-            mel_error = F.l1_loss(y_mel, y_g_hat_mel).item()
+            mel_error = F.l1_loss(y_mel, y_g_hat_mel)
         loss_values = {
-            'Gen Loss Total': loss_gen_all.item(),
+            'Gen Loss Total': loss_gen_all.detach(),
             'Mel-Spec. Error': mel_error,
         }
 
@@ -84,7 +93,7 @@ def hifigan_train_step(
                 y_g_hat = model['netG'](x_)
                 y_mel_ = torch.autograd.Variable(y_mel_)
                 y_g_hat_mel = mel_spectrogram_in_train_step(y=y_g_hat.squeeze(1))
-                val_err += F.l1_loss(y_mel_, y_g_hat_mel).item()
+                val_err += F.l1_loss(y_mel_, y_g_hat_mel)
                 cnt += 1
         loss_values = {
             'Mel-Spec. Error': val_err/cnt,
@@ -128,7 +137,7 @@ def hifigan_eval_model(
         plt.close()
 
 
-def to_device(data, phase, device):
+def to_device(data, phase, device, data_config):
     (
         ids,
         audios,
@@ -138,10 +147,17 @@ def to_device(data, phase, device):
 
     if phase == 'train':
         audios = torch.Tensor(audios).float().to(device, non_blocking=True)
+    else:
+        audios = [torch.Tensor(audio).float().to(device, non_blocking=True) for audio in audios]
+
+    if mels is None:
+        # data.mel_on_device: collateではmelを作らず, ここでbatchでまとめて計算する.
+        with torch.no_grad():
+            mels, mel_losses = hifigan_mel_spectrograms(audios, data_config)
+    elif phase == 'train':
         mels = torch.Tensor(mels).float().to(device, non_blocking=True)
         mel_losses = torch.Tensor(mel_losses).float().to(device, non_blocking=True)
     else:
-        audios = [torch.Tensor(audio).float().to(device, non_blocking=True) for audio in audios]
         mels = [torch.Tensor(mel).float().to(device, non_blocking=True) for mel in mels]
         mel_losses = [torch.Tensor(mel_loss).float().to(device, non_blocking=True) for mel_loss in mel_losses]
 
@@ -155,7 +171,8 @@ def to_device(data, phase, device):
 
 @hydra.main(config_path="conf/train_hifigan", config_name="config")
 def my_app(config: DictConfig) -> None:
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # distributed=trueならtorchrunのrankごとのdevice.
+    device = init_distributed(config)
 
     # 以下自由
     collate_fn = partial(
@@ -184,7 +201,7 @@ def my_app(config: DictConfig) -> None:
         hifigan_eval_model, mel_spectrogram_in_eval=mel_spectrogram_in_eval, sampling_rate=config.data.sampling_rate
     )
     # 以下固定
-    to_device_ = partial(to_device, device=device)
+    to_device_ = partial(to_device, device=device, data_config=config.data)
     train_loop(config, to_device_, model, optimizer, lr_scheduler, loss,
                data_loaders, writers, logger, eval_model, train_step, epoch_step=True,
                last_epoch=last_epoch, last_train_iter=last_train_iter)
@@ -20,6 +20,7 @@ def _objective(trial, config):
     collate_fn = partial(
         collate_fn_fastspeech2, batch_size=config.data.batch_size,
         speaker_dict=config.model.netG.speakers, emotion_dict=config.model.netG.emotions,
+        max_frames=config.data.get("max_frames", None),
     )
     model, optimizer, lr_scheduler, loss, data_loaders, logger = optuna_setup(
         config, device, collate_fn, trial, fastspeech2_get_data_loaders  # type: ignore
@@ -0,0 +1,149 @@
+"""calc_durationのDTWを, 以前のfastdtw + python loopの実装と比べるためのコード.
+
+- 厳密解 (fastdtw.dtw) とpathが一致するか
+- 同じpathから, 以前のloopと同じdurationが得られるか (diagonal_indexの処理込み)
+- 以前の前処理が使っていた近似解 (fastdtw.fastdtw) のdurationとどれだけ違うか
+- --bandを指定したときに, 厳密解のdurationとどれだけ違うか
+- 実行時間
+
+fastdtwが入っていない場合は, pathの比較とfastdtwの計時を飛ばす.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+from scipy.spatial.distance import cityblock
+
+sys.path.append("../..")
+from vc_tts_template.dtw import diagonalize, dtw, path_to_duration
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the DTW aligner against fastdtw",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--n_frames", type=int, default=300, help="number of source frames")
+    parser.add_argument("--dim", type=int, default=20, help="feature dimension")
+    parser.add_argument("--n_trials", type=int, default=5, help="number of random pairs")
+    parser.add_argument("--band", type=int, default=None, help="also run dtw with this Sakoe-Chiba band")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def make_pair(rng, n_frames, dim):
+    # sourceを滑らかな系列にして, targetはそれを時間伸縮してnoiseを足したものにする.
+    source = np.cumsum(rng.standard_normal((n_frames, dim)), axis=0)
+    rate = np.exp(np.cumsum(rng.normal(0, 0.05, n_frames)))
+    t_pos = np.cumsum(rate)
+    t_pos = t_pos / t_pos[-1] * (n_frames * rng.uniform(0.7, 1.3) - 1)
+    target = np.stack([np.interp(np.arange(int(t_pos[-1]) + 1), t_pos, source[:, d]) for d in range(dim)], 1)
+    target = target + rng.normal(0, 0.1, target.shape)
+    # 無音区間の代わりにランダムな区間を対角化の対象にする.
+    diagonal_index = np.zeros(n_frames, dtype=bool)
+    for s in rng.integers(0, n_frames, 3):
+        diagonal_index[s:s + rng.integers(1, 20)] = True
+    return target, source, diagonal_index
+
+
+def reference_duration(path, n_source, diagonal_index):
+    # 以前のcalc_durationのloop.
+    duration = np.ones(n_source)
+    patht = np.array([p[0] for p in path])
+    paths = np.array([p[1] for p in path])
+    b_p_t, b_p_s = 0, 0
+    count = 0
+    for p_t, p_s in zip(patht[1:], paths[1:]):
+        if b_p_t == p_t:
+            duration[p_s] = 0
+        if b_p_s == p_s:
+            count += 1
+        elif count > 0:
+            duration[b_p_s] += count
+            count = 0
+        b_p_t = p_t
+        b_p_s = p_s
+    duration[b_p_s] += count if count > 0 else 0
+
+    s_ind, flg = 0, 0
+    index_list = []
+    for i, v in enumerate(diagonal_index):
+        if (flg == 0) and v:
+            s_ind, flg = i, 1
+        elif (flg == 1) and (not v):
+            index_list.append([s_ind, i])
+            flg = 0
+    if v:
+        index_list.append([s_ind, i + 1])
+    for s, e in index_list:
+        part = duration[s:e]
+        if np.sum(part) > len(part):
+            mean_ = np.sum(part) // len(part)
+            rest_ = int(np.sum(part) % (len(part) * mean_))
+            part[:] = mean_
+            part[:rest_] += 1
+        else:
+            s_index = int(np.sum(part))
+            part[:s_index] = 1
+            part[s_index:] = 0
+        duration[s:e] = part
+    return duration
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args(sys.argv[1:])
+    rng = np.random.default_rng(args.seed)
+    try:
+        import fastdtw
+    except ImportError:
+        fastdtw = None
+        print("fastdtw is not installed. Skip the comparison with fastdtw.")
+
+    times = {"dtw": [], "dtw (band)": [], "fastdtw.fastdtw": [], "fastdtw.dtw": []}
+    n_same_path, n_same_duration = 0, 0
+    # 厳密解のdurationとの差. 一致した発話数と, frame毎の差の絶対値の平均.
+    diffs = {"fastdtw.fastdtw": [], "dtw (band)": []}
+    for _ in range(args.n_trials):
+        target, source, diagonal_index = make_pair(rng, args.n_frames, args.dim)
+
+        start = time.perf_counter()
+        cost, path = dtw(target, source, metric="cityblock")
+        duration = diagonalize(path_to_duration(path, len(source)), diagonal_index)
+        times["dtw"].append(time.perf_counter() - start)
+
+        assert np.sum(duration) == len(target)
+        n_same_duration += np.array_equal(duration, reference_duration(path, len(source), diagonal_index))
+
+        if args.band is not None:
+            start = time.perf_counter()
+            _, band_path = dtw(target, source, metric="cityblock", band=args.band)
+            band_duration = diagonalize(path_to_duration(band_path, len(source)), diagonal_index)
+            times["dtw (band)"].append(time.perf_counter() - start)
+            diffs["dtw (band)"].append(np.abs(band_duration - duration))
+
+        if fastdtw is not None:
+            start = time.perf_counter()
+            _, approx_path = fastdtw.fastdtw(target, source, dist=cityblock)
+            times["fastdtw.fastdtw"].append(time.perf_counter() - start)
+            approx_duration = reference_duration(approx_path, len(source), diagonal_index)
+            diffs["fastdtw.fastdtw"].append(np.abs(approx_duration - duration))
+
+            start = time.perf_counter()
+            ref_cost, ref_path = fastdtw.dtw(target, source, dist=cityblock)
+            times["fastdtw.dtw"].append(time.perf_counter() - start)
+            n_same_path += np.array_equal(path, np.array(ref_path)) and np.isclose(cost, ref_cost)
+
+    print(f"durations equal to the previous loop: {n_same_duration}/{args.n_trials}")
+    if fastdtw is not None:
+        print(f"paths equal to fastdtw.dtw: {n_same_path}/{args.n_trials}")
+    for name, diff in diffs.items():
+        if len(diff) > 0:
+            n_equal = sum(np.all(d == 0) for d in diff)
+            print(
+                f"durations of {name} equal to dtw: {n_equal}/{args.n_trials}, "
+                f"mean abs diff {np.mean(np.concatenate(diff)):.3f} frames"
+            )
+    for name, elapsed in times.items():
+        if len(elapsed) > 0:
+            print(f"{name}: {np.mean(elapsed) * 1000:.1f} ms / pair")
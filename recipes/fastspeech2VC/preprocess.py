@@ -1,21 +1,28 @@
 import argparse
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
-import librosa
 import numpy as np
 import pyworld as pw
-from fastdtw import fastdtw
-from pydub import AudioSegment, silence
+from scipy.io import wavfile
 
 sys.path.append("../..")
-from recipes.fastspeech2VC.utils import pydub_to_np
-from scipy.interpolate import interp1d
-from scipy.spatial.distance import cityblock
-from tqdm import tqdm
-from vc_tts_template.dsp import logmelspectrogram
+from recipes.common.preprocess_runner import (
+    ERRORS_NAME, SHARD_HELP, parse_shard, run_preprocess, select_shard, shard_path
+)
+from vc_tts_template.audio_cache import get_audio_cache, load_audio
+from vc_tts_template.dsp import SpectralFeatureExtractor
+from vc_tts_template.dtw import diagonalize, dtw, path_to_duration
+from vc_tts_template.length_index import LENGTH_INDEX_NAME, UttLength, write_length_index
+from vc_tts_template.manifest import (
+    MANIFEST_NAME, Manifest, RecordingJob, feats_outputs, length_index_from_entries, params_from_args
+)
+from vc_tts_template.prosody import interp_unvoiced
+from vc_tts_template.silence import (
+    detect_silence, duration_ms, max_amplitude, slice_ms, trim_silence, zero_sections
+)
 
 
 def get_parser():
@@ -28,6 +35,8 @@ def get_parser():
     parser.add_argument("tgt_wav_root", type=str, help="target wav root")
     parser.add_argument("out_dir", type=str, help="out directory")
     parser.add_argument("--n_jobs", type=int, default=1, help="Number of jobs")
+    parser.add_argument("--task_chunk_size", type=int, default=1, help="Number of utterances sent to a worker at once")
+    parser.add_argument("--shard", type=str, help=SHARD_HELP)
     parser.add_argument("--sample_rate", type=int)
     parser.add_argument("--silence_thresh_h", type=int, help="silence thresh of head")
     parser.add_argument("--silence_thresh_t", type=int, help="silence thresh of tail")
@@ -44,104 +53,62 @@ def get_parser():
     parser.add_argument("--reduction_factor", type=int)
     parser.add_argument("--sentence_duration", type=int)
     parser.add_argument("--min_silence_len", type=int)
+    parser.add_argument("--dtw_band", type=int, default=None, help="Sakoe-Chiba band of DTW. full if not given")
+    parser.add_argument("--audio_cache_dir", type=str, help="resampled audio cache (fill_audio_cache.py)")
     return parser
 
 
-def make_novoice_to_zero(audio: AudioSegment, silence_thresh: float, min_silence_len: int) -> AudioSegment:
-    """無音判定をくらった部分を, 0にしてしまう.
-    """
-    silences = silence.detect_silence(audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
-
-    audio_new = AudioSegment.empty()
-    s_index = 0
-    for silence_ in silences:
-        audio_new += audio[s_index:silence_[0]]
-        audio_new += AudioSegment.silent(duration=silence_[1]-silence_[0])
-        s_index = silence_[1]
-
-    audio_new += audio[s_index:]
-
-    return audio_new
-
-
-def delete_novoice(input_path, silence_thresh_h, silence_thresh_t, chunk_size):
-    """無音区間を先頭と末尾から削除します.
+def delete_novoice(input_path, sr, silence_thresh_h, silence_thresh_t, chunk_size, audio_cache=None):
+    """無音区間を先頭と末尾から削除し, 途中の無音区間を0にします.
+    無音の判定は元の波形で行い, 同じms単位の区間をresample済みの波形に適用する.
     Args:
       input_path: wavファイルへのpath
-      output_path: wavファイルを貯めたい場所. ファイル名はinput_pathのbasenameからとる.
+      sr: resample後のsampling rate
       chunk_size: 削除に用いる音声の最小単位. 基本defaultのままで良さそう.
+      audio_cache: resample済みの波形のcache. あればresampleしない.
+    Returns:
+      np.ndarray: float32の波形.
     """
-    audio = AudioSegment.from_wav(input_path)
-    assert len(audio) > 0, f"{input_path}は音声が入っていないようです"
+    _sr, wav = wavfile.read(input_path)
+    assert len(wav) > 0, f"{input_path}は音声が入っていないようです"
+    assert wav.ndim == 1, f"{input_path}はmonoではないようです"
 
-    # 参考: https://stackoverflow.com/questions/29547218/
-    # remove-silence-at-the-beginning-and-at-the-end-of-wave-files-with-pydub
-    def detect_leading_silence(sound, silence_threshold=-50.0, chunk_size=10):
-        trim_ms = 0  # ms
+    wav_cut, (head_ms, tail_ms) = trim_silence(wav, _sr, silence_thresh_h, silence_thresh_t, chunk_size)
+    silences = detect_silence(wav_cut, _sr, min_silence_len=chunk_size, silence_thresh=silence_thresh_t)
 
-        assert chunk_size > 0  # to avoid infinite loop
-        while sound[trim_ms:trim_ms+chunk_size].dBFS < silence_threshold and trim_ms < len(sound):
-            trim_ms += chunk_size
+    x = load_audio(input_path, sr, audio_cache)
+    x = slice_ms(x, sr, head_ms, duration_ms(wav, _sr) - tail_ms)
+    # cacheの波形はintの最大値 (int16なら32767) で割ってある. このrecipeは以前から
+    # pydubと同じ2 ** (bits - 1) (32768) で割っていたので, 特徴量が変わらないように戻す.
+    if np.issubdtype(wav.dtype, np.integer):
+        x = x * np.float32(np.iinfo(wav.dtype).max / max_amplitude(wav))
+    x = zero_sections(x, sr, silences)
 
-        return trim_ms
+    assert len(x) > 0, f"{input_path}はすべてcutされてしまいました. 閾値を下げてください"
+    return x
 
-    start_trim = detect_leading_silence(audio, silence_threshold=silence_thresh_h, chunk_size=chunk_size)
-    end_trim = detect_leading_silence(audio.reverse(),
-                                      silence_threshold=silence_thresh_t, chunk_size=chunk_size)
 
-    audio_cut = audio[start_trim:len(audio)-end_trim]
-
-    audio_cut = make_novoice_to_zero(audio_cut, silence_thresh_t, chunk_size)
-
-    assert len(audio_cut) > 0, f"{input_path}はすべてcutされてしまいました. 閾値を下げてください"
-    return pydub_to_np(audio_cut)
-
-
-def continuous_pitch(pitch: np.ndarray) -> np.ndarray:
-    # 0の値をとったらnan扱いとして, 線形補完を行ってみる.
-    nonzero_ids = np.where(pitch > 1e-6)[0]
-    interp_fn = interp1d(
-        nonzero_ids,
-        pitch[nonzero_ids],
-        fill_value=(pitch[nonzero_ids[0]], pitch[nonzero_ids[-1]]),
-        bounds_error=False,
-    )
-    pitch = interp_fn(np.arange(0, len(pitch)))
-
-    return pitch
-
-
-def process_utterance(wav, sr, n_fft, hop_length, win_length,
+def process_utterance(wav, magnitude, extractor: SpectralFeatureExtractor,
                       n_mels, fmin, fmax, clip_thresh, log_base,
                       is_continuous_pitch):
+    sr = extractor.sr
     pitch, t = pw.dio(
         wav.astype(np.float64),
         sr,
-        frame_period=hop_length / sr * 1000,
+        frame_period=extractor.hop_length / sr * 1000,
     )
     pitch = pw.stonemask(wav.astype(np.float64),
                          pitch, t, sr)
     if np.sum(pitch != 0) <= 1:
         return None, None, None
-    mel_spectrogram, energy = logmelspectrogram(
-        wav,
-        sr,
-        n_fft,
-        hop_length,
-        win_length,
-        n_mels,
-        fmin,
-        fmax,
-        clip=clip_thresh,
-        log_base=log_base,
-        need_energy=True
-    )
-    energy = np.log(energy+1e-6)
+    mel_spectrogram = extractor.logmel(magnitude, n_mels, fmin, fmax, clip=clip_thresh, log_base=log_base)
+    energy = np.log(extractor.energy(magnitude)+1e-6)
 
     if is_continuous_pitch is True:
         no_voice_indexes = np.where(energy < -5.0)
         pitch[no_voice_indexes] = 0.0
-        pitch = continuous_pitch(pitch)
+        # 0の値をとったらnan扱いとして, 線形補完を行ってみる.
+        pitch = interp_unvoiced(pitch, threshold=1e-6)
 
     pitch = np.log(pitch+1e-6)
 
@@ -175,29 +142,9 @@ def reduction(x: np.ndarray, reduction_factor: int) -> np.ndarray:
     return x.T
 
 
-def get_s_e_index_from_bools(array):
-    """True, Falseのbool配列から, Trueがあるindexの最初と最後を見つけてindexの
-    配列として返す.
-    """
-    index_list = []
-    flg = 0
-    s_ind = 0
-    for i, v in enumerate(array):
-        if (flg == 0) and v:
-            s_ind = i
-            flg = 1
-        elif (flg == 1) and (not v):
-            index_list.append([s_ind, i])
-            flg = 0
-
-    if v:
-        # 最後がTrueで終わっていた場合.
-        index_list.append([s_ind, i+1])
-
-    return index_list
-
-
-def calc_duration(ts_src: List[np.ndarray], target_path: str, diagonal_index: np.ndarray = None) -> np.ndarray:
+def calc_duration(
+    ts_src: List[np.ndarray], target_path: str, diagonal_index: np.ndarray = None, band: Optional[int] = None
+) -> np.ndarray:
     """
     Args:
       ts_src: アライメントさせたい対象.
@@ -205,6 +152,8 @@ def calc_duration(ts_src: List[np.ndarray], target_path: str, diagonal_index: np
         最初のがtarget, 次にsorceが入っている.
       diagonal_index: 対角化させたいindex. False, Trueの値が入っている.
         対角化とは, sourceとtargetのtime indexをx, y軸とでもしたときに, 斜めになるようにすること.
+      band: DTWのSakoe-Chiba band幅 (reduction後のframe数). Noneなら全てのcellを計算する.
+        長い発話ではN x Mのcostを持たなくて済むように指定する.
 
     source : target = 多 : 1 のケース
         - 該当するsourceの最初を1, それ以外は0として削除してしまう.
@@ -215,53 +164,15 @@ def calc_duration(ts_src: List[np.ndarray], target_path: str, diagonal_index: np
         - これは従来通り, sourceに多を割り当てることで対応.
     """
     t_src, s_src = ts_src
-    duration = np.ones(s_src.shape[0])
-
-    # alignment開始.
-    _, path = fastdtw(t_src, s_src, dist=cityblock)
-
-    # xのpathを取り出して, 長さで正規化する.
-    patht = np.array(list(map(lambda l: l[0], path)))
-    paths = np.array(list(map(lambda l: l[1], path)))
-
-    b_p_t, b_p_s = 0, 0  # 初期化.
-    count = 0
-    for p_t, p_s in zip(patht[1:], paths[1:]):
-        if b_p_t == p_t:
-            # もし, targetの方が連続しているなら, s:t=多:1なので削る.
-            duration[p_s] = 0  # 消したいのは, p_tに対応しているp_sであることに注意.
-        if b_p_s == p_s:
-            # sourceが連続しているなら, s:t=1:多なので増やす方.
-            count += 1
-        elif count > 0:
-            # count > 0で, 一致をしなくなったなら, それは連続が終了したとき.
-            duration[b_p_s] += count
-            count = 0
-
-        b_p_t = p_t
-        b_p_s = p_s
-
-    duration[b_p_s] += count if count > 0 else 0
+
+    # alignment開始. fastdtw(近似)ではなく, 厳密なDTWを反対角線ごとにまとめて解く.
+    _, path = dtw(t_src, s_src, metric="cityblock", band=band)
+    duration = path_to_duration(path, s_src.shape[0])
 
     if diagonal_index is not None:
         assert s_src.shape[0] == len(
             diagonal_index), f"s_src.shape: {s_src.shape}, len(diagonal_index): {len(diagonal_index)}"
-        index_list = get_s_e_index_from_bools(diagonal_index)
-        for index_s_t in index_list:
-            duration_part = duration[index_s_t[0]:index_s_t[1]]
-            if np.sum(duration_part) > len(duration_part):
-                # targetの無音区間の方が長いケース.
-                mean_ = np.sum(duration_part) // len(duration_part)
-                rest_ = int(np.sum(duration_part) % (len(duration_part)*mean_))
-                duration_part[:] = mean_
-                duration_part[:rest_] += 1
-            else:
-                # sourceの方が長いケース.
-                s_index = int(np.sum(duration_part))
-                duration_part[:s_index] = 1
-                duration_part[s_index:] = 0
-
-            duration[index_s_t[0]:index_s_t[1]] = duration_part
+        duration = diagonalize(duration, diagonal_index)
 
     assert np.sum(duration) == t_src.shape[0], f"""{target_path}にてdurationの不一致がおきました\n
     duration: {duration}\n
@@ -272,50 +183,35 @@ def calc_duration(ts_src: List[np.ndarray], target_path: str, diagonal_index: np
 
 
 def get_duration(
-    utt_id, src_wav, tgt_wav, sr, n_fft, hop_length, win_length,
+    utt_id, src_magnitude, tgt_magnitude, extractor: SpectralFeatureExtractor,
     fmin, fmax, clip_thresh, log_base, reduction_factor,
-    return_mel=False
+    return_mel=False, dtw_band=None
 ):
-    src_mel, energy = logmelspectrogram(
-        src_wav, sr, n_fft, hop_length, win_length,
-        20, fmin, fmax, clip=clip_thresh, log_base=log_base,
-        need_energy=True
-    )
-    tgt_mel = logmelspectrogram(
-        tgt_wav, sr, n_fft, hop_length, win_length,
-        20, fmin, fmax, clip=clip_thresh, log_base=log_base,
-        need_energy=False
-    )
+    # DTW用の20次元melは, process_utteranceと同じSTFTの振幅から作る.
+    src_mel = extractor.logmel(src_magnitude, 20, fmin, fmax, clip=clip_thresh, log_base=log_base)
+    energy = extractor.energy(src_magnitude)
+    tgt_mel = extractor.logmel(tgt_magnitude, 20, fmin, fmax, clip=clip_thresh, log_base=log_base)
     source_mel = reduction(src_mel, reduction_factor)
     energy = reduction(energy, reduction_factor)
     target_mel = reduction(tgt_mel, reduction_factor)
-    duration = calc_duration([target_mel, source_mel], utt_id, np.log(energy+1e-6) < -5.0)
+    duration = calc_duration([target_mel, source_mel], utt_id, np.log(energy+1e-6) < -5.0, band=dtw_band)
     if return_mel is True:
         return duration, source_mel, target_mel
     return duration
 
 
 def get_sentence_duration(
-    utt_id, src_wav, tgt_wav, sr, n_fft, hop_length, win_length,
-    fmin, fmax, clip_thresh, log_base, reduction_factor,
+    duration, src_mel, tgt_mel, tgt_wav, sr, hop_length, reduction_factor,
     min_silence_len, silence_thresh
 ):
-    duration, src_mel, tgt_mel = get_duration(utt_id, src_wav, tgt_wav, sr, n_fft, hop_length, win_length,
-                                              fmin, fmax, clip_thresh, log_base, reduction_factor, return_mel=True
-                                              )
+    """
+    Args:
+      duration, src_mel, tgt_mel: get_duration(..., return_mel=True)の出力.
+    """
     if tgt_wav.dtype in [np.float32, np.float64]:
         tgt_wav = (tgt_wav * np.iinfo(np.int16).max).astype(np.int16)
 
-    t_audio = AudioSegment(
-        tgt_wav.tobytes(),
-        sample_width=2,
-        frame_rate=sr,
-        channels=1
-    )
-
-    t_silences = np.array(
-        silence.detect_silence(t_audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
-    )
+    t_silences = detect_silence(tgt_wav, sr, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
 
     src_sent_durations = []
     tgt_sent_durations = []
@@ -380,33 +276,38 @@ def preprocess(
     min_silence_len,
     in_dir,
     out_dir,
+    audio_cache=None,
+    dtw_band=None,
 ):
     assert src_wav_file.stem == tgt_wav_file.stem
 
-    src_wav, sr_src = delete_novoice(src_wav_file, silence_thresh_h, silence_thresh_t, chunk_size)
-    tgt_wav, sr_tgt = delete_novoice(tgt_wav_file, silence_thresh_h, silence_thresh_t, chunk_size)
-
-    src_wav = librosa.resample(src_wav, sr_src, sr)
-    tgt_wav = librosa.resample(tgt_wav, sr_tgt, sr)
+    src_wav = delete_novoice(src_wav_file, sr, silence_thresh_h, silence_thresh_t, chunk_size, audio_cache)
+    tgt_wav = delete_novoice(tgt_wav_file, sr, silence_thresh_h, silence_thresh_t, chunk_size, audio_cache)
 
     utt_id = src_wav_file.stem
 
+    # STFTは各波形につき1回だけ行い, mel, energy, DTW用のmelはすべてこの振幅から作る.
+    extractor = SpectralFeatureExtractor(sr, n_fft, hop_length, win_length)
+    src_magnitude = extractor.magnitude(src_wav)
     src_mel, src_pitch, src_energy = process_utterance(
-        src_wav, sr, n_fft, hop_length, win_length,
+        src_wav, src_magnitude, extractor,
         n_mels, fmin, fmax, clip_thresh, log_base,
         is_continuous_pitch
     )
     if src_pitch is None:
-        return src_wav_file, None
+        return src_wav_file, None, None
+    tgt_magnitude = extractor.magnitude(tgt_wav)
     tgt_mel, tgt_pitch, tgt_energy = process_utterance(
-        tgt_wav, sr, n_fft, hop_length, win_length,
+        tgt_wav, tgt_magnitude, extractor,
         n_mels, fmin, fmax, clip_thresh, log_base,
         is_continuous_pitch
     )
     if tgt_pitch is None:
-        return None, tgt_wav_file
-    duration = get_duration(utt_id, src_wav, tgt_wav, sr, n_fft, hop_length, win_length,
-                            fmin, fmax, clip_thresh, log_base, reduction_factor)
+        return None, tgt_wav_file, None
+    duration, src_dtw_mel, tgt_dtw_mel = get_duration(
+        utt_id, src_magnitude, tgt_magnitude, extractor,
+        fmin, fmax, clip_thresh, log_base, reduction_factor, return_mel=True, dtw_band=dtw_band
+    )
 
     np.save(
         in_dir / "mel" / f"{utt_id}-feats.npy",
@@ -444,9 +345,9 @@ def preprocess(
         allow_pickle=False,
     )
     if sentence_duration is True:
+        # DTWはget_durationの結果を使い回す.
         src_sent_durations, tgt_sent_durations = get_sentence_duration(
-            utt_id, src_wav, tgt_wav, sr, n_fft, hop_length, win_length,
-            fmin, fmax, clip_thresh, log_base, reduction_factor,
+            duration, src_dtw_mel, tgt_dtw_mel, tgt_wav, sr, hop_length, reduction_factor,
             min_silence_len, silence_thresh_t
         )
         np.save(
@@ -459,7 +360,12 @@ def preprocess(
             tgt_sent_durations.astype(np.int16),
             allow_pickle=False,
         )
-    return None, None
+    return None, None, UttLength(len(src_mel), len(tgt_mel), utt_id.split("_")[1], utt_id.split("_")[-1])
+
+
+def has_outputs(result) -> bool:
+    """Whether :func:`preprocess` wrote features (silenceで失敗した発話はutt_lengthがNone)."""
+    return result[2] is not None
 
 
 if __name__ == "__main__":
@@ -467,6 +373,8 @@ if __name__ == "__main__":
 
     with open(args.utt_list) as f:
         utt_ids = [utt_id.strip() for utt_id in f]
+    shard = parse_shard(args.shard)
+    utt_ids = select_shard(utt_ids, shard)
 
     src_wav_files = [Path(args.src_wav_root) / f"{utt_id}.wav" for utt_id in utt_ids]
     tgt_wav_files = [Path(args.tgt_wav_root) / f"{utt_id}.wav" for utt_id in utt_ids]
@@ -497,44 +405,97 @@ if __name__ == "__main__":
     out_duration_dir.mkdir(parents=True, exist_ok=True)
     out_sent_duration_dir.mkdir(parents=True, exist_ok=True)
 
+    audio_cache = get_audio_cache(args.audio_cache_dir, args.sample_rate)
+
+    # 入力, パラメータが変わっておらず出力もある発話は飛ばす.
+    manifest = Manifest(
+        shard_path(Path(args.out_dir) / MANIFEST_NAME, shard),
+        params_from_args(
+            args,
+            [
+                "utt_list", "src_wav_root", "tgt_wav_root", "out_dir",
+                "n_jobs", "task_chunk_size", "shard", "audio_cache_dir",
+            ],
+        ),
+    )
+    streams = ["in_fastspeech2VC/mel", "in_fastspeech2VC/pitch", "in_fastspeech2VC/energy",
+               "out_fastspeech2VC/mel", "out_fastspeech2VC/pitch", "out_fastspeech2VC/energy",
+               "out_fastspeech2VC/duration"]
+    if args.sentence_duration > 0:
+        streams += ["in_fastspeech2VC/sent_duration", "out_fastspeech2VC/sent_duration"]
+    inputs = {
+        utt_id: [src_wav_file, tgt_wav_file]
+        for utt_id, src_wav_file, tgt_wav_file in zip(utt_ids, src_wav_files, tgt_wav_files)
+    }
+    todo = [utt_id for utt_id in utt_ids if not manifest.is_up_to_date(utt_id, inputs[utt_id])]
+    print(f"{len(utt_ids) - len(todo)} / {len(utt_ids)} utterances are up to date.")
+
+    # 入力のsha1と出力のmomentsもworkerで求める. silenceで失敗した発話は出力がない.
+    fn = RecordingJob(partial(
+        preprocess,
+        sr=args.sample_rate,
+        silence_thresh_h=args.silence_thresh_h,
+        silence_thresh_t=args.silence_thresh_t,
+        chunk_size=args.chunk_size,
+        n_fft=args.filter_length,
+        hop_length=args.hop_length,
+        win_length=args.win_length,
+        n_mels=args.n_mel_channels,
+        fmin=args.mel_fmin,
+        fmax=args.mel_fmax,
+        clip_thresh=args.clip,
+        log_base=args.log_base,
+        is_continuous_pitch=args.is_continuous_pitch > 0,
+        reduction_factor=args.reduction_factor,
+        sentence_duration=args.sentence_duration > 0,
+        min_silence_len=args.min_silence_len,
+        in_dir=in_dir,
+        out_dir=out_dir,
+        audio_cache=audio_cache,
+        dtw_band=args.dtw_band,
+    ), Path(args.out_dir), moment_keys=streams[:6], has_outputs=has_outputs)
+    tasks = [manifest.task(utt_id, inputs[utt_id]) for utt_id in todo]
+    for utt_id, recorded, error in run_preprocess(
+        fn, tasks, args.n_jobs, args.task_chunk_size, errors_path=shard_path(Path(args.out_dir) / ERRORS_NAME, shard)
+    ):
+        if error is not None:
+            manifest.add(utt_id, inputs[utt_id], {}, error=error)
+            continue
+        src_wav_file, tgt_wav_file, utt_length = recorded.result
+        failed = utt_length is None
+        manifest.add(
+            utt_id,
+            inputs[utt_id],
+            {} if failed else feats_outputs(Path(args.out_dir), utt_id, streams),
+            stats={
+                "failed_src": src_wav_file is not None,
+                "failed_tgt": tgt_wav_file is not None,
+                "length": None if failed else list(utt_length),
+            },
+            failed=failed,
+            recorded=recorded,
+        )
+    manifest.compact(utt_ids)
+
+    if shard is not None:
+        # 長さのindexやstats.jsonは全shardのmanifestが揃ってから, merge_shards.pyで作る.
+        sys.exit(0)
+
+    # 失敗した発話のlistと長さのindexは, 飛ばした発話も含めてmanifestから作る.
+    # 例外で失敗した発話はerrors.jsonlに記録されている.
     failed_src_lst = []
     failed_tgt_lst = []
-
-    with ProcessPoolExecutor(args.n_jobs) as executor:
-        futures = [
-            executor.submit(
-                preprocess,
-                src_wav_file,
-                tgt_wav_file,
-                args.sample_rate,
-                args.silence_thresh_h,
-                args.silence_thresh_t,
-                args.chunk_size,
-                args.filter_length,
-                args.hop_length,
-                args.win_length,
-                args.n_mel_channels,
-                args.mel_fmin,
-                args.mel_fmax,
-                args.clip,
-                args.log_base,
-                args.is_continuous_pitch > 0,
-                args.reduction_factor,
-                args.sentence_duration > 0,
-                args.min_silence_len,
-                in_dir,
-                out_dir,
-            )
-            for src_wav_file, tgt_wav_file in zip(src_wav_files, tgt_wav_files)
-        ]
-        for future in tqdm(futures):
-            src_wav_file, tgt_wav_file = future.result()
-            if src_wav_file is not None:
-                failed_src_lst.append(str(src_wav_file)+'\n')
-            if tgt_wav_file is not None:
-                failed_tgt_lst.append(str(tgt_wav_file)+'\n')
+    for utt_id, src_wav_file, tgt_wav_file in zip(utt_ids, src_wav_files, tgt_wav_files):
+        entry = manifest.entries[utt_id]
+        if entry["stats"].get("failed_src", False):
+            failed_src_lst.append(str(src_wav_file)+'\n')
+        if entry["stats"].get("failed_tgt", False):
+            failed_tgt_lst.append(str(tgt_wav_file)+'\n')
 
     with open(in_dir.parent / "failed_src_lst.txt", 'w') as f:
         f.writelines(failed_src_lst)
     with open(in_dir.parent / "failed_tgt_lst.txt", 'w') as f:
         f.writelines(failed_tgt_lst)
+
+    # 学習時のsamplerなどが特徴量を読まずに長さを得られるように, split毎に長さを記録する.
+    write_length_index(Path(args.out_dir) / LENGTH_INDEX_NAME, length_index_from_entries(manifest.entries))
@@ -1,14 +1,13 @@
 """preprocessにおいて利用するsilence threshとして
 良さそうな閾値を探すためのコード.
 """
-from preprocess import delete_novoice
 from pathlib import Path
 import numpy as np
-import librosa
 import sys
-from scipy.io import wavfile
 
 sys.path.append("../..")
+from recipes.fastspeech2VC.preprocess import delete_novoice
+from vc_tts_template.audio_cache import load_audio
 from vc_tts_template.dsp import logmelspectrogram
 from vc_tts_template.train_utils import plot_mels
 
@@ -19,6 +18,7 @@ src_wav_root = "downloads/jsut_jsss/source"
 tgt_wav_root = "downloads/jsut_jsss/target"
 silence_thresh_h = -50
 silence_thresh_t = -100
+chunk_size = 10
 shuffle = True
 num_plot = 5
 sr = 22050
@@ -41,24 +41,19 @@ else:
 
 
 def read_wav(wav_path, sr):
-    _sr, x = wavfile.read(wav_path)
-    if x.dtype in [np.int16, np.int32]:
-        x = (x / np.iinfo(x.dtype).max).astype(np.float64)
-    wav = librosa.resample(x, _sr, sr)
-    return wav
+    """resampleした元の波形と, preprocess.pyのdelete_novoiceで無音を処理した波形を返す."""
+    wav_org = load_audio(wav_path, sr)
+    wav = delete_novoice(wav_path, sr, silence_thresh_h, silence_thresh_t, chunk_size)
+    print(f"{wav_path.name}: {len(wav_org) / sr:.2f} sec -> {len(wav) / sr:.2f} sec")
+    return wav_org, wav
 
 
 src_mels = []
 tgt_mels = []
 titles = []
 for src_wav_file, tgt_wav_file in zip(source_input_paths, target_input_paths):
-    src_wav, sr_src = delete_novoice(src_wav_file, silence_thresh_h, silence_thresh_t)
-    tgt_wav, sr_tgt = delete_novoice(tgt_wav_file, silence_thresh_h, silence_thresh_t)
-
-    src_wav_org = read_wav(src_wav_file, sr)
-    src_wav = librosa.resample(src_wav, sr_src, sr)
-    tgt_wav_org = read_wav(tgt_wav_file, sr)
-    tgt_wav = librosa.resample(tgt_wav, sr_tgt, sr)
+    src_wav_org, src_wav = read_wav(src_wav_file, sr)
+    tgt_wav_org, tgt_wav = read_wav(tgt_wav_file, sr)
 
     src_mel_org = logmelspectrogram(
         src_wav_org, sr, 1024, 256, 1024,
@@ -11,6 +11,7 @@ from scipy.io import wavfile
 
 sys.path.append("../..")
 from vc_tts_template.fastspeech2VC.gen import synthesis
+from vc_tts_template.normalization import load_scaler
 from vc_tts_template.utils import load_utt_list, optional_tqdm
 
 
@@ -44,6 +45,11 @@ def my_app(config: DictConfig) -> None:
     vocoder_model.remove_weight_norm()
 
     in_dir = Path(to_absolute_path(config.in_dir))
+    # orgの特徴量を読むなら, 学習時と同じscalerで正規化する.
+    in_scalers = None
+    if config.get("scaler_dir", None):
+        scaler_dir = Path(to_absolute_path(config.scaler_dir))
+        in_scalers = [load_scaler(scaler_dir, f"{in_dir.name}_{feat}") for feat in ["mel", "pitch", "energy"]]
     out_dir = Path(to_absolute_path(config.out_dir))
     out_dir.mkdir(parents=True, exist_ok=True)
 
@@ -67,7 +73,7 @@ def my_app(config: DictConfig) -> None:
     ):
         wav = synthesis(
             device, data, acoustic_config.netG.speakers, acoustic_config.netG.emotions,
-            acoustic_model, acoustic_out_scaler, vocoder_model
+            acoustic_model, acoustic_out_scaler, vocoder_model, in_scalers
         )
 
         wav = np.clip(wav, -1.0, 1.0)
@@ -92,7 +98,9 @@ def my_app(config: DictConfig) -> None:
 
         for mel_file in optional_tqdm(config.tqdm, desc="Utterance")(mel_files):
             mel_org = np.load(mel_file)
-            mel_org = acoustic_out_scaler.inverse_transform(mel_org)  # type: ignore
+            if in_scalers is None:
+                # 正規化済みのmel (norm) なので元に戻す.
+                mel_org = acoustic_out_scaler.inverse_transform(mel_org)  # type: ignore
             mel_org = torch.Tensor(mel_org).unsqueeze(0).to(device)
             wav = vocoder_model(mel_org.transpose(1, 2)).squeeze(1).cpu().data.numpy()[0]
             utt_id = Path(mel_file).name.replace("-feats.npy", "")
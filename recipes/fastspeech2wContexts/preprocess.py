@@ -1,22 +1,27 @@
 import argparse
 import json
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import List, Dict
 
-import librosa
 import numpy as np
 import pyworld as pw
 from nnmnkwii.io import hts
-from scipy.io import wavfile
 import tgt
-from scipy.interpolate import interp1d
-from tqdm import tqdm
 
 sys.path.append("../..")
+from recipes.common.preprocess_runner import (
+    ERRORS_NAME, SHARD_HELP, parse_shard, run_preprocess, select_shard, shard_path
+)
+from vc_tts_template.audio_cache import get_audio_cache, load_audio
 from vc_tts_template.dsp import logmelspectrogram
 from vc_tts_template.frontend.openjtalk import text_to_sequence, pp_symbols
+from vc_tts_template.length_index import LENGTH_INDEX_NAME, UttLength, write_length_index
+from vc_tts_template.manifest import (
+    MANIFEST_NAME, Manifest, RecordingJob, feats_outputs, length_index_from_entries, load_manifests, params_from_args,
+    prosody_stats
+)
+from vc_tts_template.prosody import interp_unvoiced, phoneme_average
 
 
 def get_parser():
@@ -29,6 +34,8 @@ def get_parser():
     parser.add_argument("lab_root", type=str, help="lab_root")
     parser.add_argument("out_dir", type=str, help="out directory")
     parser.add_argument("--n_jobs", type=int, default=1, help="Number of jobs")
+    parser.add_argument("--task_chunk_size", type=int, default=1, help="Number of utterances sent to a worker at once")
+    parser.add_argument("--shard", type=str, help=SHARD_HELP)
     parser.add_argument("--sample_rate", type=int)
     parser.add_argument("--filter_length", type=int)
     parser.add_argument("--hop_length", type=int)
@@ -41,6 +48,7 @@ def get_parser():
     parser.add_argument("--pitch_phoneme_averaging", type=int)
     parser.add_argument("--energy_phoneme_averaging", type=int)
     parser.add_argument("--accent_info", type=int)
+    parser.add_argument("--audio_cache_dir", type=str, help="resampled audio cache (fill_audio_cache.py)")
     return parser
 
 
@@ -127,7 +135,7 @@ def get_alignmentwPP(PP, start_times, end_times, sr, hop_length):
 def process_utterance(wav_path, lab_path, sr, n_fft, hop_length, win_length,
                       n_mels, fmin, fmax, clip_thresh, log_base,
                       pitch_phoneme_averaging, energy_phoneme_averaging,
-                      accent_info):
+                      accent_info, audio_cache=None):
     if accent_info is True:
         labels = hts.load(lab_path)
         PP = pp_symbols(labels.contexts, all_accent_info=accent_info)
@@ -143,11 +151,8 @@ def process_utterance(wav_path, lab_path, sr, n_fft, hop_length, win_length,
     if start >= end:
         return None
     # Read and trim wav files
-    # resample
-    _sr, x = wavfile.read(wav_path)
-    if x.dtype in [np.int16, np.int32]:
-        x = (x / np.iinfo(x.dtype).max).astype(np.float64)
-    wav = librosa.resample(x, _sr, sr)
+    # resample済みの波形. cacheにあればresampleしない.
+    wav = load_audio(wav_path, sr, audio_cache)
 
     wav = wav[
         int(sr * start): int(sr * end)
@@ -180,35 +185,13 @@ def process_utterance(wav_path, lab_path, sr, n_fft, hop_length, win_length,
 
     if pitch_phoneme_averaging is True:
         # perform linear interpolation
-        nonzero_ids = np.where(pitch != 0)[0]
-        interp_fn = interp1d(
-            nonzero_ids,
-            pitch[nonzero_ids],
-            fill_value=(pitch[nonzero_ids[0]], pitch[nonzero_ids[-1]]),
-            bounds_error=False,
-        )
-        pitch = interp_fn(np.arange(0, len(pitch)))
-
+        pitch = interp_unvoiced(pitch, voiced=pitch != 0)
         # Phoneme-level average
-        pos = 0
-        for i, d in enumerate(duration):
-            if d > 0:
-                pitch[i] = np.mean(pitch[pos: pos + d])
-            else:
-                pitch[i] = 0
-            pos += d
-        pitch = pitch[: len(duration)]
+        pitch = phoneme_average(pitch, duration)
 
     if energy_phoneme_averaging is True:
         # Phoneme-level average
-        pos = 0
-        for i, d in enumerate(duration):
-            if d > 0:
-                energy[i] = np.mean(energy[pos: pos + d])
-            else:
-                energy[i] = 0
-            pos += d
-        energy = energy[: len(duration)]
+        energy = phoneme_average(energy, duration)
 
     return (
         text,
@@ -236,6 +219,7 @@ def preprocess(
     accent_info,
     in_dir,
     out_dir,
+    audio_cache=None,
 ):
     assert wav_file.stem == lab_file.stem
 
@@ -254,6 +238,7 @@ def preprocess(
         pitch_phoneme_averaging,
         energy_phoneme_averaging,
         accent_info,
+        audio_cache,
     )
     text = np.array(text_to_sequence(text), dtype=np.int64)
 
@@ -285,7 +270,8 @@ def preprocess(
         np.min(pitch),
         np.max(pitch),
         np.min(energy),
-        np.max(energy)
+        np.max(energy),
+        UttLength(len(text), len(mel_spectrogram), utt_id.split("_")[0], utt_id.split("_")[-1]),
     )
 
 
@@ -294,6 +280,8 @@ if __name__ == "__main__":
 
     with open(args.utt_list) as f:
         utt_ids = [utt_id.strip() for utt_id in f]
+    shard = parse_shard(args.shard)
+    utt_ids = select_shard(utt_ids, shard)
 
     wav_files = [Path(args.wav_root) / f"{utt_id}.wav" for utt_id in utt_ids]
     postfix = ".lab" if args.accent_info > 0 else ".TextGrid"
@@ -312,48 +300,76 @@ if __name__ == "__main__":
     out_energy_dir.mkdir(parents=True, exist_ok=True)
     out_duration_dir.mkdir(parents=True, exist_ok=True)
 
-    stats_tmp: Dict[str, List[float]] = {"pitch_min": [], "pitch_max": [], "energy_min": [], "energy_max": []}
-
-    with ProcessPoolExecutor(args.n_jobs) as executor:
-        futures = [
-            executor.submit(
-                preprocess,
-                wav_file,
-                lab_file,
-                args.sample_rate,
-                args.filter_length,
-                args.hop_length,
-                args.win_length,
-                args.n_mel_channels,
-                args.mel_fmin,
-                args.mel_fmax,
-                args.clip,
-                args.log_base,
-                args.pitch_phoneme_averaging > 0,
-                args.energy_phoneme_averaging > 0,
-                args.accent_info > 0,
-                in_dir,
-                out_dir,
-            )
-            for wav_file, lab_file in zip(wav_files, lab_files)
-        ]
-        for future in tqdm(futures):
-            p_m, p_M, e_m, e_M = future.result()
-            stats_tmp["pitch_min"].append(p_m)
-            stats_tmp["pitch_max"].append(p_M)
-            stats_tmp["energy_min"].append(e_m)
-            stats_tmp["energy_max"].append(e_M)
+    audio_cache = get_audio_cache(args.audio_cache_dir, args.sample_rate)
+
+    # 入力, パラメータが変わっておらず出力もある発話は飛ばす.
+    manifest = Manifest(
+        shard_path(Path(args.out_dir) / MANIFEST_NAME, shard),
+        params_from_args(
+            args,
+            [
+                "utt_list", "wav_root", "lab_root", "out_dir",
+                "n_jobs", "task_chunk_size", "shard", "audio_cache_dir",
+            ],
+        ),
+    )
+    streams = ["in_fastspeech2", "out_fastspeech2/mel", "out_fastspeech2/pitch",
+               "out_fastspeech2/energy", "out_fastspeech2/duration"]
+    inputs = {utt_id: [wav_file, lab_file] for utt_id, wav_file, lab_file in zip(utt_ids, wav_files, lab_files)}
+    todo = [utt_id for utt_id in utt_ids if not manifest.is_up_to_date(utt_id, inputs[utt_id])]
+    print(f"{len(utt_ids) - len(todo)} / {len(utt_ids)} utterances are up to date.")
+
+    # 入力のsha1と出力のmomentsもworkerで求める.
+    fn = RecordingJob(partial(
+        preprocess,
+        sr=args.sample_rate,
+        n_fft=args.filter_length,
+        hop_length=args.hop_length,
+        win_length=args.win_length,
+        n_mels=args.n_mel_channels,
+        fmin=args.mel_fmin,
+        fmax=args.mel_fmax,
+        clip_thresh=args.clip,
+        log_base=args.log_base,
+        pitch_phoneme_averaging=args.pitch_phoneme_averaging > 0,
+        energy_phoneme_averaging=args.energy_phoneme_averaging > 0,
+        accent_info=args.accent_info > 0,
+        in_dir=in_dir,
+        out_dir=out_dir,
+        audio_cache=audio_cache,
+    ), Path(args.out_dir), moment_keys=streams[1:4])
+    tasks = [manifest.task(utt_id, inputs[utt_id]) for utt_id in todo]
+    for utt_id, recorded, error in run_preprocess(
+        fn, tasks, args.n_jobs, args.task_chunk_size, errors_path=shard_path(Path(args.out_dir) / ERRORS_NAME, shard)
+    ):
+        if error is not None:
+            manifest.add(utt_id, inputs[utt_id], {}, error=error)
+            continue
+        p_m, p_M, e_m, e_M, utt_length = recorded.result
+        manifest.add(
+            utt_id,
+            inputs[utt_id],
+            feats_outputs(Path(args.out_dir), utt_id, streams),
+            stats={
+                "pitch_min": float(p_m), "pitch_max": float(p_M),
+                "energy_min": float(e_m), "energy_max": float(e_M),
+                "length": list(utt_length),
+            },
+            recorded=recorded,
+        )
+    manifest.compact(utt_ids)
 
-    stats_path = Path(args.out_dir).parent / "stats.json"
-    stats = {"pitch_min": 1e+9, "pitch_max": -1e+9, "energy_min": 1e+9, "energy_max": -1e-9}
+    if shard is not None:
+        # 長さのindexやstats.jsonは全shardのmanifestが揃ってから, merge_shards.pyで作る.
+        sys.exit(0)
 
-    if stats_path.exists():
-        with open(stats_path) as f:
-            stats = json.load(f)
-    stats["pitch_min"] = float(min(stats["pitch_min"], np.min(stats_tmp["pitch_min"])))
-    stats["pitch_max"] = float(max(stats["pitch_max"], np.max(stats_tmp["pitch_max"])))
-    stats["energy_min"] = float(min(stats["energy_min"], np.min(stats_tmp["energy_min"])))
-    stats["energy_max"] = float(max(stats["energy_max"], np.max(stats_tmp["energy_max"])))
+    # 学習時のsamplerなどが特徴量を読まずに長さを得られるように, split毎に長さを記録する.
+    write_length_index(Path(args.out_dir) / LENGTH_INDEX_NAME, length_index_from_entries(manifest.entries))
 
+    # 全splitのmanifestから計算し直すので, 実行の順番や回数によらない.
+    entries = load_manifests(Path(args.out_dir).parent.glob(f"*/{MANIFEST_NAME}"))
+    stats = prosody_stats(entries)
+
+    stats_path = Path(args.out_dir).parent / "stats.json"
     with open(stats_path, "w") as f:
         f.write(json.dumps(stats))
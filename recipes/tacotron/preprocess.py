@@ -1,16 +1,20 @@
 import argparse
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
-import librosa
 import numpy as np
 from nnmnkwii.io import hts
 from nnmnkwii.preprocessing import mulaw_quantize
-from scipy.io import wavfile
-from tqdm import tqdm
+
+sys.path.append("../..")
+from recipes.common.preprocess_runner import (
+    ERRORS_NAME, SHARD_HELP, parse_shard, run_preprocess, select_shard, shard_path
+)
+from vc_tts_template.audio_cache import get_audio_cache, load_audio
 from vc_tts_template.dsp import logmelspectrogram
 from vc_tts_template.frontend.openjtalk import pp_symbols, text_to_sequence
+from vc_tts_template.manifest import MANIFEST_NAME, Manifest, RecordingJob, feats_outputs, params_from_args
 from vc_tts_template.utils import pad_1d
 
 
@@ -24,8 +28,11 @@ def get_parser():
     parser.add_argument("lab_root", type=str, help="lab_root")
     parser.add_argument("out_dir", type=str, help="out directory")
     parser.add_argument("--n_jobs", type=int, default=1, help="Number of jobs")
+    parser.add_argument("--task_chunk_size", type=int, default=1, help="Number of utterances sent to a worker at once")
+    parser.add_argument("--shard", type=str, help=SHARD_HELP)
     parser.add_argument("--sample_rate", type=int, default=16000, help="Sample rate")
     parser.add_argument("--mu", type=int, default=256, help="mu")
+    parser.add_argument("--audio_cache_dir", type=str, help="resampled audio cache (fill_audio_cache.py)")
     return parser
 
 
@@ -37,6 +44,7 @@ def preprocess(
     in_dir,
     out_dir,
     wave_dir,
+    audio_cache=None,
 ):
     assert wav_file.stem == lab_file.stem
     labels = hts.load(lab_file)
@@ -45,10 +53,8 @@ def preprocess(
     in_feats = np.array(text_to_sequence(PP), dtype=np.int64)
 
     # メルスペクトログラムの計算
-    _sr, x = wavfile.read(wav_file)
-    if x.dtype in [np.int16, np.int32]:
-        x = (x / np.iinfo(x.dtype).max).astype(np.float64)
-    x = librosa.resample(x, _sr, sr)
+    # resample済みの波形. cacheにあればresampleしない.
+    x = load_audio(wav_file, sr, audio_cache).astype(np.float64)
     out_feats = logmelspectrogram(x, sr)
 
     # 冒頭と末尾の非音声区間の長さを調整
@@ -93,6 +99,8 @@ if __name__ == "__main__":
 
     with open(args.utt_list) as f:
         utt_ids = [utt_id.strip() for utt_id in f]
+    shard = parse_shard(args.shard)
+    utt_ids = select_shard(utt_ids, shard)
     wav_files = [Path(args.wav_root) / f"{utt_id}.wav" for utt_id in utt_ids]
     lab_files = [Path(args.lab_root) / f"{utt_id}.lab" for utt_id in utt_ids]
 
@@ -103,19 +111,40 @@ if __name__ == "__main__":
     out_dir.mkdir(parents=True, exist_ok=True)
     wave_dir.mkdir(parents=True, exist_ok=True)
 
-    with ProcessPoolExecutor(args.n_jobs) as executor:
-        futures = [
-            executor.submit(
-                preprocess,
-                wav_file,
-                lab_file,
-                args.sample_rate,
-                args.mu,
-                in_dir,
-                out_dir,
-                wave_dir,
-            )
-            for wav_file, lab_file in zip(wav_files, lab_files)
-        ]
-        for future in tqdm(futures):
-            future.result()
+    audio_cache = get_audio_cache(args.audio_cache_dir, args.sample_rate)
+
+    # 入力, パラメータが変わっておらず出力もある発話は飛ばす.
+    manifest = Manifest(
+        shard_path(Path(args.out_dir) / MANIFEST_NAME, shard),
+        params_from_args(
+            args,
+            [
+                "utt_list", "wav_root", "lab_root", "out_dir",
+                "n_jobs", "task_chunk_size", "shard", "audio_cache_dir",
+            ],
+        ),
+    )
+    streams = ["in_tacotron", "out_tacotron", "out_wavenet"]
+    inputs = {utt_id: [wav_file, lab_file] for utt_id, wav_file, lab_file in zip(utt_ids, wav_files, lab_files)}
+    todo = [utt_id for utt_id in utt_ids if not manifest.is_up_to_date(utt_id, inputs[utt_id])]
+    print(f"{len(utt_ids) - len(todo)} / {len(utt_ids)} utterances are up to date.")
+
+    # 入力のsha1と出力のmomentsもworkerで求める.
+    fn = RecordingJob(partial(
+        preprocess, sr=args.sample_rate, mu=args.mu, in_dir=in_dir, out_dir=out_dir, wave_dir=wave_dir,
+        audio_cache=audio_cache,
+    ), Path(args.out_dir), moment_keys=["out_tacotron"])
+    tasks = [manifest.task(utt_id, inputs[utt_id]) for utt_id in todo]
+    for utt_id, recorded, error in run_preprocess(
+        fn, tasks, args.n_jobs, args.task_chunk_size, errors_path=shard_path(Path(args.out_dir) / ERRORS_NAME, shard)
+    ):
+        if error is not None:
+            manifest.add(utt_id, inputs[utt_id], {}, error=error)
+            continue
+        manifest.add(
+            utt_id,
+            inputs[utt_id],
+            feats_outputs(Path(args.out_dir), utt_id, streams),
+            recorded=recorded,
+        )
+    manifest.compact(utt_ids)
@@ -24,12 +24,17 @@ testsets=($eval_set)
 
 stage=0
 stop_stage=0
+# 前処理を複数の計算機に分けるときは, 各計算機で stage 1 を --shard i/N として実行し,
+# 全shardが終わってから stage 1 を --merge_shards 1 として実行してまとめる.
+shard=""
+merge_shards=0
 
 . $COMMON_ROOT/parse_options.sh || exit 1;
 
 dumpdir=dump
 dump_org_dir=$dumpdir/${spk}_sr${sample_rate}/org
-dump_norm_dir=$dumpdir/${spk}_sr${sample_rate}/norm
+# resample済みの波形のcache. wavの中身のhashがkeyなので, recipe間で共有できる.
+audio_cache_dir=../audio_cache
 
 # exp name
 if [ -z ${tag:=} ]; then
@@ -71,11 +76,18 @@ fi
 
 if [ ${stage} -le 1 ] && [ ${stop_stage} -ge 1 ]; then
     echo "stage 1: Feature generation for Tacotron"
-    for s in ${datasets[@]}; do
-        xrun python preprocess.py data/$s.list $wav_root $lab_root \
-            $dump_org_dir/$s --n_jobs $n_jobs \
-            --sample_rate $sample_rate --mu $mu
-    done
+    if [ ${merge_shards} -ge 1 ]; then
+        xrun python $COMMON_ROOT/merge_shards.py ${datasets[@]/#/$dump_org_dir/}
+    else
+        for s in ${datasets[@]}; do
+            xrun python $COMMON_ROOT/fill_audio_cache.py data/$s.list $audio_cache_dir $wav_root \
+                --sample_rate $sample_rate --n_jobs $n_jobs ${shard:+--shard $shard}
+            xrun python preprocess.py data/$s.list $wav_root $lab_root \
+                $dump_org_dir/$s --n_jobs $n_jobs \
+                --sample_rate $sample_rate --mu $mu \
+                --audio_cache_dir $audio_cache_dir ${shard:+--shard $shard}
+        done
+    fi
 fi
 
 if [ ${stage} -le 2 ] && [ ${stop_stage} -ge 2 ]; then
@@ -84,38 +96,23 @@ if [ ${stage} -le 2 ] && [ ${stop_stage} -ge 2 ]; then
        for inout in "out"; do
             xrun python $COMMON_ROOT/fit_scaler.py data/train.list \
                 $dump_org_dir/$train_set/${inout}_${typ} \
-                $dump_org_dir/${inout}_${typ}_scaler.joblib
+                $dump_org_dir/${inout}_${typ}_scaler.joblib --n_jobs $n_jobs --manifest
         done
     done
 
-    mkdir -p $dump_norm_dir
-    cp -v $dump_org_dir/*.joblib $dump_norm_dir/
-
-    for s in ${datasets[@]}; do
-        for typ in "tacotron"; do
-            for inout in "out" "in"; do
-                if [ $inout == "in" ]; then
-                    cp -r $dump_org_dir/$s/${inout}_${typ} $dump_norm_dir/$s/
-                    continue
-                fi
-                xrun python $COMMON_ROOT/preprocess_normalize.py data/$s.list \
-                    $dump_org_dir/${inout}_${typ}_scaler.joblib \
-                    $dump_org_dir/$s/${inout}_${typ}/ \
-                    $dump_norm_dir/$s/${inout}_${typ}/ --n_jobs $n_jobs
-            done
-        done
-    done
+    # 正規化は学習時にcollateでscalerを使って行うので, 正規化した特徴量のdump(norm)は作らない.
 fi
 
 if [ ${stage} -le 3 ] && [ ${stop_stage} -ge 3 ]; then
     echo "stage 3: Training Tacotron"
     xrun python train_tacotron.py model=$acoustic_model tqdm=$tqdm \
+        data.scaler_dir=$dump_org_dir \
         data.train.utt_list=data/train.list \
-        data.train.in_dir=$dump_norm_dir/$train_set/in_tacotron/ \
-        data.train.out_dir=$dump_norm_dir/$train_set/out_tacotron/ \
+        data.train.in_dir=$dump_org_dir/$train_set/in_tacotron/ \
+        data.train.out_dir=$dump_org_dir/$train_set/out_tacotron/ \
         data.dev.utt_list=data/dev.list \
-        data.dev.in_dir=$dump_norm_dir/$dev_set/in_tacotron/ \
-        data.dev.out_dir=$dump_norm_dir/$dev_set/out_tacotron/ \
+        data.dev.in_dir=$dump_org_dir/$dev_set/in_tacotron/ \
+        data.dev.out_dir=$dump_org_dir/$dev_set/out_tacotron/ \
         train.out_dir=$expdir/${acoustic_model} \
         train.log_dir=tensorboard/${expname}_${acoustic_model} \
         train.max_train_steps=$tacotron_train_max_train_steps \
@@ -126,11 +123,12 @@ fi
 if [ ${stage} -le 4 ] && [ ${stop_stage} -ge 4 ]; then
     echo "stage 4: Training WaveNet vocoder"
     xrun python train_wavenet.py model=$wavenet_model tqdm=$tqdm \
+        data.scaler_dir=$dump_org_dir \
         data.train.utt_list=data/train.list \
-        data.train.in_dir=$dump_norm_dir/$train_set/out_tacotron/ \
+        data.train.in_dir=$dump_org_dir/$train_set/out_tacotron/ \
         data.train.out_dir=$dump_org_dir/$train_set/out_wavenet/ \
         data.dev.utt_list=data/dev.list \
-        data.dev.in_dir=$dump_norm_dir/$dev_set/out_tacotron/ \
+        data.dev.in_dir=$dump_org_dir/$dev_set/out_tacotron/ \
         data.dev.out_dir=$dump_org_dir/$dev_set/out_wavenet/ \
         train.out_dir=$expdir/${wavenet_model} \
         train.log_dir=tensorboard/${expname}_${wavenet_model} \
@@ -147,7 +145,7 @@ if [ ${stage} -le 5 ] && [ ${stop_stage} -ge 5 ]; then
             out_dir=$expdir/synthesis_${acoustic_model}_griffin_lim/$s \
             sample_rate=$sample_rate \
             acoustic.checkpoint=$expdir/${acoustic_model}/$acoustic_eval_checkpoint \
-            acoustic.out_scaler_path=$dump_norm_dir/out_tacotron_scaler.joblib \
+            acoustic.out_scaler_path=$dump_org_dir/out_tacotron_scaler.joblib \
             acoustic.model_yaml=$expdir/${acoustic_model}/model.yaml \
             reverse=$reverse num_eval_utts=$num_eval_utts
     done
@@ -161,7 +159,7 @@ if [ ${stage} -le 6 ] && [ ${stop_stage} -ge 6 ]; then
             out_dir=$expdir/synthesis_${acoustic_model}_${wavenet_model}/$s \
             sample_rate=$sample_rate \
             acoustic.checkpoint=$expdir/${acoustic_model}/$acoustic_eval_checkpoint \
-            acoustic.out_scaler_path=$dump_norm_dir/out_tacotron_scaler.joblib \
+            acoustic.out_scaler_path=$dump_org_dir/out_tacotron_scaler.joblib \
             acoustic.model_yaml=$expdir/${acoustic_model}/model.yaml \
             wavenet.checkpoint=$expdir/${wavenet_model}/$wavenet_eval_checkpoint \
             wavenet.model_yaml=$expdir/${wavenet_model}/model.yaml \
@@ -200,7 +198,7 @@ wavenet_model: ${wavenet_model}
 EOL
 
     # Stats
-    python $COMMON_ROOT/scaler_joblib2npy.py $dump_norm_dir/out_tacotron_scaler.joblib $dst_dir
+    python $COMMON_ROOT/scaler_joblib2npy.py $dump_org_dir/out_tacotron_scaler.joblib $dst_dir
 
     # Acoustic model
     python $COMMON_ROOT/clean_checkpoint_state.py $expdir/${acoustic_model}/$acoustic_eval_checkpoint \
@@ -0,0 +1,62 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+sys.path.append("../..")
+from vc_tts_template.wavenet import WaveNet
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark autoregressive inference of WaveNet",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--model_config", type=str, default="conf/train_wavenet/model/wavenet_sr16k_mulaw256.yaml",
+        help="model config (netG)"
+    )
+    parser.add_argument("--checkpoint", type=str, default=None, help="checkpoint. random weights if not given")
+    parser.add_argument("--n_frames", type=int, default=50, help="number of conditioning frames to generate")
+    parser.add_argument("--n_runs", type=int, default=3, help="number of runs")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seed", type=int, default=773)
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args(sys.argv[1:])
+    device = torch.device(args.device)
+
+    # _target_はttslearnのものなので, パラメータだけ使ってこのrepoのWaveNetを作る.
+    params = OmegaConf.to_container(OmegaConf.load(args.model_config).netG)
+    params.pop("_target_", None)  # type: ignore
+    model = WaveNet(**params).to(device)  # type: ignore
+    if args.checkpoint is not None:
+        checkpoint = torch.load(args.checkpoint, map_location=device)
+        model.load_state_dict(checkpoint["state_dict"])
+    model.eval()
+    model.remove_weight_norm_()
+
+    # 条件付け特徴量はaux_context_window分だけ前後に余分に必要.
+    torch.manual_seed(args.seed)
+    c = torch.randn(1, model.cin_channels, args.n_frames + 2 * model.aux_context_window, device=device)
+    num_time_steps = args.n_frames * int(np.prod(model.upsample_scales))
+
+    elapsed = []
+    for _ in range(args.n_runs):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.no_grad():
+            model.inference(c, num_time_steps, tqdm=lambda x: x)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed.append(time.perf_counter() - start)
+
+    best = min(elapsed)
+    print(f"{num_time_steps} samples: best {best:.3f} sec ({num_time_steps / best:.1f} samples/sec)")
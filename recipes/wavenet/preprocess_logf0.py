@@ -1,14 +1,17 @@
 import argparse
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
-import librosa
 import numpy as np
 from nnmnkwii.frontend import merlin as fe
 from nnmnkwii.io import hts
-from scipy.io import wavfile
-from tqdm import tqdm
+
+sys.path.append("../..")
+from recipes.common.preprocess_runner import (
+    ERRORS_NAME, SHARD_HELP, parse_shard, run_preprocess, select_shard, shard_path
+)
+from vc_tts_template.audio_cache import get_audio_cache, load_audio
 from vc_tts_template.dsp import world_log_f0_vuv
 
 
@@ -23,11 +26,14 @@ def get_parser():
     parser.add_argument("qst_file", type=str, help="HTS style question file")
     parser.add_argument("out_dir", type=str, help="out directory")
     parser.add_argument("--n_jobs", type=int, default=1, help="Number of jobs")
+    parser.add_argument("--task_chunk_size", type=int, default=1, help="Number of utterances sent to a worker at once")
+    parser.add_argument("--shard", type=str, help=SHARD_HELP)
     parser.add_argument("--sample_rate", type=int, default=16000, help="Sample rate")
+    parser.add_argument("--audio_cache_dir", type=str, help="resampled audio cache (fill_audio_cache.py)")
     return parser
 
 
-def preprocess(wav_file, lab_file, binary_dict, numeric_dict, sr, in_dir, out_dir):
+def preprocess(wav_file, lab_file, binary_dict, numeric_dict, sr, in_dir, out_dir, audio_cache=None):
     assert wav_file.stem == lab_file.stem
     # フルコンテキストラベルの読み込み
     labels = hts.load(lab_file)
@@ -42,10 +48,8 @@ def preprocess(wav_file, lab_file, binary_dict, numeric_dict, sr, in_dir, out_di
     )
 
     # 音声ファイルの読み込み
-    _sr, x = wavfile.read(wav_file)
-    if x.dtype in [np.int16, np.int32]:
-        x = (x / np.iinfo(x.dtype).max).astype(np.float64)
-    x = librosa.resample(x, _sr, sr)
+    # resample済みの波形. cacheにあればresampleしない.
+    x = load_audio(wav_file, sr, audio_cache).astype(np.float64)
 
     # 連続対数基本周波数と有声 / 無声フラグを結合した特徴量の計算
     out_feats = world_log_f0_vuv(x.astype(np.float64), sr)
@@ -83,6 +87,8 @@ if __name__ == "__main__":
 
     with open(args.utt_list) as f:
         utt_ids = [utt_id.strip() for utt_id in f]
+    shard = parse_shard(args.shard)
+    utt_ids = select_shard(utt_ids, shard)
     wav_files = [Path(args.wav_root) / f"{utt_id}.wav" for utt_id in utt_ids]
     lab_files = [Path(args.lab_root) / f"{utt_id}.lab" for utt_id in utt_ids]
     binary_dict, numeric_dict = hts.load_question_set(args.qst_file)
@@ -92,19 +98,16 @@ if __name__ == "__main__":
     in_dir.mkdir(parents=True, exist_ok=True)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    with ProcessPoolExecutor(args.n_jobs) as executor:
-        futures = [
-            executor.submit(
-                preprocess,
-                wav_file,
-                lab_file,
-                binary_dict,
-                numeric_dict,
-                args.sample_rate,
-                in_dir,
-                out_dir,
-            )
-            for wav_file, lab_file in zip(wav_files, lab_files)
-        ]
-        for future in tqdm(futures):
-            future.result()
+    audio_cache = get_audio_cache(args.audio_cache_dir, args.sample_rate)
+
+    fn = partial(
+        preprocess,
+        binary_dict=binary_dict, numeric_dict=numeric_dict, sr=args.sample_rate, in_dir=in_dir, out_dir=out_dir,
+        audio_cache=audio_cache,
+    )
+    tasks = [(utt_id, (wav_file, lab_file)) for utt_id, wav_file, lab_file in zip(utt_ids, wav_files, lab_files)]
+    # 失敗した発話は{out_dir}/errors.jsonlに記録して, 残りの発話は続ける.
+    for _ in run_preprocess(
+        fn, tasks, args.n_jobs, args.task_chunk_size, errors_path=shard_path(Path(args.out_dir) / ERRORS_NAME, shard)
+    ):
+        pass
@@ -29,7 +29,8 @@ stop_stage=0
 
 dumpdir=dump
 dump_org_dir=$dumpdir/${spk}_sr${sample_rate}/org
-dump_norm_dir=$dumpdir/${spk}_sr${sample_rate}/norm
+# resample済みの波形のcache. wavの中身のhashがkeyなので, recipe間で共有できる.
+audio_cache_dir=../audio_cache
 
 # exp name
 if [ -z ${tag:=} ]; then
@@ -78,9 +79,12 @@ fi
 if [ ${stage} -le 2 ] && [ ${stop_stage} -ge 2 ]; then
     echo "stage 2: Feature generation for log-F0 prediction model"
     for s in ${datasets[@]}; do
+        xrun python $COMMON_ROOT/fill_audio_cache.py data/$s.list $audio_cache_dir $db_root/wav/ \
+            --sample_rate $sample_rate --n_jobs $n_jobs
         xrun python preprocess_logf0.py data/$s.list $db_root/wav/ $db_root/lab/ \
             $qst_path $dump_org_dir/$s --n_jobs $n_jobs \
-            --sample_rate $sample_rate
+            --sample_rate $sample_rate \
+            --audio_cache_dir $audio_cache_dir
     done
 fi
 
@@ -89,51 +93,38 @@ if [ ${stage} -le 3 ] && [ ${stop_stage} -ge 3 ]; then
     for s in ${datasets[@]}; do
         xrun python preprocess_wavenet.py data/$s.list $db_root/wav/ $db_root/lab/ \
             $qst_path $dump_org_dir/$s --n_jobs $n_jobs \
-            --sample_rate $sample_rate --mu $mu
+            --sample_rate $sample_rate --mu $mu \
+            --audio_cache_dir $audio_cache_dir
     done
 fi
 
 if [ ${stage} -le 4 ] && [ ${stop_stage} -ge 4 ]; then
     echo "stage 4: feature normalization"
+    streams=""
     for typ in "duration" "logf0" "wavenet"; do
        for inout in "in" "out"; do
             if [ $typ == "wavenet" ] && [ $inout == "out" ]; then
                 # 波形は正規化しないため、スキップ
                 continue
             fi
-            xrun python $COMMON_ROOT/fit_scaler.py data/train.list \
-                $dump_org_dir/$train_set/${inout}_${typ} \
-                $dump_org_dir/${inout}_${typ}_scaler.joblib
+            streams="$streams --stream $dump_org_dir/$train_set/${inout}_${typ} $dump_org_dir/${inout}_${typ}_scaler.joblib"
         done
     done
+    xrun python $COMMON_ROOT/fit_scaler.py data/train.list $streams --n_jobs $n_jobs
 
-    mkdir -p $dump_norm_dir
-    cp -v $dump_org_dir/*.joblib $dump_norm_dir/
-
-    for s in ${datasets[@]}; do
-        for typ in "duration" "logf0" "wavenet"; do
-            for inout in "in" "out"; do
-                if [ $typ == "wavenet" ] && [ $inout == "out" ]; then
-                    continue
-                fi
-                xrun python $COMMON_ROOT/preprocess_normalize.py data/$s.list \
-                    $dump_org_dir/${inout}_${typ}_scaler.joblib \
-                    $dump_org_dir/$s/${inout}_${typ}/ \
-                    $dump_norm_dir/$s/${inout}_${typ}/ --n_jobs $n_jobs
-            done
-        done
-    done
+    # 正規化は学習時にcollateでscalerを使って行うので, 正規化した特徴量のdump(norm)は作らない.
 fi
 
 if [ ${stage} -le 5 ] && [ ${stop_stage} -ge 5 ]; then
     echo "stage 5: Training duration model"
     xrun python train_dnntts.py model=$duration_model tqdm=$tqdm \
+        data.scaler_dir=$dump_org_dir \
         data.train.utt_list=data/train.list \
-        data.train.in_dir=$dump_norm_dir/$train_set/in_duration/ \
-        data.train.out_dir=$dump_norm_dir/$train_set/out_duration/ \
+        data.train.in_dir=$dump_org_dir/$train_set/in_duration/ \
+        data.train.out_dir=$dump_org_dir/$train_set/out_duration/ \
         data.dev.utt_list=data/dev.list \
-        data.dev.in_dir=$dump_norm_dir/$dev_set/in_duration/ \
-        data.dev.out_dir=$dump_norm_dir/$dev_set/out_duration/ \
+        data.dev.in_dir=$dump_org_dir/$dev_set/in_duration/ \
+        data.dev.out_dir=$dump_org_dir/$dev_set/out_duration/ \
         train.out_dir=$expdir/${duration_model} \
         train.log_dir=tensorboard/${expname}_${duration_model} \
         train.nepochs=$dnntts_train_nepochs \
@@ -144,12 +135,13 @@ fi
 if [ ${stage} -le 6 ] && [ ${stop_stage} -ge 6 ]; then
     echo "stage 6: Training log-f0 prediction model"
     xrun python train_dnntts.py model=$logf0_model tqdm=$tqdm \
+        data.scaler_dir=$dump_org_dir \
         data.train.utt_list=data/train.list \
-        data.train.in_dir=$dump_norm_dir/$train_set/in_logf0/ \
-        data.train.out_dir=$dump_norm_dir/$train_set/out_logf0/ \
+        data.train.in_dir=$dump_org_dir/$train_set/in_logf0/ \
+        data.train.out_dir=$dump_org_dir/$train_set/out_logf0/ \
         data.dev.utt_list=data/dev.list \
-        data.dev.in_dir=$dump_norm_dir/$dev_set/in_logf0/ \
-        data.dev.out_dir=$dump_norm_dir/$dev_set/out_logf0/ \
+        data.dev.in_dir=$dump_org_dir/$dev_set/in_logf0/ \
+        data.dev.out_dir=$dump_org_dir/$dev_set/out_logf0/ \
         train.out_dir=$expdir/${logf0_model} \
         train.log_dir=tensorboard/${expname}_${logf0_model} \
         train.nepochs=$dnntts_train_nepochs \
@@ -160,11 +152,12 @@ fi
 if [ ${stage} -le 7 ] && [ ${stop_stage} -ge 7 ]; then
     echo "stage 7: Training WaveNet"
     xrun python train_wavenet.py model=${wavenet_model} tqdm=$tqdm \
+        data.scaler_dir=$dump_org_dir \
         data.train.utt_list=data/train.list \
-        data.train.in_dir=$dump_norm_dir/$train_set/in_wavenet/ \
+        data.train.in_dir=$dump_org_dir/$train_set/in_wavenet/ \
         data.train.out_dir=$dump_org_dir/$train_set/out_wavenet/ \
         data.dev.utt_list=data/dev.list \
-        data.dev.in_dir=$dump_norm_dir/$dev_set/in_wavenet/ \
+        data.dev.in_dir=$dump_org_dir/$dev_set/in_wavenet/ \
         data.dev.out_dir=$dump_org_dir/$dev_set/out_wavenet/ \
         train.out_dir=$expdir/${wavenet_model} \
         train.log_dir=tensorboard/${expname}_${wavenet_model} \
@@ -181,15 +174,15 @@ if [ ${stage} -le 8 ] && [ ${stop_stage} -ge 8 ]; then
             out_dir=$expdir/synthesis_${duration_model}_${logf0_model}_${wavenet_model}/$s \
             sample_rate=$sample_rate qst_path=$qst_path \
             duration.checkpoint=$expdir/${duration_model}/$duration_eval_checkpoint \
-            duration.in_scaler_path=$dump_norm_dir/in_duration_scaler.joblib \
-            duration.out_scaler_path=$dump_norm_dir/out_duration_scaler.joblib \
+            duration.in_scaler_path=$dump_org_dir/in_duration_scaler.joblib \
+            duration.out_scaler_path=$dump_org_dir/out_duration_scaler.joblib \
             duration.model_yaml=$expdir/${duration_model}/model.yaml \
             logf0.checkpoint=$expdir/${logf0_model}/$logf0_eval_checkpoint \
-            logf0.in_scaler_path=$dump_norm_dir/in_logf0_scaler.joblib \
-            logf0.out_scaler_path=$dump_norm_dir/out_logf0_scaler.joblib \
+            logf0.in_scaler_path=$dump_org_dir/in_logf0_scaler.joblib \
+            logf0.out_scaler_path=$dump_org_dir/out_logf0_scaler.joblib \
             logf0.model_yaml=$expdir/${logf0_model}/model.yaml \
             wavenet.checkpoint=$expdir/${wavenet_model}/$wavenet_eval_checkpoint \
-            wavenet.in_scaler_path=$dump_norm_dir/in_wavenet_scaler.joblib \
+            wavenet.in_scaler_path=$dump_org_dir/in_wavenet_scaler.joblib \
             wavenet.model_yaml=$expdir/${wavenet_model}/model.yaml \
             reverse=$reverse num_eval_utts=$num_eval_utts
     done
@@ -234,7 +227,7 @@ EOL
             if [ $typ == "wavenet" ] && [ $inout == "out" ]; then
                 continue
             fi
-            python $COMMON_ROOT/scaler_joblib2npy.py $dump_norm_dir/${inout}_${typ}_scaler.joblib $dst_dir
+            python $COMMON_ROOT/scaler_joblib2npy.py $dump_org_dir/${inout}_${typ}_scaler.joblib $dst_dir
         done
     done
 
@@ -0,0 +1,123 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+import librosa
+import numpy as np
+from scipy.io import wavfile
+
+
+def load_wav(wav_path: Union[str, Path], sampling_rate: int) -> np.ndarray:
+    """Read a wav file and resample it.
+
+    これまで各所で書かれていた wavfile.read -> 正規化 -> librosa.resample と同じ処理.
+
+    Args:
+        wav_path: Path to the wav file.
+        sampling_rate: Target sampling rate.
+
+    Returns:
+        np.ndarray: Resampled waveform.
+    """
+    _sr, x = wavfile.read(wav_path)
+    if x.dtype in [np.int16, np.int32]:
+        x = (x / np.iinfo(x.dtype).max).astype(np.float64)
+    return librosa.resample(x, orig_sr=_sr, target_sr=sampling_rate)
+
+
+class AudioCache:
+    """Content-addressed on-disk store of resampled audio.
+
+    元のwavの中身のhash, sampling_rate, resamplerをkeyとして, resample済みの波形を
+    float32の.npyで保存する. 読み出しは mmap_mode="r" なので, 一部だけ切り出す場合は
+    その分しかdiskから読まない. 書き込みは一時ファイルからのrenameなので,
+    複数のworkerやprocessが同時に同じ発話を作っても壊れない.
+
+    Args:
+        cache_dir: Directory to store cached audio.
+        sampling_rate: Target sampling rate.
+        resampler: Name of the resampler. keyの一部なので, resampleの方法を変えたら名前も変える.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], sampling_rate: int, resampler: str = "librosa"):
+        self.cache_dir = Path(cache_dir)
+        self.sampling_rate = sampling_rate
+        self.resampler = resampler
+        # path -> ((size, mtime), digest). 同じprocessで何度もwav全体をhashしないためのmemo.
+        self._digests: Dict[str, Tuple[Tuple[int, int], str]] = {}
+
+    def _digest(self, wav_path: Path) -> str:
+        st = os.stat(wav_path)
+        stamp = (st.st_size, st.st_mtime_ns)
+        memo = self._digests.get(str(wav_path))
+        if memo is not None and memo[0] == stamp:
+            return memo[1]
+        with open(wav_path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        self._digests[str(wav_path)] = (stamp, digest)
+        return digest
+
+    def cache_path(self, wav_path: Union[str, Path]) -> Path:
+        """Path of the cached audio for ``wav_path``."""
+        digest = self._digest(Path(wav_path))
+        return self.cache_dir / digest[:2] / f"{digest}_sr{self.sampling_rate}_{self.resampler}.npy"
+
+    def build(self, wav_path: Union[str, Path]) -> Path:
+        """Resample ``wav_path`` and store it unless it is already cached.
+
+        Args:
+            wav_path: Path to the wav file.
+
+        Returns:
+            Path: Path to the cached audio.
+        """
+        path = self.cache_path(wav_path)
+        if path.exists():
+            return path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        audio = load_wav(wav_path, self.sampling_rate).astype(np.float32)
+        tmp_path = path.parent / f"{path.stem}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, audio, allow_pickle=False)
+        os.replace(tmp_path, path)
+        return path
+
+    def load(self, wav_path: Union[str, Path]) -> np.ndarray:
+        """Load resampled audio as a read-only memmap, building it on a cache miss.
+
+        Args:
+            wav_path: Path to the wav file.
+
+        Returns:
+            np.ndarray: Memory-mapped float32 waveform.
+        """
+        return np.load(self.build(wav_path), mmap_mode="r")
+
+
+def get_audio_cache(cache_dir: Optional[Union[str, Path]], sampling_rate: int) -> Optional[AudioCache]:
+    """AudioCache for ``cache_dir``, or None if ``cache_dir`` is None or empty."""
+    if not cache_dir:
+        return None
+    return AudioCache(cache_dir, sampling_rate)
+
+
+def load_audio(
+    wav_path: Union[str, Path], sampling_rate: int, audio_cache: Optional[AudioCache] = None
+) -> np.ndarray:
+    """Read a wav file resampled to ``sampling_rate`` as float32.
+
+    audio_cacheがあればそこから読み(なければ作る), ない場合はその場でresampleする.
+    どちらもfloat32なので, cacheの有無で結果は変わらない.
+
+    Args:
+        wav_path: Path to the wav file.
+        sampling_rate: Target sampling rate.
+        audio_cache: Audio cache. Must have the same sampling rate.
+
+    Returns:
+        np.ndarray: float32 waveform. Read-only memmap when read from the cache.
+    """
+    if audio_cache is not None:
+        assert audio_cache.sampling_rate == sampling_rate
+        return audio_cache.load(wav_path)
+    return load_wav(wav_path, sampling_rate).astype(np.float32)
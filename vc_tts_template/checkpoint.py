@@ -0,0 +1,255 @@
+import os
+import re
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import torch
+from hydra.utils import to_absolute_path
+
+from vc_tts_template.distributed import unwrap_model
+
+# 推論に要らないstate. clean_checkpoint_state.pyで消していたもの.
+_TRAINING_STATE_KEYS = ["optimizer_state", "lr_scheduler_state", "optimizer", "lr_scheduler"]
+_DISCRIMINATOR_KEYS = ["netMPD", "netMSD"]
+
+
+def clean_checkpoint_state(checkpoint: Dict[str, Any]) -> Dict[str, Any]:
+    """Remove states which are not needed for inference (optimizer, discriminators etc.).
+
+    Args:
+        checkpoint: Checkpoint. 中身は書き換えずに新しいdictを返す.
+
+    Returns:
+        dict: Checkpoint with weights only.
+    """
+    checkpoint = {k: v for k, v in checkpoint.items() if k not in _TRAINING_STATE_KEYS}
+
+    # For https://github.com/kan-bayashi/ParallelWaveGAN
+    if "model" in checkpoint and "discriminator" in checkpoint["model"]:
+        checkpoint["model"] = {k: v for k, v in checkpoint["model"].items() if k != "discriminator"}
+
+    # For hifigan
+    if "state_dict" in checkpoint.keys() and any(k in checkpoint["state_dict"] for k in _DISCRIMINATOR_KEYS):
+        checkpoint["state_dict"] = {
+            k: v for k, v in checkpoint["state_dict"].items() if k not in _DISCRIMINATOR_KEYS
+        }
+    return checkpoint
+
+
+def checkpoint_state(
+    model, optimizer, lr_scheduler, epoch: int, train_iter: int, resume_state: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """State saved by :func:`vc_tts_template.train_utils.save_checkpoint`.
+
+    model は単体でも, hifiganのようなdictでもよい. DataParallel等ははがして保存する.
+    ``resume_state`` (train_loopが途中から再開するためのstate) があれば一緒に保存する.
+    """
+    if isinstance(model, dict):
+        state_dict = {k: unwrap_model(v).state_dict() for k, v in model.items()}
+    else:
+        state_dict = unwrap_model(model).state_dict()
+    state = {
+        "state_dict": state_dict,
+        "optimizer_state": optimizer.state_dict(),
+        "lr_scheduler_state": lr_scheduler.state_dict(),
+        "last_epoch": epoch,
+        "last_train_iter": train_iter,
+    }
+    if resume_state is not None:
+        state["resume_state"] = resume_state
+    return state
+
+
+def load_resume_state(config) -> Optional[Dict[str, Any]]:
+    """``resume_state`` of ``config.train.pretrained.checkpoint``.
+
+    optimizer_resetするとき (ファインチューニング) や, resume_stateのない古いcheckpointではNone.
+    """
+    pretrained = config.train.pretrained  # type: ignore
+    if pretrained.checkpoint is None or len(pretrained.checkpoint) == 0 or pretrained.optimizer_reset is True:
+        return None
+    checkpoint = torch.load(to_absolute_path(pretrained.checkpoint), map_location=torch.device("cpu"))
+    return checkpoint.get("resume_state")
+
+
+def snapshot_to_cpu(obj: Any) -> Any:
+    """Copy all tensors in nested dicts/lists to CPU.
+
+    state_dictのtensorは学習中のparameterそのものなので, 別threadで書く前にcopyしておく.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj: Any, path: Union[str, Path]) -> None:
+    """torch.save to a temporary file in the same directory and rename it.
+
+    途中で止まっても, ``path`` には前回の完全なfileか今回の完全なfileのどちらかが残る.
+    """
+    path = Path(path)
+    tmp_path = path.parent / f".{path.name}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def link_latest(path: Path, latest_path: Path) -> None:
+    """Point ``latest_path`` to ``path`` without copying its content.
+
+    hard linkにする. hard linkが作れないfile systemではsymlink, それも駄目ならcopyする.
+    いずれも一時fileを作ってからrenameするので, 読み手が中途半端なlatestを見ることはない.
+    """
+    tmp_path = latest_path.parent / f".{latest_path.name}.{os.getpid()}.tmp"
+    if tmp_path.exists() or tmp_path.is_symlink():
+        tmp_path.unlink()
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        try:
+            os.symlink(path.name, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, latest_path)
+
+
+class CheckpointManager(object):
+    """Write checkpoints in a background thread with a retention policy.
+
+    以前のsave_checkpointは, 学習を止めてtorch.saveした後, 同じ中身をlatest.pthにcopyしていた.
+    ここでは
+
+    - model, optimizer, lr_schedulerのstateをCPUにcopyした時点で学習に戻り, 書き込みは別threadで行う.
+      CPUのmemoryを増やし続けないよう, 前回の書き込みが終わっていなければ待ってからcopyする.
+    - 一時fileに書いてからrenameするので, 途中で止まっても壊れたcheckpointは残らない.
+    - ``latest{postfix}.pth`` は最新の ``epochXXXX{postfix}.pth`` へのhard link (なければsymlink).
+    - ``epochXXXX{postfix}.pth`` は新しい ``keep_last`` 個だけ残す. ``best_loss{postfix}.pth`` は別に残る.
+    - ``export_weights`` なら, optimizer等と識別器を除いた推論用の ``*_weights.pth`` も書く
+      (clean_checkpoint_state.pyと同じ中身).
+    - :meth:`save_step` はepochの途中で ``resume{postfix}.pth`` を上書きする. 中断からの再開用.
+
+    Args:
+        out_dir: Output directory.
+        logger: Logger.
+        keep_last: Number of epoch checkpoints to keep. -1なら全て残す.
+        async_save: Write checkpoints in a background thread.
+        export_weights: Also write weights-only checkpoints for inference.
+        postfix: Postfix of the file names.
+    """
+
+    def __init__(
+        self,
+        out_dir: Union[str, Path],
+        logger,
+        keep_last: int = -1,
+        async_save: bool = True,
+        export_weights: bool = False,
+        postfix: str = "",
+    ) -> None:
+        self.out_dir = Path(out_dir)
+        self.logger = logger
+        self.keep_last = keep_last
+        self.async_save = async_save
+        self.export_weights = export_weights
+        self.postfix = postfix
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+    def save(
+        self, model, optimizer, lr_scheduler, epoch: int, train_iter: int, is_best: bool = False,
+        resume_state: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Save a checkpoint. ``async_save`` ならstateをCPUにcopyしたところで戻る.
+
+        Args:
+            model: Model or dict of models.
+            optimizer: Optimizer.
+            lr_scheduler: Learning rate scheduler.
+            epoch: Current epoch.
+            train_iter: Current step.
+            is_best: Whether or not the current model is the best.
+            resume_state: State to resume training exactly. See train_loop.
+        """
+        kind = "best" if is_best else "epoch"
+        self._save(kind, model, optimizer, lr_scheduler, epoch, train_iter, resume_state)
+
+    def save_step(
+        self, model, optimizer, lr_scheduler, epoch: int, train_iter: int, resume_state: Dict[str, Any]
+    ) -> None:
+        """Save a checkpoint in the middle of an epoch as ``resume{postfix}.pth``.
+
+        latestやretentionの対象にはならず, 毎回上書きする.
+        ``epoch`` は最後に終わったepoch (再開すると ``epoch + 1`` の途中から始まる).
+        """
+        self._save("step", model, optimizer, lr_scheduler, epoch, train_iter, resume_state)
+
+    def _save(self, kind: str, model, optimizer, lr_scheduler, epoch, train_iter, resume_state) -> None:
+        self.wait()
+        state = snapshot_to_cpu(checkpoint_state(model, optimizer, lr_scheduler, epoch, train_iter, resume_state))
+        if kind == "best":
+            path = self.out_dir / f"best_loss{self.postfix}.pth"
+        elif kind == "step":
+            path = self.out_dir / f"resume{self.postfix}.pth"
+        else:
+            path = self.out_dir / "epoch{:04d}{}.pth".format(epoch, self.postfix)
+
+        if not self.async_save:
+            self._write(state, path, kind)
+            return
+        self._thread = threading.Thread(target=self._write_in_thread, args=(state, path, kind), daemon=True)
+        self._thread.start()
+
+    def _write_in_thread(self, state: Dict[str, Any], path: Path, kind: str) -> None:
+        try:
+            self._write(state, path, kind)
+        except BaseException as e:
+            # 学習側のthreadで, 次のsaveかwaitのときにraiseする.
+            self._error = e
+
+    def _write(self, state: Dict[str, Any], path: Path, kind: str) -> None:
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        atomic_save(state, path)
+        self.logger.info(f"Saved checkpoint at {path}")
+        if kind == "step":
+            return
+        name = f"best_loss{self.postfix}" if kind == "best" else f"latest{self.postfix}"
+        if kind == "epoch":
+            link_latest(path, self.out_dir / f"{name}.pth")
+            self._remove_old()
+        if self.export_weights:
+            atomic_save(clean_checkpoint_state(state), self.out_dir / f"{name}_weights.pth")
+
+    def _remove_old(self) -> None:
+        if self.keep_last < 0:
+            return
+        pattern = re.compile(rf"epoch(\d+){re.escape(self.postfix)}\.pth")
+        epochs = []
+        for p in self.out_dir.glob(f"epoch*{self.postfix}.pth"):
+            m = pattern.fullmatch(p.name)
+            if m is not None:
+                epochs.append((int(m.group(1)), p))
+        # latestのsymlinkが切れないよう, 最新の1つは必ず残す.
+        keep = max(self.keep_last, 1)
+        for _, p in sorted(epochs)[:max(len(epochs) - keep, 0)]:
+            p.unlink()
+            self.logger.info(f"Removed old checkpoint {p}")
+
+    def wait(self) -> None:
+        """Wait for the checkpoint being written. 書き込みで起きた例外はここでraiseする."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self) -> None:
+        self.wait()
@@ -0,0 +1,126 @@
+import os
+from typing import Any, List, Sequence
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+
+def is_distributed() -> bool:
+    """Whether the process group has been initialized by :func:`init_distributed`."""
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """Whether this process writes checkpoints and TensorBoard logs (rank 0)."""
+    return get_rank() == 0
+
+
+def init_distributed(config) -> torch.device:
+    """Initialize DistributedDataParallel training and return the device of this process.
+
+    ``config.distributed`` がtrueのとき, torchrunが設定する環境変数 (RANK, WORLD_SIZE, LOCAL_RANK等) から
+    process groupを作る. backendはGPUがあればnccl, CPUのみならgloo.
+    falseなら従来通り, GPUがあればcudaを使うだけ.
+
+    Args:
+        config: Configuration for training.
+
+    Returns:
+        torch.device: Device of this process.
+    """
+    if not config.get("distributed", False):  # type: ignore
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    assert "WORLD_SIZE" in os.environ, "distributed=true requires launching with torchrun"
+    assert not config.data_parallel, "data_parallel and distributed can not be used together"  # type: ignore
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
+        backend = "nccl"
+    else:
+        device = torch.device("cpu")
+        backend = "gloo"
+    if not is_distributed():
+        dist.init_process_group(backend=backend)
+    return device
+
+
+def wrap_model(model: nn.Module, config, device: torch.device) -> nn.Module:
+    """Wrap a model with DistributedDataParallel or DataParallel according to the config.
+
+    複数modelの場合はmodelごとに呼ぶ. dictごとwrapすることはできない.
+    """
+    if is_distributed():
+        return DistributedDataParallel(
+            model,
+            device_ids=[device.index] if device.type == "cuda" else None,
+            # 話者埋め込みなど, 設定によって使われないparameterがあるmodelではtrueにする.
+            find_unused_parameters=config.get("find_unused_parameters", False),  # type: ignore
+        )
+    if config.data_parallel:  # type: ignore
+        return nn.DataParallel(model)
+    return model
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    """The underlying module of DataParallel and DistributedDataParallel."""
+    if isinstance(model, (nn.DataParallel, DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def set_epoch_(data_loader, epoch: int) -> None:
+    """Tell the (batch) sampler the epoch so that all ranks shuffle in the same way."""
+    for sampler in [getattr(data_loader, "batch_sampler", None), getattr(data_loader, "sampler", None)]:
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+            return
+
+
+def all_reduce_means(sums: torch.Tensor, num_steps: int) -> Sequence[float]:
+    """Mean over all ranks of losses summed over ``num_steps`` steps on each rank.
+
+    rankごとのstep数が違っても, 全rankのstep数で割った平均になる.
+    全rankで同じ順番のlossについて, 同じ回数呼ばれる必要がある.
+
+    Args:
+        sums: Sum of each loss on this rank, of shape (num_losses,).
+        num_steps: Number of steps on this rank.
+
+    Returns:
+        list: Mean of each loss.
+    """
+    if not is_distributed():
+        return (sums / num_steps).tolist()
+    if dist.get_backend() == "nccl":
+        sums = sums.cuda()
+    # step数も一緒に足すので, 1回の通信で済む.
+    buf = torch.cat([sums.double(), sums.new_tensor([num_steps], dtype=torch.float64)])
+    dist.all_reduce(buf)
+    buf = buf.cpu()
+    return (buf[:-1] / buf[-1]).tolist()
+
+
+def barrier() -> None:
+    if is_distributed():
+        dist.barrier()
+
+
+def all_gather_object(obj: Any) -> List[Any]:
+    """Objects of all ranks in rank order (乱数のstateなど, rankごとに違うものをrank 0で保存するため)."""
+    if not is_distributed():
+        return [obj]
+    objs: List[Any] = [None] * get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import Optional
 
 import librosa
@@ -6,6 +7,7 @@ import pysptk
 import pyworld
 from nnmnkwii.preprocessing import delta_features
 from nnmnkwii.preprocessing.f0 import interp1d
+from scipy.signal import get_window
 
 
 def f0_to_lf0(f0: np.ndarray) -> np.ndarray:
@@ -231,6 +233,143 @@ def inv_mulaw_quantize(y: np.ndarray, mu: int = 255) -> np.ndarray:
     return _inv_mulaw(_inv_quantize(y, mu), mu)
 
 
+def _next_power_of_2(x):
+    # xを超える最大の2^を返す.
+    return 1 if x == 0 else 2 ** (x - 1).bit_length()
+
+
+def _log(S: np.ndarray, log_base: str) -> np.ndarray:
+    assert log_base in ["common", "natural"]
+    if log_base == "common":
+        return np.log10(S)
+    # fastspeech, hifiganはこちら.
+    return np.log(S)
+
+
+@lru_cache(maxsize=None)
+def _hann_window(win_length: int) -> np.ndarray:
+    # librosa.stftの window="hann" と同じ窓.
+    window = get_window("hann", win_length, fftbins=True)
+    window.setflags(write=False)
+    return window
+
+
+@lru_cache(maxsize=None)
+def _mel_basis(sr: int, n_fft: int, n_mels: int, fmin: float, fmax: float) -> np.ndarray:
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax)
+    mel_basis.setflags(write=False)
+    return mel_basis
+
+
+class SpectralFeatureExtractor:
+    """Derive several features from a single STFT of a waveform.
+
+    STFTの振幅は :meth:`magnitude` で1回だけ計算し, そこからmel(分解能違いも可), energy,
+    log-spectrogramを作る. mel filterbankと窓はparameterをkeyにprocess内でcacheされる.
+
+    Args:
+        sr (int): Sampling rate.
+        n_fft (int, optional): FFT size.
+        hop_length (int, optional): Hop length. Defaults to 12.5ms.
+        win_length (int, optional): Window length. Defaults to 50 ms.
+
+    Examples:
+        >>> extractor = SpectralFeatureExtractor(22050, 1024, 256, 1024)
+        >>> magnitude = extractor.magnitude(wav)
+        >>> mel = extractor.logmel(magnitude, n_mels=80, log_base="natural")
+        >>> energy = extractor.energy(magnitude)
+    """
+
+    def __init__(
+        self,
+        sr: int,
+        n_fft: Optional[int] = None,
+        hop_length: Optional[int] = None,
+        win_length: Optional[int] = None,
+    ):
+        if hop_length is None:
+            hop_length = int(sr * 0.0125)
+        if win_length is None:
+            win_length = int(sr * 0.050)
+        if n_fft is None:
+            n_fft = _next_power_of_2(win_length)
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.win_length = win_length
+
+    def magnitude(self, y: np.ndarray) -> np.ndarray:
+        """Compute the STFT magnitude.
+
+        Args:
+            y (ndarray): Waveform.
+
+        Returns:
+            numpy.ndarray: Magnitude spectrogram of shape (n_fft // 2 + 1, T).
+        """
+        S = librosa.stft(
+            y, n_fft=self.n_fft, hop_length=self.hop_length, win_length=self.win_length,
+            window=_hann_window(self.win_length)
+        )
+        return np.abs(S)
+
+    def logmel(
+        self,
+        magnitude: np.ndarray,
+        n_mels: int = 80,
+        fmin: Optional[int] = None,
+        fmax: Optional[int] = None,
+        clip: float = 1e-3,
+        log_base: str = "common",
+    ) -> np.ndarray:
+        """Log-melspectrogram from a magnitude spectrogram.
+
+        Args:
+            magnitude (ndarray): Output of :meth:`magnitude`.
+            n_mels (int, optional): Number of mel bins. Defaults to 80.
+            fmin (int, optional): Minimum frequency. Defaults to 0.
+            fmax (int, optional): Maximum frequency. Defaults to sr / 2.
+            clip (float, optional): Clip the magnitude. Defaults to 0.001.
+            log_base (str, optional): "common" or "natural".
+
+        Returns:
+            numpy.ndarray: Log-melspectrogram of shape (T, n_mels).
+        """
+        fmin = 0 if fmin is None else fmin
+        fmax = self.sr // 2 if fmax is None else fmax
+        # スペクトログラム -> メルスペクトログラム
+        S = np.dot(_mel_basis(self.sr, self.n_fft, n_mels, fmin, fmax), magnitude)
+        # クリッピングして対数を取る
+        S = _log(np.maximum(S, clip), log_base)
+        # Time first: (T, N)
+        return S.T
+
+    def energy(self, magnitude: np.ndarray) -> np.ndarray:
+        """Frame energy (L2 norm of the magnitude), as in the FastSpeech 2 implementation.
+
+        Args:
+            magnitude (ndarray): Output of :meth:`magnitude`.
+
+        Returns:
+            numpy.ndarray: Energy of shape (T,).
+        """
+        return np.linalg.norm(magnitude, axis=0)
+
+    def logspec(self, magnitude: np.ndarray, clip: float = 1e-3) -> np.ndarray:
+        """Log-spectrogram (base 10) from a magnitude spectrogram.
+
+        Args:
+            magnitude (ndarray): Output of :meth:`magnitude`.
+            clip (float, optional): Clip the magnitude. Defaults to 0.001.
+
+        Returns:
+            numpy.ndarray: Log-spectrogram of shape (T, n_fft // 2 + 1).
+        """
+        # NOTE: クリッピングの値は、データに依存して調整する必要があります。
+        # Tacotron 2の論文では 0.01 です
+        return np.log10(np.maximum(magnitude, clip)).T
+
+
 def logspectrogram(
     y: np.ndarray,
     sr: int,
@@ -252,31 +391,8 @@ def logspectrogram(
     Returns:
         numpy.ndarray: Log-spectrogram.
     """
-    if hop_length is None:
-        hop_length = int(sr * 0.0125)
-    if win_length is None:
-        win_length = int(sr * 0.050)
-    if n_fft is None:
-        n_fft = _next_power_of_2(win_length)
-
-    S = librosa.stft(
-        y, n_fft=n_fft, hop_length=hop_length, win_length=win_length, window="hanning"
-    )
-    # スペクトログラムのクリッピング
-    # NOTE: クリッピングの値は、データに依存して調整する必要があります。
-    # Tacotron 2の論文では 0.01 です
-    S = np.maximum(np.abs(S), clip)
-
-    # 対数を取る
-    S = np.log10(S)
-
-    # Time first: (T, N)
-    return S.T
-
-
-def _next_power_of_2(x):
-    # xを超える最大の2^を返す.
-    return 1 if x == 0 else 2 ** (x - 1).bit_length()
+    extractor = SpectralFeatureExtractor(sr, n_fft, hop_length, win_length)
+    return extractor.logspec(extractor.magnitude(y), clip)
 
 
 def logmelspectrogram(
@@ -294,6 +410,8 @@ def logmelspectrogram(
 ):
     """Compute log-melspectrogram.
 
+    複数の特徴量を同じ波形から作る場合は, :class:`SpectralFeatureExtractor` でSTFTを使い回すこと.
+
     Args:
         y (ndarray): Waveform.
         sr (int): Sampling rate.
@@ -308,43 +426,16 @@ def logmelspectrogram(
     Returns:
         numpy.ndarray: Log-melspectrogram.
     """
-    if hop_length is None:
-        hop_length = int(sr * 0.0125)
-    if win_length is None:
-        win_length = int(sr * 0.050)
-    if n_fft is None:
-        n_fft = _next_power_of_2(win_length)
-
-    magnitude = librosa.stft(
-        y, n_fft=n_fft, hop_length=hop_length, win_length=win_length, window="hanning"
-    )
-
-    fmin = 0 if fmin is None else fmin
-    fmax = sr // 2 if fmax is None else fmax
-
-    # メルフィルタバンク
-    mel_basis = librosa.filters.mel(sr, n_fft, fmin=fmin, fmax=fmax, n_mels=n_mels)
-    # スペクトログラム -> メルスペクトログラム
-    magnitude = np.abs(magnitude)
-    S = np.dot(mel_basis, magnitude)
-
-    # クリッピング
-    S = np.maximum(S, clip)
-
-    # 対数を取る
-    assert log_base in ["common", "natural"]
-    if log_base == "common":
-        S = np.log10(S)
-    elif log_base == "natural":
-        # fastspeech, hifiganはこちら.
-        S = np.log(S)
+    extractor = SpectralFeatureExtractor(sr, n_fft, hop_length, win_length)
+    magnitude = extractor.magnitude(y)
+    S = extractor.logmel(magnitude, n_mels, fmin, fmax, clip, log_base)
 
     if need_energy is True:
         # fastspeech2の実装準拠.
-        return S.T, np.linalg.norm(magnitude.T, axis=1)
+        return S, extractor.energy(magnitude)
 
     # Time first: (T, N)
-    return S.T
+    return S
 
 
 def logmelspectrogram_to_audio(
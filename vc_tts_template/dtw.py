@@ -0,0 +1,151 @@
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+
+def dtw(
+    x: np.ndarray, y: np.ndarray, metric: str = "cityblock", band: Optional[int] = None
+) -> Tuple[float, np.ndarray]:
+    """Exact dynamic time warping.
+
+    fastdtwのdtw(厳密解)と同じ漸化式, 同じ同値時の優先順位 (xだけ進む, yだけ進む, 両方進む) で
+    pathを求める. DPは同じ反対角線 (i + j = k) 上のセルが互いに依存しないことを利用して,
+    反対角線ごとにまとめて計算する. bandを指定すると, 各反対角線でband内のセルだけを計算する.
+
+    Args:
+        x: Sequence of shape (N, d).
+        y: Sequence of shape (M, d).
+        metric: Distance metric passed to ``scipy.spatial.distance.cdist``.
+        band: Sakoe-Chiba band width in frames around the (length-normalized) diagonal.
+            None computes the full cost matrix. With a band, the cost and the backtrack
+            steps are kept only for the cells in the band, so memory is O((N + M) * band).
+
+    Returns:
+        tuple: Total cost and warping path of shape (L, 2) as (x index, y index) pairs.
+    """
+    n, m = len(x), len(y)
+    ratio = m / n
+    if band is None:
+        cost = cdist(x, y, metric=metric)
+        col_lo = np.zeros(n, dtype=np.int64)
+    else:
+        # 対角線の傾きより狭いとpathが途切れるので, 最低でもceil(M / N)は残す.
+        band = max(band, math.ceil(ratio))
+        # x[i]の行では, |(i + 1) * M / N - (j + 1)| <= band となるy[j]だけ距離を求める.
+        # 下の反対角線ごとの範囲と丸めがずれても困らないように, 両側に1 frame余分に取る.
+        center = np.arange(1, n + 1) * ratio
+        col_lo = np.clip(np.ceil(center - band).astype(np.int64) - 2, 0, m)
+        col_hi = np.clip(np.floor(center + band).astype(np.int64) + 1, 0, m)
+        cost = np.full((n, int(np.max(col_hi - col_lo))), np.inf)
+        for i in range(n):
+            cost[i, :col_hi[i] - col_lo[i]] = cdist(x[i:i + 1], y[col_lo[i]:col_hi[i]], metric=metric)[0]
+
+    # D[i, j]: x[:i], y[:j] のalignmentの最小コスト (0行目と0列目は番兵).
+    # 反対角線 k = i + j ごとに, iをindexとする長さN+1の配列で持つと,
+    # D[i-1, j], D[i, j-1] は1本前, D[i-1, j-1] は2本前の配列のsliceになる.
+    prev2 = np.full(n + 1, np.inf)  # k - 2
+    prev2[0] = 0.0
+    prev1 = np.full(n + 1, np.inf)  # k - 1
+    # 0: (i-1, j), 1: (i, j-1), 2: (i-1, j-1) のどこから来たか.
+    # steps[k][i - steps_lo[k]] として, 反対角線ごとに計算した範囲だけ持つ.
+    steps = [np.zeros(0, dtype=np.int8)] * (n + m + 1)
+    steps_lo = np.zeros(n + m + 1, dtype=np.int64)
+    for k in range(2, n + m + 1):
+        lo, hi = max(1, k - m), min(n, k - 1)
+        if band is not None:
+            # |i * M / N - j| <= band となるiの範囲.
+            lo = max(lo, math.ceil((k - band) / (1 + ratio)))
+            hi = min(hi, math.floor((k + band) / (1 + ratio)))
+        current = np.full(n + 1, np.inf)
+        if lo <= hi:
+            i = np.arange(lo, hi + 1)
+            c = cost[i - 1, k - i - 1 - col_lo[i - 1]]
+            # fastdtwと同じく, 各候補にコストを足してから比べる.
+            up = prev1[lo - 1:hi] + c
+            left = prev1[lo:hi + 1] + c
+            diag = prev2[lo - 1:hi] + c
+            # 同値なら up, left, diag の順に優先する (fastdtwのmin(..., key=)と同じ).
+            best = np.minimum(up, left)
+            is_diag = diag < best
+            current[lo:hi + 1] = np.minimum(best, diag)
+            steps[k] = np.where(is_diag, 2, left < up).astype(np.int8)
+            steps_lo[k] = lo
+        prev2, prev1 = prev1, current
+
+    if not np.isfinite(prev1[n]):
+        raise ValueError(f"No warping path within band={band}")
+
+    # backtrack. 長さはN+M未満なので, ここはpython loopで十分速い.
+    path = []
+    i, j = n, m
+    while i > 0 and j > 0:
+        path.append((i - 1, j - 1))
+        s = steps[i + j][i - steps_lo[i + j]]
+        if s == 0:
+            i -= 1
+        elif s == 1:
+            j -= 1
+        else:
+            i, j = i - 1, j - 1
+    return float(prev1[n]), np.array(path[::-1])
+
+
+def path_to_duration(path: np.ndarray, n_source: int) -> np.ndarray:
+    """Convert a (target, source) warping path into per-source-frame durations.
+
+    source : target = 多 : 1 のときは, 該当するsourceの最初以外を0にする(削除).
+    source : target = 1 : 多 のときは, sourceに多を割り当てる.
+
+    Args:
+        path: Warping path of shape (L, 2) as (target index, source index) pairs.
+        n_source: Number of source frames.
+
+    Returns:
+        np.ndarray: Duration of each source frame. Its sum equals the number of target frames.
+    """
+    path_t, path_s = path[:, 0], path[:, 1]
+    # sourceの各frameがpath上に何回現れるか = 割り当てるtargetのframe数.
+    duration = np.bincount(path_s, minlength=n_source).astype(np.float64)
+    # targetが進まずにsourceだけ進んで到達したframe (多:1) は, その分1減らす.
+    horizontal = np.zeros(len(path), dtype=bool)
+    horizontal[1:] = path_t[1:] == path_t[:-1]
+    duration -= np.bincount(path_s[horizontal], minlength=n_source)
+    return duration
+
+
+def diagonalize(duration: np.ndarray, diagonal_index: np.ndarray) -> np.ndarray:
+    """Spread durations evenly inside each run of ``diagonal_index``.
+
+    対角化とは, sourceとtargetのtime indexをx, y軸とでもしたときに, 斜めになるようにすること.
+    Trueが続く区間ごとに区間内のdurationの和を保ったまま,
+    targetの方が長ければ均等に割り振り(余りは前から1ずつ), sourceの方が長ければ前からの1で埋める.
+
+    Args:
+        duration: Duration of each source frame.
+        diagonal_index: Boolean array of the same length as ``duration``.
+
+    Returns:
+        np.ndarray: New durations.
+    """
+    duration = duration.copy()
+    diagonal_index = np.asarray(diagonal_index, dtype=bool)
+    positions = np.flatnonzero(diagonal_index)
+    if len(positions) == 0:
+        return duration
+
+    # 区間の先頭を見つけて, 各Trueの位置が属する区間とその中での位置を求める.
+    is_start = np.ones(len(positions), dtype=bool)
+    is_start[1:] = positions[1:] != positions[:-1] + 1
+    starts = np.flatnonzero(is_start)
+    run_id = np.cumsum(is_start) - 1
+    offset = np.arange(len(positions)) - starts[run_id]
+
+    run_sum = np.add.reduceat(duration[positions], starts)
+    run_len = np.diff(np.append(starts, len(positions)))
+    # sum <= len のときはmean=0か1になり, 前からsum個を1にするのと一致する.
+    mean = run_sum // run_len
+    rest = run_sum - run_len * mean
+    duration[positions] = mean[run_id] + (offset < rest[run_id])
+    return duration
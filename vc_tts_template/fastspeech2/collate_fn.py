@@ -5,6 +5,10 @@ from hydra.utils import to_absolute_path
 from torch.utils import data as data_utils
 import numpy as np
 
+from vc_tts_template.length_index import find_length_index, load_length_index
+from vc_tts_template.normalization import get_normalized_collate_fn
+from vc_tts_template.packed import PackedFeatures
+from vc_tts_template.sampler import get_data_loader, split_by_budget
 from vc_tts_template.utils import load_utt_list, pad_1d, pad_2d
 
 
@@ -57,6 +61,48 @@ class fastspeech2_Dataset(data_utils.Dataset):  # type: ignore
         return len(self.in_paths)
 
 
+class fastspeech2_PackedDataset(data_utils.Dataset):  # type: ignore
+    """Dataset for packed shards made by recipes/common/pack_dump.py
+
+    fastspeech2_Datasetと同じものを返すが, 各特徴量はshardのview(コピーなし).
+
+    Args:
+        utt_ids: List of utterance ids
+        in_feats: Packed input features
+        out_mels, out_pitches, out_energies, out_durations: Packed output features
+    """
+
+    def __init__(
+        self,
+        utt_ids: List[str],
+        in_feats: PackedFeatures,
+        out_mels: PackedFeatures,
+        out_pitches: PackedFeatures,
+        out_energies: PackedFeatures,
+        out_durations: PackedFeatures,
+    ):
+        self.utt_ids = utt_ids
+        self.in_feats = in_feats
+        self.out_mels = out_mels
+        self.out_pitches = out_pitches
+        self.out_energies = out_energies
+        self.out_durations = out_durations
+
+    def __getitem__(self, idx: int) -> Tuple[str, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        utt_id = self.utt_ids[idx]
+        return (
+            f"{utt_id}-feats.npy",
+            self.in_feats[utt_id],
+            self.out_mels[utt_id],
+            self.out_pitches[utt_id],
+            self.out_energies[utt_id],
+            self.out_durations[utt_id],
+        )
+
+    def __len__(self):
+        return len(self.utt_ids)
+
+
 def fastspeech2_get_data_loaders(data_config: Dict, collate_fn: Callable) -> Dict[str, data_utils.DataLoader]:
     """Get data loaders for training and validation.
 
@@ -73,28 +119,46 @@ def fastspeech2_get_data_loaders(data_config: Dict, collate_fn: Callable) -> Dic
         utt_ids = load_utt_list(to_absolute_path(data_config[phase].utt_list))
         in_dir = Path(to_absolute_path(data_config[phase].in_dir))
         out_dir = Path(to_absolute_path(data_config[phase].out_dir))
-
-        in_feats_paths = [in_dir / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        out_mel_paths = [out_dir / "mel" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        out_pitch_paths = [out_dir / "pitch" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        out_energy_paths = [out_dir / "energy" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        out_duration_paths = [out_dir / "duration" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-
-        dataset = fastspeech2_Dataset(
-            in_feats_paths,
-            out_mel_paths,
-            out_pitch_paths,
-            out_energy_paths,
-            out_duration_paths,
-        )
-        data_loaders[phase] = data_utils.DataLoader(
-            dataset,
-            batch_size=data_config.batch_size * data_config.group_size,  # type: ignore
-            collate_fn=collate_fn,
-            pin_memory=True,
-            num_workers=data_config.num_workers,  # type: ignore
-            shuffle=phase.startswith("train"),  # trainならTrue
+        bucketing = data_config.get("bucketing", False)  # type: ignore
+        # 前処理で作った発話長のindexがあれば, 特徴量を開かずに長さが分かる.
+        length_index_path = find_length_index([in_dir, out_dir]) if bucketing else None
+        need_lengths = bucketing and length_index_path is None
+
+        if data_config.get("packed", False):  # type: ignore
+            dataset = fastspeech2_PackedDataset(
+                utt_ids,
+                PackedFeatures(in_dir),
+                PackedFeatures(out_dir / "mel"),
+                PackedFeatures(out_dir / "pitch"),
+                PackedFeatures(out_dir / "energy"),
+                PackedFeatures(out_dir / "duration"),
+            )
+            # collateでsort, 区切りに使うのはmelの長さ (1stepのメモリはほぼmelのframe数で決まる).
+            lengths = [dataset.out_mels.length(utt_id) for utt_id in utt_ids] if need_lengths else None
+        else:
+            in_feats_paths = [in_dir / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            out_mel_paths = [out_dir / "mel" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            out_pitch_paths = [out_dir / "pitch" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            out_energy_paths = [out_dir / "energy" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            out_duration_paths = [out_dir / "duration" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+
+            dataset = fastspeech2_Dataset(
+                in_feats_paths,
+                out_mel_paths,
+                out_pitch_paths,
+                out_energy_paths,
+                out_duration_paths,
+            )
+            # indexがない場合のみ, npyのheaderから長さを読む.
+            lengths = [np.load(path, mmap_mode="r").shape[0] for path in out_mel_paths] if need_lengths else None
+        if length_index_path is not None:
+            length_index = load_length_index(length_index_path)
+            lengths = [length_index[utt_id].mel_len for utt_id in utt_ids]
+        # scaler_dirがあれば, orgの特徴量をcollateでまとめて正規化する.
+        phase_collate_fn = get_normalized_collate_fn(
+            data_config, collate_fn, {2: f"{out_dir.name}_mel", 3: f"{out_dir.name}_pitch", 4: f"{out_dir.name}_energy"}
         )
+        data_loaders[phase] = get_data_loader(data_config, dataset, phase_collate_fn, phase, lengths)
 
     return data_loaders
 
@@ -144,23 +208,19 @@ def reprocess(batch, idxs, speaker_dict, emotion_dict):
     )
 
 
-def collate_fn_fastspeech2(batch, batch_size, speaker_dict=None, emotion_dict=None):
+def collate_fn_fastspeech2(batch, batch_size, speaker_dict=None, emotion_dict=None, max_frames=None):
     """Collate function for Tacotron.
     Args:
         batch (list): List of tuples of the form (inputs, targets).
         Datasetのreturnが1単位となって, それがbatch_size分入って渡される.
+        max_frames (int): sub-batchあたりのpadding込み最大長. LengthBucketBatchSamplerと同じ値を渡す.
     Returns:
         tuple: Batch of inputs, input lengths, targets, target lengths and stop flags.
     """
-    # shape[0]がtimeになるようなindexを指定する.
-    len_arr = np.array([batch[idx][1].shape[0] for idx in range(len(batch))])
+    # shape[0]がtimeになるようなindexを指定する. max_framesはmelのframe数の予算なので, melの長さで区切る.
+    len_arr = np.array([batch[idx][2].shape[0] for idx in range(len(batch))])
     # 以下固定
-    idx_arr = np.argsort(-len_arr)
-    tail = idx_arr[len(idx_arr) - (len(idx_arr) % batch_size):]
-    idx_arr = idx_arr[: len(idx_arr) - (len(idx_arr) % batch_size)]
-    idx_arr = idx_arr.reshape((-1, batch_size)).tolist()
-    if len(tail) > 0:
-        idx_arr += [tail.tolist()]
+    idx_arr = split_by_budget(len_arr, batch_size, max_frames)
     output = list()
 
     # 以下, reprocessへの引数が変更の余地あり.
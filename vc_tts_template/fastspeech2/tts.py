@@ -11,7 +11,8 @@ from omegaconf import OmegaConf
 sys.path.append('..')
 from vc_tts_template.pretrained import retrieve_pretrained_model
 from vc_tts_template.frontend.openjtalk import text_to_sequence
-from vc_tts_template.utils import StandardScaler
+from vc_tts_template.utils import StandardScaler, pad_1d
+from vc_tts_template.vocoder.hifigan.stream import vocode_stream
 
 
 class FastSpeech2TTS(object):
@@ -59,6 +60,7 @@ class FastSpeech2TTS(object):
             np.load(model_dir / "out_fastspeech2_mel_scaler_scale.npy"),
         )
         self.acoustic_model.eval()
+        self._set_scaler_tensors()
 
         # vocoder
         self.vocoder_config = OmegaConf.load(model_dir / "vocoder_model.yaml")
@@ -70,6 +72,8 @@ class FastSpeech2TTS(object):
         self.vocoder_model.load_state_dict(checkpoint["state_dict"]["netG"])
         self.vocoder_model.eval()
         self.vocoder_model.remove_weight_norm()
+        # melの1frameあたりのsample数
+        self.hop_size = int(np.prod(self.vocoder_config.netG.upsample_rates))
 
     def __repr__(self):
         acoustic_str = json.dumps(
@@ -98,31 +102,18 @@ Vocoder model: {wavenet_str}
         self.device = device
         self.acoustic_model.to(device)
         self.vocoder_model.to(device)
+        self._set_scaler_tensors()
 
-    @torch.no_grad()
-    def tts(self, text, accents=None, speaker=None, emotion=None):
-        """Run TTS
+    def _set_scaler_tensors(self):
+        # inverse_transformをdevice上で行うためのtensor. 形は(1, 1, mel_dim)
+        self._mel_mean = torch.tensor(self.acoustic_out_scaler.mean_, dtype=torch.float).view(1, 1, -1).to(self.device)
+        self._mel_scale = torch.tensor(
+            self.acoustic_out_scaler.scale_, dtype=torch.float
+        ).view(1, 1, -1).to(self.device)
 
-        Args:
-            text (str): Input text
-            accents (str): Accents corresponding to text
-            speaker (str): you can select speaker if you train with it.
-            tqdm (object, optional): tqdm object. Defaults to None.
-
-        Returns:
-            tuple: audio array (np.int16) and sampling rate (int)
-        """
+    def _text_to_feats(self, text, accents=None):
         # OpenJTalkを用いて言語特徴量の抽出
         phonemes = pyopenjtalk.g2p(text).split(" ")
-        if speaker is None:
-            speakers = np.array([0])
-        else:
-            speakers = np.array([self.acoustic_model.speakers[speaker]])
-        if emotion is None:
-            emotions = np.array([0])
-        else:
-            emotions = np.array([self.acoustic_model.emotions[emotion]])
-
         if accents is not None:
             if len(accents) != len(phonemes):
                 raise ValueError(
@@ -134,7 +125,57 @@ Vocoder model: {wavenet_str}
             phonemes = [
                 p + acc for p, acc in zip(phonemes, accents)
             ]
-        in_feats = np.array(text_to_sequence(phonemes))
+        return np.array(text_to_sequence(phonemes))
+
+    def _speaker_id(self, speaker):
+        return 0 if speaker is None else self.acoustic_model.speakers[speaker]
+
+    def _emotion_id(self, emotion):
+        return 0 if emotion is None else self.acoustic_model.emotions[emotion]
+
+    @torch.no_grad()
+    def tts(self, text, accents=None, speaker=None, emotion=None):
+        """Run TTS
+
+        Args:
+            text (str): Input text
+            accents (str): Accents corresponding to text
+            speaker (str): you can select speaker if you train with it.
+            tqdm (object, optional): tqdm object. Defaults to None.
+
+        Returns:
+            tuple: audio array (np.int16) and sampling rate (int)
+        """
+        mels = self._tts_mel(text, accents, speaker, emotion)
+        wav = self.vocoder_model(mels.transpose(1, 2)).squeeze(1).cpu().data.numpy()[0]
+
+        return self.post_process(wav), self.sample_rate
+
+    @torch.no_grad()
+    def tts_stream(self, text, accents=None, speaker=None, emotion=None, chunk_frames=64):
+        """Run TTS and vocode the mel chunk by chunk
+
+        音響モデルは一度に実行し, vocoderだけchunk_framesずつ受容野分の文脈を付けて実行する.
+        連結した波形はtts()と(浮動小数点の誤差を除き)一致する.
+
+        Args:
+            text (str): Input text
+            accents (str): Accents corresponding to text
+            speaker (str): you can select speaker if you train with it.
+            emotion (str): you can select emotion if you train with it.
+            chunk_frames (int): Number of mel frames vocoded at once.
+
+        Yields:
+            np.ndarray: audio block (np.int16) of chunk_frames * hop_size samples
+        """
+        mels = self._tts_mel(text, accents, speaker, emotion)
+        for wav in vocode_stream(self.vocoder_model, mels.transpose(1, 2), chunk_frames):
+            yield self.post_process(wav.cpu().data.numpy())
+
+    def _tts_mel(self, text, accents=None, speaker=None, emotion=None):
+        speakers = np.array([self._speaker_id(speaker)])
+        emotions = np.array([self._emotion_id(emotion)])
+        in_feats = self._text_to_feats(text, accents)
         src_lens = [in_feats.shape[0]]
         max_src_len = max(src_lens)
 
@@ -152,12 +193,64 @@ Vocoder model: {wavenet_str}
             max_src_len=max_src_len,
         )
 
-        mel_post = output[1]
-        mels = [self.acoustic_out_scaler.inverse_transform(mel.cpu().data.numpy()) for mel in mel_post]  # type: ignore
-        mels = torch.Tensor(np.array(mels)).to(self.device)
-        wav = self.vocoder_model(mels.transpose(1, 2)).squeeze(1).cpu().data.numpy()[0]
+        # 逆正規化はdevice上で行う. CPUとの往復はしない.
+        return output[1] * self._mel_scale + self._mel_mean
 
-        return self.post_process(wav), self.sample_rate
+    @torch.no_grad()
+    def tts_batch(self, texts, accents=None, speakers=None, emotions=None, batch_size=None):
+        """Run TTS for multiple sentences at once
+
+        G2Pを全文に対して行った後, 音素数の長い順に並べてbatch_size文ずつpaddingし,
+        音響モデルとvocoderをbatchごとに1回だけ実行する.
+        melの逆正規化はdevice上で行い, 各波形は自身のmel長 * hop_sizeで切り出す.
+
+        Args:
+            texts (list): Input texts
+            accents (list, optional): Accents corresponding to each text
+            speakers (list, optional): Speaker of each text
+            emotions (list, optional): Emotion of each text
+            batch_size (int, optional): Number of sentences in one forward. All at once if None.
+
+        Returns:
+            tuple: list of audio arrays (np.int16) in the order of texts and sampling rate (int)
+        """
+        n = len(texts)
+        if n == 0:
+            return [], self.sample_rate
+        accents = [None] * n if accents is None else accents
+        speakers = [None] * n if speakers is None else speakers
+        emotions = [None] * n if emotions is None else emotions
+        batch_size = n if batch_size is None else batch_size
+        assert batch_size > 0, f"batch_size must be positive, but got {batch_size}"
+
+        in_feats = [self._text_to_feats(text, acc) for text, acc in zip(texts, accents)]
+        speaker_ids = np.array([self._speaker_id(spk) for spk in speakers])
+        emotion_ids = np.array([self._emotion_id(emo) for emo in emotions])
+
+        # 長さの近い文同士でbatchを組み, paddingを減らす.
+        order = np.argsort([-len(feats) for feats in in_feats], kind="stable")
+        wavs = [None] * n
+        for start in range(0, n, batch_size):
+            idxs = order[start:start+batch_size]
+            src_lens = [len(in_feats[idx]) for idx in idxs]
+
+            output = self.acoustic_model(
+                ids=None,
+                speakers=torch.tensor(speaker_ids[idxs], dtype=torch.long).to(self.device),
+                emotions=torch.tensor(emotion_ids[idxs], dtype=torch.long).to(self.device),
+                texts=torch.tensor(pad_1d([in_feats[idx] for idx in idxs]), dtype=torch.long).to(self.device),
+                src_lens=torch.tensor(src_lens, dtype=torch.long).to(self.device),
+                max_src_len=max(src_lens),
+            )
+
+            # padding部分は0にしておく(1文ずつ合成したときのvocoderのzero paddingに近づける).
+            mels = (output[1] * self._mel_scale + self._mel_mean).masked_fill(output[7].unsqueeze(-1), 0.0)
+            mel_lens = output[9].cpu().numpy()
+            batch_wavs = self.vocoder_model(mels.transpose(1, 2)).squeeze(1).cpu().data.numpy()
+            for idx, wav, mel_len in zip(idxs, batch_wavs, mel_lens):
+                wavs[idx] = self.post_process(wav[: mel_len * self.hop_size])
+
+        return wavs, self.sample_rate
 
     def post_process(self, wav):
         wav = np.clip(wav, -1.0, 1.0)
@@ -7,7 +7,7 @@ import torch.nn as nn
 import numpy as np
 
 sys.path.append('.')
-from vc_tts_template.utils import make_pad_mask, pad
+from vc_tts_template.utils import make_pad_mask
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -208,35 +208,32 @@ class LengthRegulator(nn.Module):
         super(LengthRegulator, self).__init__()
 
     def LR(self, x, duration, max_len):
-        output = list()
-        mel_len = list()
-        for batch, expand_target in zip(x, duration):
-            expanded = self.expand(batch, expand_target)
-            output.append(expanded)
-            # expandedのlenがまさに出力したいmelの幅になる.
-            mel_len.append(expanded.shape[0])
-
-        # ここでは, まだoutputは長さバラバラのlistであることに注意.
-        # 長さを揃えなきゃ.
-        if max_len is not None:
-            # max_lenがあるなら, それでpad.
-            output = pad(output, max_len)
-        else:
-            # targetがないならmax_lenもないですね.
-            # その場合は自動で一番長い部分を探してくれる.
-            output = pad(output)
+        # 各phonemeをdurationだけ繰り返す処理を, batch全体で一度に行う.
+        # phoneme毎の.item()によるGPU→CPUの同期を避けるため, ループは書かない.
+        duration = torch.clamp(duration.long(), min=0)
+        # expandedのlenがまさに出力したいmelの幅になる.
+        mel_len = torch.sum(duration, dim=1)
 
-        return output, torch.LongTensor(mel_len).to(device)
+        if max_len is None:
+            # targetがないならmax_lenもないですね.
+            # その場合は一番長い部分に揃える. ここだけは形を決めるために同期が必要.
+            max_len = int(torch.max(mel_len).item()) if mel_len.size(0) > 0 else 0
 
-    def expand(self, batch, predicted):
-        out = list()
+        # frame t が何番目のphonemeに属するかは, 累積durationの中でt以下のものの数.
+        cum_duration = torch.cumsum(duration, dim=1)
+        frame_ids = torch.arange(max_len, device=x.device).unsqueeze(0).expand(x.size(0), -1)
+        phone_ids = torch.searchsorted(cum_duration, frame_ids.contiguous(), right=True)
+        phone_ids = torch.clamp(phone_ids, max=max(x.size(1) - 1, 0))
 
-        for i, vec in enumerate(batch):
-            expand_size = predicted[i].item()
-            out.append(vec.expand(max(int(expand_size), 0), -1))
-        out = torch.cat(out, 0)  # listをtorchの2次元へ, かな.
+        output = torch.gather(
+            x, 1, phone_ids.unsqueeze(-1).expand(-1, -1, x.size(-1))
+        )
+        # mel_lenを超える部分はpadなので0にする.
+        output = output.masked_fill(
+            (frame_ids >= mel_len.unsqueeze(1)).unsqueeze(-1), 0.0
+        )
 
-        return out
+        return output, mel_len
 
     def forward(self, x, duration, max_len):
         # durationがpredictか, targetのdurationです.
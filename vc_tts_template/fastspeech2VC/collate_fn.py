@@ -5,6 +5,10 @@ from hydra.utils import to_absolute_path
 from torch.utils import data as data_utils
 import numpy as np
 
+from vc_tts_template.length_index import find_length_index, load_length_index
+from vc_tts_template.normalization import get_normalized_collate_fn
+from vc_tts_template.packed import PackedFeatures, is_packed
+from vc_tts_template.sampler import get_data_loader, split_by_budget
 from vc_tts_template.utils import load_utt_list, pad_1d, pad_2d
 
 
@@ -69,6 +73,47 @@ class fastspeech2VC_Dataset(data_utils.Dataset):  # type: ignore
         return len(self.in_mel_paths)
 
 
+class fastspeech2VC_PackedDataset(data_utils.Dataset):  # type: ignore
+    """Dataset for packed shards made by recipes/common/pack_dump.py
+
+    fastspeech2VC_Datasetと同じものを返すが, 各特徴量はshardのview(コピーなし).
+    sent_durationは, packされていない or indexにない場合Noneを返す.
+
+    Args:
+        utt_ids: List of utterance ids
+        in_feats: Dict of packed source features. keys: mel, pitch, energy, sent_duration
+        out_feats: Dict of packed target features. keys: mel, pitch, energy, duration, sent_duration
+    """
+
+    def __init__(self, utt_ids: List[str], in_feats: Dict, out_feats: Dict):
+        self.utt_ids = utt_ids
+        self.in_feats = in_feats
+        self.out_feats = out_feats
+
+    def _get_sent_duration(self, feats: Dict, utt_id: str):
+        if feats["sent_duration"] is None:
+            return None
+        return feats["sent_duration"].get(utt_id)
+
+    def __getitem__(self, idx: int):
+        utt_id = self.utt_ids[idx]
+        return (
+            utt_id,
+            self.in_feats["mel"][utt_id],
+            self.in_feats["pitch"][utt_id],
+            self.in_feats["energy"][utt_id],
+            self._get_sent_duration(self.in_feats, utt_id),
+            self.out_feats["mel"][utt_id],
+            self.out_feats["pitch"][utt_id],
+            self.out_feats["energy"][utt_id],
+            self.out_feats["duration"][utt_id],
+            self._get_sent_duration(self.out_feats, utt_id),
+        )
+
+    def __len__(self):
+        return len(self.utt_ids)
+
+
 def fastspeech2VC_get_data_loaders(data_config: Dict, collate_fn: Callable) -> Dict[str, data_utils.DataLoader]:
     """Get data loaders for training and validation.
 
@@ -85,36 +130,64 @@ def fastspeech2VC_get_data_loaders(data_config: Dict, collate_fn: Callable) -> D
         utt_ids = load_utt_list(to_absolute_path(data_config[phase].utt_list))
         in_dir = Path(to_absolute_path(data_config[phase].in_dir))
         out_dir = Path(to_absolute_path(data_config[phase].out_dir))
+        bucketing = data_config.get("bucketing", False)  # type: ignore
+        # 前処理で作った発話長のindexがあれば, 特徴量を開かずに長さが分かる.
+        length_index_path = find_length_index([in_dir, out_dir]) if bucketing else None
+        need_lengths = bucketing and length_index_path is None
 
-        in_mel_paths = [in_dir / "mel" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        in_pitch_paths = [in_dir / "pitch" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        in_energy_paths = [in_dir / "energy" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        in_sent_duration_dir = [in_dir / "sent_duration" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        out_mel_paths = [out_dir / "mel" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        out_pitch_paths = [out_dir / "pitch" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        out_energy_paths = [out_dir / "energy" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        out_duration_paths = [out_dir / "duration" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        out_sent_duration_dir = [out_dir / "sent_duration" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-
-        dataset = fastspeech2VC_Dataset(
-            in_mel_paths,
-            in_pitch_paths,
-            in_energy_paths,
-            in_sent_duration_dir,
-            out_mel_paths,
-            out_pitch_paths,
-            out_energy_paths,
-            out_duration_paths,
-            out_sent_duration_dir,
-        )
-        data_loaders[phase] = data_utils.DataLoader(
-            dataset,
-            batch_size=data_config.batch_size * data_config.group_size,  # type: ignore
-            collate_fn=collate_fn,
-            pin_memory=True,
-            num_workers=data_config.num_workers,  # type: ignore
-            shuffle=phase.startswith("train"),  # trainならTrue
-        )
+        if data_config.get("packed", False):  # type: ignore
+            def _packed_feats(feat_dir, names):
+                return {
+                    name: PackedFeatures(feat_dir / name) if is_packed(feat_dir / name) else None
+                    for name in names
+                }
+            dataset = fastspeech2VC_PackedDataset(
+                utt_ids,
+                _packed_feats(in_dir, ["mel", "pitch", "energy", "sent_duration"]),
+                _packed_feats(out_dir, ["mel", "pitch", "energy", "duration", "sent_duration"]),
+            )
+            # collateでsortに使うのはsourceのmelの長さ.
+            lengths = [
+                max(dataset.in_feats["mel"].length(utt_id), dataset.out_feats["mel"].length(utt_id))
+                for utt_id in utt_ids
+            ] if need_lengths else None
+        else:
+            in_mel_paths = [in_dir / "mel" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            in_pitch_paths = [in_dir / "pitch" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            in_energy_paths = [in_dir / "energy" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            in_sent_duration_dir = [in_dir / "sent_duration" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            out_mel_paths = [out_dir / "mel" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            out_pitch_paths = [out_dir / "pitch" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            out_energy_paths = [out_dir / "energy" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            out_duration_paths = [out_dir / "duration" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            out_sent_duration_dir = [out_dir / "sent_duration" / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+
+            dataset = fastspeech2VC_Dataset(
+                in_mel_paths,
+                in_pitch_paths,
+                in_energy_paths,
+                in_sent_duration_dir,
+                out_mel_paths,
+                out_pitch_paths,
+                out_energy_paths,
+                out_duration_paths,
+                out_sent_duration_dir,
+            )
+            # indexがない場合のみ, npyのheaderから長さを読む.
+            lengths = [
+                max(np.load(in_path, mmap_mode="r").shape[0], np.load(out_path, mmap_mode="r").shape[0])
+                for in_path, out_path in zip(in_mel_paths, out_mel_paths)
+            ] if need_lengths else None
+        if length_index_path is not None:
+            # text_lenにはsourceの, mel_lenにはtargetのmel長が入っている.
+            length_index = load_length_index(length_index_path)
+            lengths = [max(length_index[utt_id].text_len, length_index[utt_id].mel_len) for utt_id in utt_ids]
+        # scaler_dirがあれば, orgの特徴量をcollateでまとめて正規化する.
+        phase_collate_fn = get_normalized_collate_fn(data_config, collate_fn, {
+            1: f"{in_dir.name}_mel", 2: f"{in_dir.name}_pitch", 3: f"{in_dir.name}_energy",
+            5: f"{out_dir.name}_mel", 6: f"{out_dir.name}_pitch", 7: f"{out_dir.name}_energy",
+        })
+        data_loaders[phase] = get_data_loader(data_config, dataset, phase_collate_fn, phase, lengths)
 
     return data_loaders
 
@@ -184,23 +257,19 @@ def reprocess(batch, idxs, speaker_dict, emotion_dict):
     )
 
 
-def collate_fn_fastspeech2VC(batch, batch_size, speaker_dict=None, emotion_dict=None):
+def collate_fn_fastspeech2VC(batch, batch_size, speaker_dict=None, emotion_dict=None, max_frames=None):
     """Collate function for Tacotron.
     Args:
         batch (list): List of tuples of the form (inputs, targets).
         Datasetのreturnが1単位となって, それがbatch_size分入って渡される.
+        max_frames (int): sub-batchあたりのpadding込み最大長. LengthBucketBatchSamplerと同じ値を渡す.
     Returns:
         tuple: Batch of inputs, input lengths, targets, target lengths and stop flags.
     """
-    # shape[0]がtimeになるようなindexを指定する.
-    len_arr = np.array([batch[idx][1].shape[0] for idx in range(len(batch))])
+    # shape[0]がtimeになるようなindexを指定する. source, targetの長い方のmel長で区切る (samplerと同じ).
+    len_arr = np.array([max(batch[idx][1].shape[0], batch[idx][5].shape[0]) for idx in range(len(batch))])
     # 以下固定
-    idx_arr = np.argsort(-len_arr)
-    tail = idx_arr[len(idx_arr) - (len(idx_arr) % batch_size):]
-    idx_arr = idx_arr[: len(idx_arr) - (len(idx_arr) % batch_size)]
-    idx_arr = idx_arr.reshape((-1, batch_size)).tolist()
-    if len(tail) > 0:
-        idx_arr += [tail.tolist()]
+    idx_arr = split_by_budget(len_arr, batch_size, max_frames)
     output = list()
 
     # 以下, reprocessへの引数が変更の余地あり.
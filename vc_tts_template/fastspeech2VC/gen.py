@@ -2,10 +2,13 @@ import numpy as np
 import torch
 from pathlib import Path
 
+from vc_tts_template.normalization import normalize_arrays
+
 
 @torch.no_grad()
 def synthesis(device, data, speaker_dict, emotion_dict, acoustic_model,
-              acoustic_out_scaler, vocoder_model):
+              acoustic_out_scaler, vocoder_model, in_scalers=None):
+    """in_scalers: source の mel, pitch, energy の scaler. 与えた場合 data は org の特徴量として正規化する."""
 
     ids = [Path(data[0]).name.replace("-feats.npy", "")]
     if speaker_dict is None:
@@ -20,9 +23,13 @@ def synthesis(device, data, speaker_dict, emotion_dict, acoustic_model,
     else:
         s_emotions = np.array([emotion_dict[fname.split("_")[-2]] for fname in ids])
         t_emotions = np.array([emotion_dict[fname.split("_")[-1]] for fname in ids])
-    s_mels = np.array([np.load(data[0])])
-    s_pitches = np.array([np.load(data[1])])
-    s_energies = np.array([np.load(data[2])])
+    s_feats = [np.load(data[0]), np.load(data[1]), np.load(data[2])]
+    if in_scalers is not None:
+        # 学習時のcollateと同じ正規化.
+        s_feats = [normalize_arrays([x], scaler)[0] for x, scaler in zip(s_feats, in_scalers)]
+    s_mels = np.array([s_feats[0]])
+    s_pitches = np.array([s_feats[1]])
+    s_energies = np.array([s_feats[2]])
 
     s_mel_lens = np.array([s_mels[0].shape[0]])
     max_s_mel_len = max(s_mel_lens)
@@ -72,12 +72,12 @@ class FastSpeech2VCLoss(nn.Module):
         total_loss = mel_loss + postnet_mel_loss + duration_loss + pitch_loss + energy_loss
 
         loss_values = {
-            "mel_loss": mel_loss.item(),
-            "postnet_mel_loss": postnet_mel_loss.item(),
-            "pitch_loss": pitch_loss.item(),
-            "energy_loss": energy_loss.item(),
-            "duration_loss": duration_loss.item(),
-            "total_loss": total_loss.item()
+            "mel_loss": mel_loss.detach(),
+            "postnet_mel_loss": postnet_mel_loss.detach(),
+            "pitch_loss": pitch_loss.detach(),
+            "energy_loss": energy_loss.detach(),
+            "duration_loss": duration_loss.detach(),
+            "total_loss": total_loss.detach()
         }
 
         return total_loss, loss_values
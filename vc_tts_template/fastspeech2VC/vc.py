@@ -9,12 +9,13 @@ import torch
 from hydra.utils import instantiate
 from omegaconf import OmegaConf
 import pyworld as pw
-from scipy.interpolate import interp1d
 
 sys.path.append('..')
 from vc_tts_template.dsp import logmelspectrogram
 from vc_tts_template.pretrained import retrieve_pretrained_model
+from vc_tts_template.prosody import interp_unvoiced
 from vc_tts_template.utils import StandardScaler
+from vc_tts_template.vocoder.hifigan.stream import vocode_stream
 
 
 class FastSpeech2VC(object):
@@ -148,10 +149,41 @@ Vocoder model: {wavenet_str}
         Returns:
             tuple: audio array (np.int16) and sampling rate (int)
         """
+        mels = self._vc_mel(wav, wav_sr, s_speaker, t_speaker, s_emotion, t_emotion, s_sent_durations)
+        wav = self.vocoder_model(mels.transpose(1, 2)).squeeze(1).cpu().data.numpy()[0]
+
+        return self.post_process(wav), self.sample_rate
+
+    @torch.no_grad()
+    def vc_stream(self,
+                  wav, wav_sr,
+                  s_speaker=None, t_speaker=None,
+                  s_emotion=None, t_emotion=None,
+                  s_sent_durations=None,
+                  chunk_frames=64,
+                  ):
+        """Run VC and vocode the mel chunk by chunk
+
+        音響モデルは一度に実行し, vocoderだけchunk_framesずつ受容野分の文脈を付けて実行する.
+        連結した波形はvc()と(浮動小数点の誤差を除き)一致する.
+
+        Args:
+            wav (np.ndarray): Input waveform
+            wav_sr (int): Sampling rate of wav
+            chunk_frames (int): Number of mel frames vocoded at once.
+
+        Yields:
+            np.ndarray: audio block (np.int16) of chunk_frames * hop_size samples
+        """
+        mels = self._vc_mel(wav, wav_sr, s_speaker, t_speaker, s_emotion, t_emotion, s_sent_durations)
+        for wav in vocode_stream(self.vocoder_model, mels.transpose(1, 2), chunk_frames):
+            yield self.post_process(wav.cpu().data.numpy())
+
+    def _vc_mel(self, wav, wav_sr, s_speaker, t_speaker, s_emotion, t_emotion, s_sent_durations):
         # OpenJTalkを用いて言語特徴量の抽出
         if wav.dtype in [np.int16, np.int32]:
             wav = (wav / np.iinfo(wav.dtype).max).astype(np.float64)
-        wav = librosa.resample(wav, wav_sr, self.sample_rate)
+        wav = librosa.resample(wav, orig_sr=wav_sr, target_sr=self.sample_rate)
         s_mel, s_energy = self.get_mel(wav)
         s_pitch, t = self.get_pitch(wav.astype(np.float64))
         s_pitch = pw.stonemask(wav.astype(np.float64),
@@ -159,14 +191,7 @@ Vocoder model: {wavenet_str}
         s_energy = np.log(s_energy+1e-6)
 
         if self.is_continuous_pitch is True:
-            nonzero_ids = np.where(s_energy > -5.0)[0]
-            interp_fn = interp1d(
-                nonzero_ids,
-                s_pitch[nonzero_ids],
-                fill_value=(s_pitch[nonzero_ids[0]], s_pitch[nonzero_ids[-1]]),
-                bounds_error=False,
-            )
-            s_pitch = interp_fn(np.arange(0, len(s_pitch)))
+            s_pitch = interp_unvoiced(s_pitch, voiced=s_energy > -5.0)
 
         s_pitch = np.log(s_pitch+1e-6)
         s_mel = self.acoustic_in_mel_scaler.transform(s_mel)
@@ -215,10 +240,7 @@ Vocoder model: {wavenet_str}
 
         mel_post = output[1]
         mels = [self.acoustic_out_scaler.inverse_transform(mel.cpu().data.numpy()) for mel in mel_post]  # type: ignore
-        mels = torch.Tensor(np.array(mels)).to(self.device)
-        wav = self.vocoder_model(mels.transpose(1, 2)).squeeze(1).cpu().data.numpy()[0]
-
-        return self.post_process(wav), self.sample_rate
+        return torch.Tensor(np.array(mels)).to(self.device)
 
     def post_process(self, wav):
         wav = np.clip(wav, -1.0, 1.0)
@@ -53,9 +53,17 @@ class ConvBNorms2d(nn.Module):
             ]
         self.convolutions = nn.Sequential(*self.convolutions)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         # expected (B, C, H, W)
-        return self.convolutions(x)
+        if mask is None:
+            return self.convolutions(x)
+        # mask: (B, 1, H, 1) or broadcastable. Trueの位置(padding)を各層の後で0に戻す.
+        # こうしないと2層目以降でpaddingの値が有効な部分に漏れ, 結果がpaddingの量に依存する.
+        for layer in self.convolutions:
+            x = layer(x)
+            if isinstance(layer, nn.ReLU):
+                x = x.masked_fill(mask, 0.0)
+        return x
 
 
 class ConvLNorms1d(nn.Module):
@@ -1,6 +1,5 @@
 import sys
 
-import numpy as np
 import torch
 import torch.nn as nn
 from torch.distributions import Normal, OneHotCategorical
@@ -9,8 +8,6 @@ from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 sys.path.append("../..")
 from vc_tts_template.fastspeech2wGMM.layers import ConvBNorms2d, ConvLNorms1d
 from vc_tts_template.tacotron.decoder import ZoneOutCell
-from vc_tts_template.utils import pad
-from vc_tts_template.train_utils import free_tensors_memory
 
 
 def encoder_init(m):
@@ -60,24 +57,18 @@ class ProsodyExtractor(nn.Module):
             if self.global_prosody is True:
                 return None, None
             return None
-        durations = durations.detach().cpu().numpy()  # detach
-        output_sorted, src_lens_sorted, segment_nums, inv_sort_idx = self.mel2phone(mels, durations)
-        free_tensors_memory([durations])
-        outs = list()
-        for output, src_lens in zip(output_sorted, src_lens_sorted):
-            # output: (B, T_n, d_mel). T_n: length of phoneme
-            # convolution
-            mel_hidden = self.convnorms(output.unsqueeze(1))
-            # Bi-GRU
-            mel_hidden = pack_padded_sequence(mel_hidden.squeeze(1), src_lens, batch_first=True)
-            out, _ = self.bi_gru(mel_hidden)
-            # out: (B, T_n, d_out)
-            out, _ = pad_packed_sequence(out, batch_first=True)
-            outs.append(out[:, -1, :])  # use last time
-        free_tensors_memory([output_sorted, src_lens_sorted])
-        outs = torch.cat(outs, 0)
-        out = self.phone2utter(outs[inv_sort_idx], segment_nums)
-        free_tensors_memory([outs])
+        # segments: (S, T_max, d_mel). S: 全発話の音素数の合計. T_max: 最長の音素長
+        segments, seg_lens, pad_mask, valid = self.mel2phone(mels, durations)
+        # convolution
+        mel_hidden = self.convnorms(segments.unsqueeze(1), pad_mask.unsqueeze(1).unsqueeze(-1)).squeeze(1)
+        # Bi-GRU. 全音素をまとめて1回で流す. sortはpack_padded_sequenceに任せる.
+        mel_hidden = pack_padded_sequence(mel_hidden, seg_lens, batch_first=True, enforce_sorted=False)
+        out, _ = self.bi_gru(mel_hidden)
+        # out: (S, T_max, d_out)
+        out, _ = pad_packed_sequence(out, batch_first=True)
+        # use last time. padding部分ではなく, 各音素の最後のframeを取る.
+        outs = out[torch.arange(out.size(0), device=out.device), seg_lens.to(out.device) - 1]
+        out = self.phone2utter(outs, valid)
 
         if self.global_prosody is True:
             # global_emb: (B, d_out)
@@ -89,56 +80,47 @@ class ProsodyExtractor(nn.Module):
     def mel2phone(self, mels, durations):
         """
         melをphone単位のsegmentに分割
-        長い順に降順ソートして, batch_sizeごとにまとめている
-        降順sortはpack_padded_sequenceの要請. batch_sizeごとにまとめたのはpadの量を削減するため
+        durationの累積和から各音素の開始位置を求め, 全音素のsegmentを1回のgatherで切り出す.
+        pack_padded_sequenceに渡す長さはCPUに必要なので, durationのCPU転送はここでの1回のみ.
+
+        Args:
+            mels (torch.Tensor): (B, T, d_mel)
+            durations (torch.Tensor): (B, N). 0はpaddingで, 最初の0以降は無視する.
+
+        Returns:
+            tuple: segments (S, T_max, d_mel), CPU上の音素長 (S,), paddingのmask (S, T_max),
+                有効な音素のmask (B, N)
         """
-        output = list()
-        src_lens = list()
-        segment_nums = list()
-        # devide mel into phone segments
-        for mel, duration in zip(mels, durations):
-            s_idx = 0
-            cnt = 0
-            for d in duration:
-                if d == 0:
-                    # d = 0 is only allowed for pad
-                    break
-                mel_seg = mel[s_idx: s_idx+d]
-                s_idx += d
-                cnt += 1
-                output.append(mel_seg)
-                src_lens.append(d)
-            segment_nums.append(cnt)
-
-        sort_idx = np.argsort(-np.array(src_lens))
-        inv_sort_idx = np.argsort(sort_idx)
-        # Regroup phoneme segments into batch sizes.
-        batch_size = mels.size(0)
-        output_sorted = list()
-        src_lens_sorted = list()
-        for i in range(len(output) // batch_size):
-            sort_seg = sort_idx[i*batch_size:(i+1)*batch_size]
-            if i == ((len(output) // batch_size) - 1):
-                # This is a way to avoid setting batch_size=1 when doing BN.
-                sort_seg = sort_idx[i*batch_size:]
-            output_seg = [output[idx] for idx in sort_seg]
-            src_lens_seg = [src_lens[idx] for idx in sort_seg]
-            output_seg = pad(output_seg)
-            output_sorted.append(output_seg)
-            src_lens_sorted.append(src_lens_seg)
-        free_tensors_memory([output])
-        return output_sorted, src_lens_sorted, segment_nums, inv_sort_idx
-
-    def phone2utter(self, out, segment_nums):
+        durations = durations.detach().cpu()  # detach
+        # d = 0 is only allowed for pad
+        valid = torch.cumprod((durations > 0).long(), dim=1).bool()
+        starts = torch.cumsum(durations, dim=1) - durations
+
+        seg_lens = durations[valid]
+        seg_starts = starts[valid]
+        seg_batch = torch.arange(durations.size(0)).unsqueeze(1).expand_as(durations)[valid]
+
+        # (S, T_max): 各音素のframe index. 音素長を超える部分はmaskして0にする.
+        frame_idx = torch.arange(int(seg_lens.max()))
+        pad_mask = frame_idx.unsqueeze(0) >= seg_lens.unsqueeze(1)
+        frame_idx = (seg_starts.unsqueeze(1) + frame_idx.unsqueeze(0)).masked_fill(pad_mask, 0)
+
+        device = mels.device
+        pad_mask = pad_mask.to(device)
+        segments = mels[seg_batch.to(device).unsqueeze(1), frame_idx.to(device)]
+        segments = segments.masked_fill(pad_mask.unsqueeze(-1), 0.0)
+        return segments, seg_lens, pad_mask, valid
+
+    def phone2utter(self, out, valid):
         """
         音素ごとのmel segmentを, utteranceごとにまとめ直す
+        validは行優先でsegmentを切り出したときと同じ並びなので, そのままscatterできる.
         """
-        output = list()
-        s_idx = 0
-        for seg_num in segment_nums:
-            output.append(out[s_idx:s_idx+seg_num])
-            s_idx += seg_num
-        return pad(output)
+        n_max = int(valid.sum(dim=1).max())
+        valid = valid[:, :n_max].to(out.device)
+        output = out.new_zeros(valid.size(0), n_max, out.size(-1))
+        output[valid] = out
+        return output
 
 
 class ProsodyPredictor(nn.Module):
@@ -0,0 +1,114 @@
+from typing import Dict, List, Optional, Tuple
+
+import optuna
+import torch
+
+
+def grad_norms(grads: List[torch.Tensor]) -> torch.Tensor:
+    """L2 norm of each gradient as one tensor on the device.
+
+    torch._foreach_normがあれば全parameterを数回のkernelでまとめて計算する. どちらでもCPUとの同期はしない.
+
+    Args:
+        grads: Gradients.
+
+    Returns:
+        torch.Tensor: Norms of shape (len(grads),).
+    """
+    if len(grads) == 0:
+        return torch.zeros(0)
+    if hasattr(torch, "_foreach_norm"):
+        norms = torch._foreach_norm(grads)
+    else:
+        norms = [g.norm() for g in grads]
+    return torch.stack([n.float() for n in norms])
+
+
+class GradHealthMonitor():
+    """AMP実装の為に, grad_infのparamを特定できるようにするクラス (check_grad_flowの置き換え).
+
+    仮定(設計)はcheck_grad_flowと同じ.
+        - (train step内) grad norm が NaNとなっていいのは, AMP時だけ.
+            それ以外はモデルのバグなのでraise error
+        - (self.report内) infのparamがないのにreport呼び出し(つまりgrad norm is NaN)は,
+            lossにNaNがあったということ.
+            - これに関しては, AMPだとしてもよろしくないので, raise error.
+            - 但し, optuna中であれば, パラメタが悪い(lossが発散に向かっているということ)なので, pruned
+
+    check_grad_flowは毎step全parameterの ``grad.abs().mean().cpu()`` を求めていて, parameterの数だけ同期していた.
+    ここでは ``set_params`` でparameterごとのnormをdevice上でまとめて計算して持っておくだけにし,
+    clip_grad_norm_が非有限を返して ``report`` が呼ばれたときにだけCPUに移して調べる.
+    clip_grad_norm_は非有限のnormでgradを上書きしてしまうので, normはclipの前に求めておく必要がある.
+
+    Args:
+        logger: Logger.
+        interval: Compute per-parameter norms every ``interval`` steps. 0なら計算しない.
+            計算しなかったstepでreportされた場合は, clip後のgradから非有限のparameterを探す.
+        only_inf_grad: Report only parameters with inf gradients. Falseなら全parameterのnormを出す.
+    """
+    def __init__(self, logger, interval: int = 1, only_inf_grad: bool = True) -> None:
+        self.logger = logger
+        self.interval = interval
+        self.only_inf_grad = only_inf_grad
+        self.num_step = 0
+        self._named_params: List[Tuple[str, torch.nn.Parameter]] = []
+        self._norms: Optional[torch.Tensor] = None
+
+    def set_params(self, named_parameters):
+        """Record gradients after backward and before unscale_/clip_grad_norm_. 同期しない."""
+        self.num_step += 1
+        # gradそのものは持たない (zero_gradで解放されるはずのmemoryを残さない).
+        self._named_params = [
+            (n, p) for n, p in named_parameters if p.requires_grad is True and p.grad is not None
+        ]
+        self._norms = None
+        if self.interval > 0 and self.num_step % self.interval == 0:
+            self._norms = grad_norms([p.grad.detach() for _, p in self._named_params])
+
+    def _param_norms(self) -> Dict[str, float]:
+        if self._norms is not None:
+            norms = self._norms.cpu()
+            bad = torch.isinf(norms)
+        else:
+            # clip後はinfのgradがNaNになっているので, 非有限のものを探す.
+            norms = grad_norms([p.grad.detach() for _, p in self._named_params]).cpu()
+            bad = ~torch.isfinite(norms)
+        return {
+            f"steps: {self.num_step}, param_name: " + n: float(norm)
+            for (n, _), norm, b in zip(self._named_params, norms, bad)
+            if (self.only_inf_grad is False) or b
+        }
+
+    def report(self, loss_values=None, trial=False):
+        """Log per-parameter diagnostics. Call only when the grad norm is not finite."""
+        model_params = self._param_norms()
+        if (len(model_params) == 0) and (loss_values is not None):
+            self.logger.warning(
+                "Maybe the losses is NaN!! check log"
+            )
+            self._report_dict(loss_values, add_step=True)
+            if trial is False:
+                raise ValueError("loss value error")
+            else:
+                raise optuna.TrialPruned()
+
+        self._report_dict(loss_values)
+        self._report_dict(model_params)
+        self._reset()
+
+    def _reset(self):
+        self._named_params = []
+        self._norms = None
+
+    def _report_dict(self, dict_, add_step=False, mode="debug"):
+        if dict_ is not None:
+            for k, v in dict_.items():
+                # loss_valuesは0次元のtensorで渡される (report時にだけCPUに移す).
+                if isinstance(v, torch.Tensor) and v.numel() == 1:
+                    v = v.item()
+                if add_step is True:
+                    k = f"steps: {self.num_step}, " + k
+                if mode == "debug":
+                    self.logger.debug(f"{k}: {v}")
+                else:
+                    self.logger.info(f"{k}: {v}")
@@ -0,0 +1,67 @@
+from pathlib import Path
+from typing import Dict, Iterable, NamedTuple, Optional, Union
+
+LENGTH_INDEX_NAME = "lengths.tsv"
+_COLUMNS = ["utt_id", "text_len", "mel_len", "speaker", "emotion"]
+
+
+class UttLength(NamedTuple):
+    """One row of the length index.
+
+    fastspeech2VCではtext_lenにsourceのmel長, mel_lenにtargetのmel長を入れる.
+    speaker, emotionは出力側(VCならtarget)のもの.
+    """
+    text_len: int
+    mel_len: int
+    speaker: str
+    emotion: str
+
+
+def write_length_index(path: Union[str, Path], index: Dict[str, UttLength]) -> None:
+    """Write a length index as a tsv file.
+
+    Args:
+        path: Output path. Usually ``dump/xxx/org/{split}/lengths.tsv``.
+        index: Mapping from utt_id to its lengths.
+    """
+    with open(path, "w") as f:
+        f.write("\t".join(_COLUMNS) + "\n")
+        for utt_id, row in index.items():
+            f.write("\t".join([utt_id] + [str(v) for v in row]) + "\n")
+
+
+def load_length_index(path: Union[str, Path]) -> Dict[str, UttLength]:
+    """Load a length index written by :func:`write_length_index`.
+
+    Args:
+        path: Path to the index.
+
+    Returns:
+        dict: Mapping from utt_id to its lengths.
+    """
+    index = {}
+    with open(path) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        assert header == _COLUMNS, f"{path}: unexpected header {header}"
+        for line in f:
+            utt_id, text_len, mel_len, speaker, emotion = line.rstrip("\n").split("\t")
+            index[utt_id] = UttLength(int(text_len), int(mel_len), speaker, emotion)
+    return index
+
+
+def find_length_index(feat_dirs: Iterable[Path]) -> Optional[Path]:
+    """Find the length index of a split from its feature directories.
+
+    indexはsplitのdirectory (in_xxx, out_xxxの親) に置かれるので, その親を順に探す.
+
+    Args:
+        feat_dirs: Feature directories such as ``dump/xxx/org/train/in_fastspeech2``.
+
+    Returns:
+        Path: Path to the index, or None if not found.
+    """
+    for feat_dir in feat_dirs:
+        path = Path(feat_dir).parent / LENGTH_INDEX_NAME
+        if path.exists():
+            return path
+    return None
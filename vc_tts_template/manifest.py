@@ -0,0 +1,330 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from vc_tts_template.length_index import UttLength
+from vc_tts_template.moments import Moments, compute_moments
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def params_hash(params: Dict[str, Any]) -> str:
+    """Hash of preprocessing parameters (順序によらない)."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def params_from_args(args, exclude: Iterable[str]) -> Dict[str, Any]:
+    """Parameters from argparse arguments except for paths and the number of jobs.
+
+    Args:
+        args: Parsed arguments.
+        exclude: Names that do not change outputs, such as ``n_jobs`` and input/output roots.
+
+    Returns:
+        dict: Parameters.
+    """
+    exclude = set(exclude)
+    return {k: v for k, v in vars(args).items() if k not in exclude}
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def input_record(path: Union[str, Path], old: Optional[dict] = None, digest: bool = True) -> dict:
+    """Size, mtime and sha1 of an input file.
+
+    Args:
+        path: Input file.
+        old: Previous record. size, mtimeが同じならsha1は計算し直さずにそのまま返す.
+        digest: Compute sha1. Falseならsize, mtimeだけ記録する (変わったら作り直しになる).
+
+    Returns:
+        dict: Record of the input.
+    """
+    st = os.stat(path)
+    if old is not None and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+        return old
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": file_digest(path) if digest else None}
+
+
+def input_records(
+    inputs: Sequence[Union[str, Path]], old: Optional[Dict[str, dict]] = None, digest: bool = True
+) -> Dict[str, dict]:
+    """Records of input files keyed by path. ``old`` is the ``inputs`` of the previous manifest entry."""
+    old = old if old is not None else {}
+    return {str(p): input_record(p, old.get(str(p)), digest) for p in inputs}
+
+
+def load_manifest(path: Union[str, Path]) -> Dict[str, dict]:
+    """Load a manifest written by :class:`Manifest`.
+
+    同じ発話が複数回あれば後のものを使う. 書き込み途中で止まった最後の行は読み飛ばす.
+
+    Args:
+        path: Path to the manifest.
+
+    Returns:
+        dict: Mapping from utt_id to its entry.
+    """
+    entries: Dict[str, dict] = {}
+    if not Path(path).exists():
+        return entries
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries[entry["utt_id"]] = entry
+    return entries
+
+
+def load_manifests(paths: Iterable[Union[str, Path]]) -> Dict[str, dict]:
+    """Load and merge several manifests (train, dev, eval等)."""
+    entries: Dict[str, dict] = {}
+    for path in sorted(paths):
+        entries.update(load_manifest(path))
+    return entries
+
+
+def find_manifest(feat_dir: Union[str, Path]) -> Optional[Path]:
+    """Find the manifest of a split from a feature directory.
+
+    manifestはsplitのdirectoryに置かれるので, ``{split}/in_xxx`` と ``{split}/out_xxx/mel`` のどちらからでも探す.
+    """
+    for parent in list(Path(feat_dir).parents)[:2]:
+        path = parent / MANIFEST_NAME
+        if path.exists():
+            return path
+    return None
+
+
+def write_manifest(path: Union[str, Path], entries: Dict[str, dict]) -> None:
+    """Write entries as a manifest. 一時fileに書いてからrenameするので, 途中で止まっても壊れない."""
+    path = Path(path)
+    tmp_path = path.parent / f"{path.name}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        for entry in entries.values():
+            f.write(json.dumps(entry) + "\n")
+    os.replace(tmp_path, path)
+
+
+class Manifest:
+    """Per-utterance record of a preprocessing run.
+
+    splitのdirectoryに, 1発話1行のjsonlとして以下を記録する.
+
+    - inputs: 入力ファイルごとの size, mtime, sha1
+    - params: 前処理のパラメータのhash
+    - outputs: 出力ファイルのpath (manifestのdirectoryからの相対path)
+    - stats: 発話ごとの統計量 (pitchの最小値, 長さなど)
+    - moments: 特徴量ごとの平均と分散の元 (fit_scaler.py --manifest で使う)
+
+    1発話終わるごとに追記するので, 途中で止まってもそれまでの発話は再実行時に飛ばせる.
+    入力のsize, mtimeが変わっていなければsha1は計算し直さない. sha1とmomentsは :class:`RecordingJob` がworkerで求める.
+
+    Args:
+        path: Path to the manifest. Usually ``dump/xxx/org/{split}/manifest.jsonl``.
+        params: Preprocessing parameters. 変わると全発話が作り直しになる.
+    """
+
+    def __init__(self, path: Union[str, Path], params: Dict[str, Any]):
+        self.path = Path(path)
+        self.root = self.path.parent
+        self.params_hash = params_hash(params)
+        self.entries = load_manifest(self.path)
+
+    def task(self, utt_id: str, inputs: Sequence[Path]) -> Tuple[str, tuple]:
+        """Task of :func:`recipes.common.preprocess_runner.run_preprocess` for a :class:`RecordingJob`.
+
+        前回の入力の記録も渡すので, size, mtimeが変わっていなければworkerでもsha1を計算し直さない.
+        """
+        entry = self.entries.get(utt_id)
+        return utt_id, (utt_id, tuple(inputs), None if entry is None else entry["inputs"])
+
+    def is_up_to_date(self, utt_id: str, inputs: Sequence[Path]) -> bool:
+        """Whether the outputs of ``utt_id`` can be reused.
+
+        Args:
+            utt_id: Utterance id.
+            inputs: Input files.
+
+        Returns:
+            bool: True if the parameters and the contents of the inputs are unchanged and all outputs exist.
+        """
+        entry = self.entries.get(utt_id)
+        if entry is None or entry["params"] != self.params_hash:
+            return False
+        # 例外で失敗した発話は次の実行でやり直す.
+        if entry.get("error") is not None:
+            return False
+        if sorted(entry["inputs"].keys()) != sorted(str(p) for p in inputs):
+            return False
+        for path in inputs:
+            old = entry["inputs"][str(path)]
+            if not Path(path).exists() or input_record(path, old)["sha1"] != old["sha1"]:
+                return False
+        return all((self.root / rel).exists() for rel in entry["outputs"].values())
+
+    def add(
+        self,
+        utt_id: str,
+        inputs: Sequence[Path],
+        outputs: Dict[str, Path],
+        stats: Optional[Dict[str, Any]] = None,
+        failed: bool = False,
+        error: Optional[str] = None,
+        recorded: Optional["RecordedResult"] = None,
+    ) -> None:
+        """Record a processed utterance.
+
+        入力のsha1や出力のmomentsは ``recorded`` (workerで求めたもの) を使い, ここではfileを読まない.
+
+        Args:
+            utt_id: Utterance id.
+            inputs: Input files.
+            outputs: Mapping from a stream name such as ``out_fastspeech2/mel`` to its output file.
+            stats: Per-utterance statistics. json形式で保存できるもの.
+            failed: Whether the utterance was skipped by the preprocessing (出力なし).
+            error: Traceback if the preprocessing raised an exception. failedとして記録し, 再実行時にやり直す.
+            recorded: Returned by :class:`RecordingJob`. Noneならsize, mtimeだけ記録し, momentsは記録しない.
+        """
+        if recorded is not None:
+            records, moments = recorded.inputs, recorded.moments
+        else:
+            # 例外で失敗した発話は次の実行でやり直すので, sha1は要らない.
+            records, moments = input_records(inputs, digest=False), {}
+        entry = {
+            "utt_id": utt_id,
+            "params": self.params_hash,
+            "inputs": records,
+            "outputs": {key: os.path.relpath(path, self.root) for key, path in outputs.items()},
+            "stats": stats if stats is not None else {},
+            "moments": moments,
+            "failed": failed or error is not None,
+            "error": error,
+        }
+        self.entries[utt_id] = entry
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+
+    def compact(self, utt_ids: Sequence[str]) -> None:
+        """Rewrite the manifest with only the latest entries of ``utt_ids``.
+
+        utt_listから外れた発話は, 全体の統計量に入らないように消す.
+        """
+        self.entries = {utt_id: self.entries[utt_id] for utt_id in utt_ids if utt_id in self.entries}
+        write_manifest(self.path, self.entries)
+
+
+def feats_outputs(root: Path, utt_id: str, keys: Sequence[str]) -> Dict[str, Path]:
+    """``{root}/{key}/{utt_id}-feats.npy`` for each stream name."""
+    return {key: Path(root) / key / f"{utt_id}-feats.npy" for key in keys}
+
+
+class RecordedResult(NamedTuple):
+    """Result of :class:`RecordingJob`.
+
+    result: 前処理関数の返り値, inputs: 入力の記録, moments: 出力のmoments.
+    """
+    result: Any
+    inputs: Dict[str, dict]
+    moments: Dict[str, List]
+
+
+class RecordingJob:
+    """Wrap a preprocessing function so that workers also compute what :meth:`Manifest.add` records.
+
+    入力のsha1と出力のmomentsをmain processで求めると, 全発話のfileを順番に読み直すことになり,
+    workerが並列に処理していても律速になる. ここではworkerで前処理の直後に求めて, 返り値と一緒に返す.
+    :meth:`Manifest.task` で作ったtaskを渡す.
+
+    Args:
+        fn: Preprocessing function called as ``fn(*inputs)``. Must be picklable.
+        out_root: Split directory. 出力は ``{out_root}/{stream}/{utt_id}-feats.npy``.
+        moment_keys: Streams whose moments are recorded.
+        has_outputs: Called with the result of ``fn``. Falseを返した発話 (前処理で飛ばしたもの) は
+            momentsを求めない. Must be picklable. Noneなら常に求める.
+    """
+
+    def __init__(
+        self,
+        fn: Callable,
+        out_root: Union[str, Path],
+        moment_keys: Sequence[str] = (),
+        has_outputs: Optional[Callable[[Any], bool]] = None,
+    ) -> None:
+        self.fn = fn
+        self.out_root = Path(out_root)
+        self.moment_keys = list(moment_keys)
+        self.has_outputs = has_outputs
+
+    def __call__(
+        self, utt_id: str, inputs: Sequence[Path], old_inputs: Optional[Dict[str, dict]] = None
+    ) -> RecordedResult:
+        # 前処理が読んだものと同じ内容を記録するよう, 先に求めておく.
+        records = input_records(inputs, old_inputs)
+        result = self.fn(*inputs)
+        keys = self.moment_keys if self.has_outputs is None or self.has_outputs(result) else []
+        moments = {
+            key: compute_moments(np.load(path)).to_list()
+            for key, path in feats_outputs(self.out_root, utt_id, keys).items()
+        }
+        return RecordedResult(result, records, moments)
+
+
+def stream_moments(entries: Dict[str, dict], utt_ids: Sequence[str], key: str) -> Optional[List[Moments]]:
+    """Recorded moments of a stream for ``utt_ids``.
+
+    前処理で失敗した発話は特徴量がないので数えない.
+
+    Returns:
+        list: Moments of each utterance, or None if some utterances are not recorded.
+    """
+    moments = []
+    for utt_id in utt_ids:
+        entry = entries.get(utt_id)
+        if entry is not None and entry["failed"]:
+            continue
+        if entry is None or key not in entry["moments"]:
+            return None
+        moments.append(Moments.from_list(entry["moments"][key]))
+    return moments
+
+
+def length_index_from_entries(entries: Dict[str, dict]) -> Dict[str, UttLength]:
+    """Length index of the utterances whose lengths are recorded (失敗した発話は除く)."""
+    return {
+        utt_id: UttLength(*entry["stats"]["length"])
+        for utt_id, entry in entries.items()
+        if not entry["failed"] and entry["stats"].get("length") is not None
+    }
+
+
+def prosody_stats(entries: Dict[str, dict]) -> Optional[Dict[str, float]]:
+    """Min and max of pitch and energy over all utterances (stats.json).
+
+    Returns:
+        dict: ``pitch_min``, ``pitch_max``, ``energy_min`` and ``energy_max``.
+            None if no utterance has them.
+    """
+    utt_stats = [entry["stats"] for entry in entries.values() if not entry["failed"] and "pitch_min" in entry["stats"]]
+    if len(utt_stats) == 0:
+        return None
+    return {
+        "pitch_min": min(s["pitch_min"] for s in utt_stats),
+        "pitch_max": max(s["pitch_max"] for s in utt_stats),
+        "energy_min": min(s["energy_min"] for s in utt_stats),
+        "energy_max": max(s["energy_max"] for s in utt_stats),
+    }
@@ -0,0 +1,188 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Optional, Union
+
+import torch
+
+from vc_tts_template.distributed import all_reduce_means
+
+Value = Union[torch.Tensor, float]
+
+
+def _to_float(v: Value) -> float:
+    return float(v.item()) if isinstance(v, torch.Tensor) else float(v)
+
+
+class _CudaTimer(object):
+    # CUDA eventで区間を記録し, 経過時間は書き込みthreadでeventの完了を待ってから読む.
+    def __init__(self):
+        self.start = torch.cuda.Event(enable_timing=True)
+        self.end = torch.cuda.Event(enable_timing=True)
+
+    def elapsed_ms(self) -> float:
+        self.end.synchronize()
+        return self.start.elapsed_time(self.end)
+
+
+class MetricsAggregator(object):
+    """Accumulate losses and step timings without syncing the training loop.
+
+    loss moduleが返すtensorは ``.item()`` せずにdevice上で足し込み, ``flush_interval`` stepごとに
+    その間の平均をbackgroundのthreadでTensorBoardに書く. CPUとの同期はそのthreadで起きる.
+    epochの平均 (以前の_update_running_losses_) も同じ足し込みから求める.
+
+    時間は ``timer`` で計る. forward, backward, optimizerのようにGPUで実行される区間はCUDA eventで,
+    CPUのみのときやdata待ちは時計で計り, どちらもflush時にstep毎の平均(ms)として ``time/{name}`` に書く.
+
+    Args:
+        writer: SummaryWriter. Noneなら書かない (epochの平均だけ使う場合).
+        flush_interval: Number of steps averaged into one TensorBoard point. 0なら書かない.
+        prefix: Tag prefix of the losses.
+    """
+
+    def __init__(self, writer=None, flush_interval: int = 1, prefix: str = "loss_bystep") -> None:
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.prefix = prefix
+        self.use_cuda_timer = torch.cuda.is_available()
+        self._window: Dict[str, Value] = {}
+        self._window_timers: Dict[str, list] = {}
+        self._window_scalars: Dict[str, float] = {}
+        self._window_steps = 0
+        self._last_step = 0
+        self._epoch: Dict[str, Value] = {}
+        self._epoch_steps = 0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        if writer is not None and flush_interval > 0:
+            self._thread = threading.Thread(target=self._write_loop, daemon=True)
+            self._thread.start()
+
+    @property
+    def writes(self) -> bool:
+        """Whether the window is written to TensorBoard. Falseならepochの平均だけ持つ."""
+        return self._thread is not None
+
+    def update(self, loss_values: Dict[str, Value], step: Optional[int] = None) -> None:
+        """Add the losses of one step.
+
+        Args:
+            loss_values: Losses as 0-dim tensors (detach済み) or floats.
+            step: Global step. Given only for steps written to TensorBoard (学習時).
+        """
+        # 書かないwindowに足し込むと, flushされないまま溜まり続ける (devやrank 0以外).
+        in_window = step is not None and self.writes
+        for key, val in loss_values.items():
+            if isinstance(val, torch.Tensor):
+                val = val.detach()
+            # in-placeで足さないので, 書き込みthreadに渡したtensorは書き換わらない.
+            if in_window:
+                self._window[key] = self._window[key] + val if key in self._window else val
+            self._epoch[key] = self._epoch[key] + val if key in self._epoch else val
+        self._epoch_steps += 1
+        if not in_window:
+            return
+        self._last_step = step
+        self._window_steps += 1
+        if self.flush_interval > 0 and self._window_steps >= self.flush_interval:
+            self.flush(step)
+
+    def add_scalar(self, key: str, value: float) -> None:
+        """Record a host-side scalar (学習率など). flush時には最後の値を書く."""
+        if self.writes:
+            self._window_scalars[key] = value
+
+    def add_time(self, name: str, seconds: float) -> None:
+        """Record a time measured on the host (data待ちなど)."""
+        if self.writes:
+            self._window_timers.setdefault(name, []).append(seconds * 1000.0)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Measure a section of a step as ``time/{name}``. 書かないなら計らない."""
+        if not self.writes:
+            yield
+            return
+        if not self.use_cuda_timer:
+            start = time.perf_counter()
+            yield
+            self.add_time(name, time.perf_counter() - start)
+            return
+        t = _CudaTimer()
+        t.start.record()
+        yield
+        t.end.record()
+        self._window_timers.setdefault(name, []).append(t)
+
+    def flush(self, step: int) -> None:
+        """Hand the means of the current window to the writer thread."""
+        if self._thread is not None and self._window_steps > 0:
+            self._queue.put((step, self._window_steps, self._window, self._window_timers, self._window_scalars))
+        self._window = {}
+        self._window_timers = {}
+        self._window_scalars = {}
+        self._window_steps = 0
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            step, n_steps, window, timers, scalars = item
+            for key, val in window.items():
+                self.writer.add_scalar(f"{self.prefix}/{key}", _to_float(val) / n_steps, step)
+            for name, times in timers.items():
+                times = [t.elapsed_ms() if isinstance(t, _CudaTimer) else t for t in times]
+                self.writer.add_scalar(f"time/{name}", sum(times) / n_steps, step)
+            for key, val in scalars.items():
+                self.writer.add_scalar(key, val, step)
+            self._queue.task_done()
+
+    def epoch_means(self) -> Dict[str, float]:
+        """Mean of each loss since the last :meth:`reset_epoch`. ここでだけ同期する.
+
+        DistributedDataParallelで学習しているときは全rankの平均を返す (best modelの選択が全rankで一致する).
+        """
+        if self._epoch_steps == 0:
+            return {}
+        keys = list(self._epoch.keys())
+        values = [self._epoch[k] for k in keys]
+        device = next((v.device for v in values if isinstance(v, torch.Tensor)), torch.device("cpu"))
+        # 1回のcopy (分散時は1回のall_reduce) でまとめてCPUに移す.
+        sums = torch.stack([torch.as_tensor(v, dtype=torch.float32, device=device).reshape(()) for v in values])
+        return dict(zip(keys, all_reduce_means(sums, self._epoch_steps)))
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Running sums of the current epoch (途中から再開するためにcheckpointに入れる)."""
+        return {
+            "epoch": {k: _to_float(v) for k, v in self._epoch.items()},
+            "epoch_steps": self._epoch_steps,
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        # floatのまま持っておけば, 次のupdateでdevice上のtensorとの和になる.
+        self._epoch = dict(state["epoch"])
+        self._epoch_steps = state["epoch_steps"]
+
+    def reset_epoch(self) -> None:
+        self._epoch = {}
+        self._epoch_steps = 0
+        # 端数のwindowは次のepochに持ち越さず, 最後のstepで書いてから捨てる.
+        self.flush(self._last_step)
+
+    def close(self, step: Optional[int] = None) -> None:
+        """Flush the rest and wait for the writer thread."""
+        if step is not None:
+            self.flush(step)
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def step_timer(metrics: Optional[MetricsAggregator], name: str):
+    """``metrics.timer(name)``, or a no-op if ``metrics`` is None (optuna等)."""
+    return metrics.timer(name) if metrics is not None else nullcontext()
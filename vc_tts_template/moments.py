@@ -0,0 +1,44 @@
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+
+class Moments(NamedTuple):
+    """Mergeable statistics for mean and variance.
+
+    count: サンプル数, mean: 平均, m2: 平均からの偏差の二乗和.
+    """
+    count: int
+    mean: np.ndarray
+    m2: np.ndarray
+
+    def to_list(self) -> List:
+        """json等に保存するための形. :meth:`from_list` で戻せる."""
+        return [int(self.count), self.mean.tolist(), self.m2.tolist()]
+
+    @classmethod
+    def from_list(cls, values: List) -> "Moments":
+        count, mean, m2 = values
+        return cls(int(count), np.asarray(mean, dtype=np.float64), np.asarray(m2, dtype=np.float64))
+
+
+def compute_moments(x: np.ndarray) -> Moments:
+    """Moments of features along the first axis. 1次元の特徴量は(T, 1)として扱う."""
+    if len(x.shape) == 1:
+        x = x.reshape(-1, 1)
+    x = x.astype(np.float64)
+    mean = x.mean(axis=0)
+    return Moments(len(x), mean, ((x - mean) ** 2).sum(axis=0))
+
+
+def merge_moments(a: Optional[Moments], b: Moments) -> Moments:
+    """Merge two moments with the parallel Welford formula (Chan et al.)."""
+    if a is None or a.count == 0:
+        return b
+    if b.count == 0:
+        return a
+    count = a.count + b.count
+    delta = b.mean - a.mean
+    mean = a.mean + delta * (b.count / count)
+    m2 = a.m2 + b.m2 + delta ** 2 * (a.count * b.count / count)
+    return Moments(count, mean, m2)
@@ -0,0 +1,99 @@
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import joblib
+import numpy as np
+from hydra.utils import to_absolute_path
+
+
+def load_scaler(scaler_dir: Path, name: str, required: bool = True) -> Optional[Any]:
+    """Load ``{name}_scaler.joblib`` saved by fit_scaler.py.
+
+    Args:
+        scaler_dir: Directory of the scalers.
+        name: Stream name such as ``out_fastspeech2_mel``.
+        required: Raise an error if the scaler does not exist. Otherwise return None.
+
+    Returns:
+        StandardScaler or None.
+    """
+    path = Path(scaler_dir) / f"{name}_scaler.joblib"
+    if not path.exists():
+        if required:
+            raise FileNotFoundError(f"Scaler not found: {path}")
+        return None
+    return joblib.load(path)
+
+
+def normalize_arrays(arrays: Sequence[np.ndarray], scaler: Any) -> List[np.ndarray]:
+    """Normalize several arrays with one scaler at once.
+
+    preprocess_normalize.pyと同じく, 1次元の特徴量は(T, 1)として扱う.
+    batch内の全発話を連結して, sklearnのStandardScaler.transformと同じ演算
+    (x -= mean_, x /= scale_ をxのdtypeで行う) を1回だけかけるので, 結果はbit単位で一致する.
+
+    Args:
+        arrays: Features of shape (T,) or (T, D).
+        scaler: Fitted StandardScaler.
+
+    Returns:
+        list: Normalized features of the same shapes.
+    """
+    if len(arrays) == 0:
+        return []
+    # concatenateは新しい配列を返すので, 読み込んだ配列(memmapを含む)は書き換えない.
+    x = np.concatenate([a.reshape(len(a), -1) for a in arrays])
+    x -= scaler.mean_.astype(x.dtype)
+    x /= scaler.scale_.astype(x.dtype)
+    splits = np.split(x, np.cumsum([len(a) for a in arrays])[:-1])
+    return [s.reshape(a.shape) for s, a in zip(splits, arrays)]
+
+
+class NormalizedCollate(object):
+    """Collate function that normalizes features before collating.
+
+    datasetの各itemはtupleで, ``scalers`` のkeyはそのtuple内の位置.
+    normのdumpを作らずに, orgの特徴量をbatchごとにまとめて正規化してから元のcollate_fnに渡す.
+    値がNoneの位置 (sent_durationなど) はそのまま渡す.
+    DataLoaderのworkerに渡せるよう, 関数ではなくclassにしている.
+
+    Args:
+        collate_fn: Original collate function.
+        scalers: Mapping from the position in an item to its scaler.
+    """
+
+    def __init__(self, collate_fn: Callable, scalers: Dict[int, Any]):
+        self.collate_fn = collate_fn
+        self.scalers = scalers
+
+    def __call__(self, batch):
+        columns = [list(column) for column in zip(*batch)]
+        for pos, scaler in self.scalers.items():
+            idxs = [i for i, x in enumerate(columns[pos]) if x is not None]
+            normalized = normalize_arrays([columns[pos][i] for i in idxs], scaler)
+            for i, x in zip(idxs, normalized):
+                columns[pos][i] = x
+        return self.collate_fn([tuple(item) for item in zip(*columns)])
+
+
+def get_normalized_collate_fn(data_config: Dict, collate_fn: Callable, names: Dict[int, str]) -> Callable:
+    """Wrap collate_fn with :class:`NormalizedCollate` if ``data_config.scaler_dir`` is set.
+
+    scaler_dirを指定したのにscalerが見つからない場合はraiseする (正規化せずに学習してしまわないように).
+    textや波形など正規化しないものは ``names`` に含めないこと.
+
+    Args:
+        data_config: Data configuration.
+        collate_fn: Collate function.
+        names: Mapping from the position in an item to its stream name.
+
+    Returns:
+        Callable: Collate function.
+    """
+    scaler_dir = data_config.get("scaler_dir", None)  # type: ignore
+    # 空文字列 (hydraで data.scaler_dir= と渡した場合) も正規化しない.
+    if not scaler_dir:
+        return collate_fn
+    scaler_dir = Path(to_absolute_path(scaler_dir))
+    scalers = {pos: load_scaler(scaler_dir, name) for pos, name in names.items()}
+    return NormalizedCollate(collate_fn, scalers)
@@ -0,0 +1,127 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+INDEX_NAME = "index.json"
+
+
+def _shard_name(shard_id: int) -> str:
+    return f"shard{shard_id:04d}.npy"
+
+
+def pack_features(
+    utt_ids: List[str], in_dir: Union[str, Path], out_dir: Union[str, Path],
+    shard_size_mb: int = 1024,
+) -> int:
+    """Pack ``{utt_id}-feats.npy`` files of one feature stream into a few large shards.
+
+    各発話の特徴量を時間方向(axis=0)に連結し, ``shard_size_mb`` ごとに1つの
+    .npyファイルにまとめる. どの発話がどこにあるかは index.json に記録する.
+    ファイルが存在しない発話(sent_durationなど)はindexに載せずにskipする.
+
+    Args:
+        utt_ids: List of utterance ids to pack.
+        in_dir: Directory containing ``{utt_id}-feats.npy`` files.
+        out_dir: Output directory for shards and index.
+        shard_size_mb: Approximate upper bound of a shard in MB.
+
+    Returns:
+        int: Number of packed utterances.
+    """
+    in_dir = Path(in_dir)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    shard_size = shard_size_mb * 1024 * 1024
+
+    index: Dict[str, List[int]] = {}
+    buffer: List[np.ndarray] = []
+    buffer_bytes = 0
+    shard_id = 0
+    offset = 0
+    dtype = None
+    trailing_shape = None
+
+    def flush(shard_id, buffer):
+        np.save(out_dir / _shard_name(shard_id), np.concatenate(buffer, axis=0), allow_pickle=False)
+
+    for utt_id in utt_ids:
+        path = in_dir / f"{utt_id}-feats.npy"
+        if not path.exists():
+            continue
+        x = np.load(path)
+        if dtype is None:
+            dtype, trailing_shape = x.dtype, x.shape[1:]
+        assert x.dtype == dtype and x.shape[1:] == trailing_shape, \
+            f"{path}: dtype/shape mismatch. expected {dtype}{trailing_shape}, got {x.dtype}{x.shape[1:]}"
+
+        index[utt_id] = [shard_id, offset, x.shape[0]]
+        buffer.append(x)
+        buffer_bytes += x.nbytes
+        offset += x.shape[0]
+
+        if buffer_bytes >= shard_size:
+            flush(shard_id, buffer)
+            shard_id += 1
+            buffer, buffer_bytes, offset = [], 0, 0
+
+    if len(buffer) > 0:
+        flush(shard_id, buffer)
+
+    with open(out_dir / INDEX_NAME, "w") as f:
+        json.dump(index, f)
+
+    return len(index)
+
+
+def is_packed(feat_dir: Union[str, Path]) -> bool:
+    return (Path(feat_dir) / INDEX_NAME).exists()
+
+
+class PackedFeatures(object):
+    """Read-only access to a feature stream packed by :func:`pack_features`.
+
+    shardは初回アクセス時にmmapで開くので, DataLoaderのworkerにforkされた後でも
+    各プロセスが自分のmmapを持つ. 返り値はmmapのview(コピーなし)であることに注意.
+
+    Args:
+        feat_dir: Directory containing ``index.json`` and shards.
+    """
+
+    def __init__(self, feat_dir: Union[str, Path]):
+        self.feat_dir = Path(feat_dir)
+        with open(self.feat_dir / INDEX_NAME) as f:
+            self.index = json.load(f)
+        self._shards: Dict[int, np.ndarray] = {}
+
+    def _get_shard(self, shard_id: int) -> np.ndarray:
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.load(self.feat_dir / _shard_name(shard_id), mmap_mode="r")
+        return self._shards[shard_id]
+
+    def __contains__(self, utt_id: str) -> bool:
+        return utt_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, utt_id: str) -> np.ndarray:
+        shard_id, offset, length = self.index[utt_id]
+        return self._get_shard(shard_id)[offset: offset + length]
+
+    def get(self, utt_id: str) -> Optional[np.ndarray]:
+        if utt_id not in self.index:
+            return None
+        return self[utt_id]
+
+    def length(self, utt_id: str) -> int:
+        """Number of frames of utt_id, without touching the shards.
+        """
+        return self.index[utt_id][2]
+
+    def __getstate__(self):
+        # mmapはpickleせず, worker側で開き直す.
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
@@ -0,0 +1,109 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+def _offsets(lengths: Sequence[int]) -> np.ndarray:
+    return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+def batch_interp_unvoiced(
+    xs: Sequence[np.ndarray], voiced: Optional[Sequence[np.ndarray]] = None, threshold: float = 0.0,
+) -> List[np.ndarray]:
+    """Linearly interpolate unvoiced frames of several utterances at once.
+
+    無声(voicedでない)frameを, 同じ発話内の前後の有声frameから線形補間する.
+    発話の端は最も近い有声frameの値で埋める (interp1dのfill_value=(最初, 最後)と同じ).
+    全発話を連結して, 前後の有声frameのindexをaccumulateで求めるので, 発話数によらずloopはない.
+    有声frameが1つもない発話はそのまま返す.
+
+    Args:
+        xs: List of 1D features such as pitch.
+        voiced: List of boolean masks of voiced frames. ``x > threshold`` if None.
+        threshold: Threshold used when ``voiced`` is None.
+
+    Returns:
+        list: Interpolated features.
+    """
+    lengths = [len(x) for x in xs]
+    offsets = _offsets(lengths)
+    x = np.concatenate(xs).astype(np.float64) if len(xs) > 0 else np.zeros(0)
+    mask = np.concatenate(voiced).astype(bool) if voiced is not None else x > threshold
+
+    idx = np.arange(len(x))
+    utt_start = np.repeat(offsets[:-1], lengths)
+    utt_end = np.repeat(offsets[1:], lengths)
+    # 直前(自身を含む)と直後(自身を含む)の有声frameのindex. 別の発話のものは無効とする.
+    prev_idx = np.maximum.accumulate(np.where(mask, idx, -1))
+    next_idx = np.minimum.accumulate(np.where(mask, idx, len(x))[::-1])[::-1]
+    has_prev = prev_idx >= utt_start
+    has_next = next_idx < utt_end
+
+    out = x.copy()
+    both = ~mask & has_prev & has_next
+    lo, hi = prev_idx[both], next_idx[both]
+    slope = (x[hi] - x[lo]) / (hi - lo)
+    out[both] = slope * (idx[both] - lo) + x[lo]
+    only_prev = ~mask & has_prev & ~has_next
+    out[only_prev] = x[prev_idx[only_prev]]
+    only_next = ~mask & ~has_prev & has_next
+    out[only_next] = x[next_idx[only_next]]
+
+    return np.split(out, offsets[1:-1])
+
+
+def interp_unvoiced(x: np.ndarray, voiced: Optional[np.ndarray] = None, threshold: float = 0.0) -> np.ndarray:
+    """Linearly interpolate unvoiced frames of one utterance.
+
+    Args:
+        x: 1D feature such as pitch.
+        voiced: Boolean mask of voiced frames. ``x > threshold`` if None.
+        threshold: Threshold used when ``voiced`` is None.
+
+    Returns:
+        np.ndarray: Interpolated feature.
+    """
+    return batch_interp_unvoiced([x], None if voiced is None else [voiced], threshold)[0]
+
+
+def batch_phoneme_average(xs: Sequence[np.ndarray], durations: Sequence[np.ndarray]) -> List[np.ndarray]:
+    """Average frame-level features over each phoneme for several utterances at once.
+
+    durationの累積和を区切りとして, 全発話を連結したものに1回の np.add.reduceat をかける.
+    duration = 0 の音素は0になる.
+
+    Args:
+        xs: List of frame-level features of shape (T, ...). Frames beyond ``sum(duration)`` are ignored.
+        durations: List of phoneme durations.
+
+    Returns:
+        list: Phoneme-level features of shape (N, ...).
+    """
+    durations = [np.asarray(d, dtype=np.int64) for d in durations]
+    # 各発話の有効なframeだけを連結し, 末尾に番兵の0を1つ足す(最後の区切りがindex範囲外にならないように).
+    frames = [x[:d.sum()] for x, d in zip(xs, durations)]
+    x = np.concatenate(frames + [np.zeros((1,) + frames[0].shape[1:])])
+    duration = np.concatenate(durations)
+
+    starts = np.cumsum(duration) - duration
+    sums = np.add.reduceat(x, starts, axis=0)
+    # reduceatは区切りが等しいとき(duration = 0)にその位置の値を返すので, 0にしておく.
+    nonzero = duration > 0
+    sums[~nonzero] = 0
+    counts = np.maximum(duration, 1).reshape((-1,) + (1,) * (x.ndim - 1))
+    means = sums / counts
+
+    return np.split(means, np.cumsum([len(d) for d in durations])[:-1])
+
+
+def phoneme_average(x: np.ndarray, duration: np.ndarray) -> np.ndarray:
+    """Average a frame-level feature over each phoneme.
+
+    Args:
+        x: Frame-level feature of shape (T, ...).
+        duration: Phoneme durations.
+
+    Returns:
+        np.ndarray: Phoneme-level feature of shape (N, ...).
+    """
+    return batch_phoneme_average([x], [duration])[0]
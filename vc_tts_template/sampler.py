@@ -0,0 +1,270 @@
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import (BatchSampler, DataLoader, Dataset, DistributedSampler, RandomSampler, Sampler,
+                              SequentialSampler)
+
+from vc_tts_template.distributed import get_rank, get_world_size
+from vc_tts_template.utils import set_rng_state
+
+
+def split_by_budget(
+    lengths: Sequence[int], batch_size: int, max_frames: Optional[int] = None,
+    order: Optional[np.ndarray] = None,
+) -> List[List[int]]:
+    """Split indices sorted by length (descending) into sub-batches.
+
+    長い順に並べた発話を先頭から詰めていき, batch_size個に達するか,
+    padding込みのframe数 (先頭=最長の長さ * 個数) がmax_framesを超える手前で区切る.
+    降順なので区切り位置は「sub-batch先頭の長さと個数」だけで決まり, 後続の発話の長さに依らない.
+    よってsamplerで全体を区切った結果と, collateでgroup内を区切り直した結果は
+    (同じ長さの発話同士の入れ替わりを除いて)一致する.
+
+    Args:
+        lengths: Length of each utterance.
+        batch_size: Maximum number of utterances in a sub-batch.
+        max_frames: Maximum number of padded frames in a sub-batch. None disables the budget.
+        order: Precomputed descending order of ``lengths``. Computed if None.
+
+    Returns:
+        list: List of sub-batches (lists of indices).
+    """
+    lengths = np.asarray(lengths)
+    if order is None:
+        order = np.argsort(-lengths, kind="stable")
+
+    sub_batches = []
+    current: List[int] = []
+    head_len = 0
+    for idx in order.tolist():
+        if len(current) > 0 and (
+            len(current) >= batch_size
+            or (max_frames is not None and head_len * (len(current) + 1) > max_frames)
+        ):
+            sub_batches.append(current)
+            current = []
+        if len(current) == 0:
+            head_len = int(lengths[idx])
+        current.append(idx)
+    if len(current) > 0:
+        sub_batches.append(current)
+
+    return sub_batches
+
+
+class LengthBucketBatchSampler(Sampler):  # type: ignore
+    """Batch sampler which buckets the whole dataset by length.
+
+    dataset全体を長さ順に並べてsub-batchに区切り, group_size個のsub-batchをまとめて1回分として返す.
+    train_loopの ``for batch in batchs`` はそのままで, collate側でsplit_by_budgetにより
+    同じsub-batchに区切り直される. 長さの近い発話同士でbatchが組まれるのでpaddingが減り,
+    max_framesを指定すれば1stepあたりのメモリもほぼ一定になる.
+
+    ``num_replicas`` が2以上のとき (DistributedDataParallel) は, 全rankで同じ順番にsub-batchを並べてから
+    groupをrankごとに分ける. 全rankのstep数を揃えるため, sub-batchの数が ``num_replicas * group_size`` で
+    割り切れるよう先頭のsub-batchを繰り返して足す (DistributedSamplerと同じ).
+    順番は ``seed`` と :meth:`set_epoch` で渡されたepochから決まる.
+
+    Args:
+        lengths: Length of each utterance in the dataset. collateでsortに使う長さと同じものを渡すこと.
+        batch_size: Maximum number of utterances in a sub-batch.
+        group_size: Number of sub-batches returned at once.
+        max_frames: Maximum number of padded frames in a sub-batch.
+        shuffle: If True, shuffle utterances of the same length and the order of groups every epoch.
+        drop_last: If True, drop the last incomplete group.
+        num_replicas: Number of ranks. Defaults to the world size.
+        rank: Rank of this process. Defaults to the current rank.
+        seed: Random seed shared by all ranks. Used only if num_replicas > 1.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        group_size: int,
+        max_frames: Optional[int] = None,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        seed: int = 0,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.group_size = group_size
+        self.max_frames = max_frames
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+        self.seed = seed
+        self.epoch = 0
+
+        self._groups = self._make_groups(np.random.default_rng(0)) if not shuffle else None
+        # 区切り方は長さだけで決まるので, 個数はshuffleに依らない.
+        self._num_sub_batches = len(split_by_budget(self.lengths, batch_size, max_frames))
+
+    def _make_groups(self, rng: np.random.Generator) -> List[List[int]]:
+        if self.shuffle:
+            # 同じ長さの発話の並びをランダムにしてから長さで安定sortする.
+            perm = rng.permutation(len(self.lengths))
+            order = perm[np.argsort(-self.lengths[perm], kind="stable")]
+        else:
+            order = np.argsort(-self.lengths, kind="stable")
+        sub_batches = split_by_budget(self.lengths, self.batch_size, self.max_frames, order)
+
+        if self.shuffle:
+            sub_batches = [sub_batches[i] for i in rng.permutation(len(sub_batches))]
+        if self.num_replicas > 1:
+            unit = self.num_replicas * self.group_size
+            if self.drop_last:
+                sub_batches = sub_batches[:len(sub_batches) // unit * unit]
+            elif len(sub_batches) > 0:
+                # 発話のないrank, phaseでは足すものがない.
+                n_pad = -len(sub_batches) % unit
+                sub_batches = sub_batches + (sub_batches * (n_pad // len(sub_batches) + 1))[:n_pad]
+            groups = [
+                sum(sub_batches[i:i + self.group_size], [])
+                for i in range(0, len(sub_batches), self.group_size)
+            ]
+            return groups[self.rank::self.num_replicas]
+        groups = [
+            sum(sub_batches[i:i + self.group_size], [])
+            for i in range(0, len(sub_batches), self.group_size)
+        ]
+        if self.drop_last and len(groups) > 0 and len(sub_batches) % self.group_size != 0:
+            groups = groups[:-1]
+        return groups
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if self.shuffle and self.num_replicas > 1:
+            # 全rankで同じ並びにする必要があるので, torchの乱数ではなくseedとepochから作る.
+            groups = self._make_groups(np.random.default_rng(self.seed + self.epoch))
+        elif self.shuffle:
+            # DataLoaderのshuffleと同様, torchの乱数からseedを作る(init_seedで再現可能).
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            groups = self._make_groups(np.random.default_rng(seed))
+        else:
+            groups = self._groups  # type: ignore
+        yield from groups
+
+    def __len__(self) -> int:
+        if self.num_replicas > 1:
+            unit = self.num_replicas * self.group_size
+            if self.drop_last:
+                return self._num_sub_batches // unit
+            return (self._num_sub_batches + unit - 1) // unit
+        if self.drop_last:
+            return self._num_sub_batches // self.group_size
+        return (self._num_sub_batches + self.group_size - 1) // self.group_size
+
+
+class ResumableBatchSampler(Sampler):  # type: ignore
+    """Batch sampler which can start the next epoch from the middle.
+
+    中身のbatch samplerが返すbatchの並びはそのままで, :meth:`skip_` で指定した数のbatchを
+    読み込まずに飛ばす. batchの並びは中身のsamplerがiterの最初にtorchの乱数から決めるので,
+    epochの最初の乱数のstateに戻してからiterすれば, 中断前と同じ並びになる.
+
+    Args:
+        batch_sampler: Batch sampler to wrap.
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self._num_skip = 0
+        self._rng_state: Optional[Dict] = None
+
+    def skip_(self, num_batches: int, rng_state: Optional[Dict] = None) -> None:
+        """Skip the first ``num_batches`` batches of the next iteration only.
+
+        Args:
+            num_batches: Number of batches already used before the interruption.
+            rng_state: RNG states restored right before yielding the first batch.
+                並びが決まった後, 最初のbatchを読み込む前に中断時点の乱数に戻す.
+        """
+        self._num_skip = num_batches
+        self._rng_state = rng_state
+
+    def set_epoch(self, epoch: int) -> None:
+        for sampler in [self.batch_sampler, getattr(self.batch_sampler, "sampler", None)]:
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(epoch)
+                return
+
+    def __iter__(self) -> Iterator[List[int]]:
+        num_skip, rng_state = self._num_skip, self._rng_state
+        self._num_skip, self._rng_state = 0, None
+        for i, batch in enumerate(self.batch_sampler):
+            if i < num_skip:
+                continue
+            if rng_state is not None:
+                set_rng_state(rng_state)
+                rng_state = None
+            yield batch
+        if rng_state is not None:
+            # epochの最後のbatchまで終わっていた場合.
+            set_rng_state(rng_state)
+
+    def __len__(self) -> int:
+        return len(self.batch_sampler)
+
+
+def get_data_loader(
+    data_config: Dict, dataset: Dataset, collate_fn: Callable, phase: str, lengths: Optional[List[int]] = None
+) -> DataLoader:
+    """Get a data loader which returns ``batch_size * group_size`` utterances at once.
+
+    data.bucketingがtrueならLengthBucketBatchSamplerを使い, そうでなければ従来通りrandomに取る.
+    DistributedDataParallelで学習しているときは, rankごとに異なる発話を返すdata loaderになる.
+    batch samplerはResumableBatchSamplerで包むので, 途中から再開できる.
+
+    Args:
+        data_config: Data configuration.
+        dataset: Dataset.
+        collate_fn: Collate function.
+        phase: "train" or "dev".
+        lengths: Length of each utterance used for bucketing. Only required if data.bucketing is true.
+
+    Returns:
+        DataLoader: Data loader.
+    """
+    shuffle = phase.startswith("train")  # trainならTrue
+    seed = 0
+    if get_world_size() > 1:
+        # 全rankで同じseedにする. init_seedの後, 全rankで同じ順番に作られるので乱数も一致する.
+        seed = int(torch.randint(2 ** 31, ()).item())
+    if data_config.get("bucketing", False):  # type: ignore
+        # 長さでbucketingしたsub-batchをgroup_size個ずつ返す. collateは同じmax_framesで区切り直す.
+        assert lengths is not None, "lengths are required for bucketing"
+        batch_sampler = LengthBucketBatchSampler(
+            lengths,
+            data_config.batch_size,  # type: ignore
+            data_config.group_size,  # type: ignore
+            max_frames=data_config.get("max_frames", None),  # type: ignore
+            shuffle=shuffle,
+            seed=seed,
+        )
+    else:
+        if get_world_size() > 1:
+            # 発話数が割り切れなければ先頭を繰り返して, 全rankのstep数を揃える.
+            sampler = DistributedSampler(dataset, shuffle=shuffle, seed=seed)
+        elif shuffle:
+            sampler = RandomSampler(dataset)
+        else:
+            sampler = SequentialSampler(dataset)
+        # DataLoader(batch_size=..., shuffle=...) が内部で作るものと同じ.
+        batch_sampler = BatchSampler(
+            sampler, data_config.batch_size * data_config.group_size, drop_last=False  # type: ignore
+        )
+    return DataLoader(
+        dataset,
+        batch_sampler=ResumableBatchSampler(batch_sampler),
+        collate_fn=collate_fn,
+        pin_memory=True,
+        num_workers=data_config.num_workers,  # type: ignore
+    )
@@ -0,0 +1,215 @@
+import math
+from typing import Tuple
+
+import numpy as np
+
+
+def max_amplitude(x: np.ndarray) -> float:
+    """Max possible amplitude of a waveform (pydubのmax_possible_amplitude).
+
+    Args:
+        x: Waveform. Signed integer or float in [-1, 1].
+
+    Returns:
+        float: 2 ** (bits - 1) for integer waveforms, 1.0 for float waveforms.
+    """
+    if np.issubdtype(x.dtype, np.integer):
+        return float(np.iinfo(x.dtype).max + 1)
+    return 1.0
+
+
+def ms_to_samples(ms, sr: int) -> np.ndarray:
+    """Convert milliseconds to sample indices in the same way as pydub (int(ms * sr / 1000))."""
+    return (np.asarray(ms) * (sr / 1000.0)).astype(np.int64)
+
+
+def duration_ms(x: np.ndarray, sr: int) -> int:
+    """Length of a waveform in milliseconds (pydubのlen(audio))."""
+    return round(1000 * (len(x) / sr))
+
+
+def _square_cumsum(x: np.ndarray) -> np.ndarray:
+    # 16bit以下の整数ならint64で二乗和を厳密に持てる(audioop.rmsの倍精度の和とも一致する).
+    if np.issubdtype(x.dtype, np.integer) and x.dtype.itemsize <= 2:
+        squares = x.astype(np.int64) ** 2
+    else:
+        squares = x.astype(np.float64) ** 2
+    return np.concatenate([np.zeros(1, dtype=squares.dtype), np.cumsum(squares)])
+
+
+def window_rms(x: np.ndarray, sr: int, starts_ms: np.ndarray, ends_ms: np.ndarray) -> np.ndarray:
+    """RMS of ``x[start_ms:end_ms]`` for many windows at once.
+
+    二乗の累積和の差で各窓の和を求めるので, 窓の数や長さによらずloopはない.
+    pydubと同じく, 窓の終わりは音声長(ms)で切り, それでも波形の外にはみ出した分は0として数える.
+    整数の波形はaudioop.rmsと同じく切り捨てた整数を返す.
+
+    Args:
+        x: Waveform of shape (T,).
+        sr: Sampling rate.
+        starts_ms: Start of each window in milliseconds.
+        ends_ms: End of each window in milliseconds.
+
+    Returns:
+        np.ndarray: RMS of each window. 0 for empty windows.
+    """
+    len_ms = duration_ms(x, sr)
+    starts = ms_to_samples(np.minimum(starts_ms, len_ms), sr)
+    ends = ms_to_samples(np.minimum(ends_ms, len_ms), sr)
+    cumsum = _square_cumsum(x)
+    sums = cumsum[np.minimum(ends, len(x))] - cumsum[np.minimum(starts, len(x))]
+    counts = np.maximum(ends - starts, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rms = np.sqrt(sums / counts)
+    rms[counts == 0] = 0
+    if np.issubdtype(x.dtype, np.integer):
+        rms = np.floor(rms)
+    return rms
+
+
+def _db_to_rms_bound(db: float, amplitude: float) -> int:
+    # 整数のrmsについて, 20 * log10(rms / amplitude) < db となる最大のrms(pydubのdBFSと同じ式)を二分探索で求める.
+    lo, hi = 0, int(amplitude) + 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if 20 * math.log(mid / amplitude, 10) < db:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def detect_leading_silence(x: np.ndarray, sr: int, silence_thresh: float = -50.0, chunk_size: int = 10) -> int:
+    """Length of the leading silence in milliseconds.
+
+    先頭からchunk_size(ms)ごとの区間のdBFSがsilence_threshを下回り続ける長さを返す.
+    pydubのchunkを1つずつ見るwhile loopと同じ結果を, 全chunkのRMSを一度に求めて得る.
+
+    Args:
+        x: Waveform of shape (T,).
+        sr: Sampling rate.
+        silence_thresh: Threshold in dBFS.
+        chunk_size: Chunk size in milliseconds.
+
+    Returns:
+        int: Leading silence in milliseconds (a multiple of ``chunk_size``).
+    """
+    assert chunk_size > 0
+    len_ms = duration_ms(x, sr)
+    starts_ms = np.arange(0, len_ms, chunk_size)
+    rms = window_rms(x, sr, starts_ms, starts_ms + chunk_size)
+    if np.issubdtype(x.dtype, np.integer):
+        silent = rms <= _db_to_rms_bound(silence_thresh, max_amplitude(x))
+    else:
+        with np.errstate(divide="ignore"):
+            silent = 20 * np.log10(rms / max_amplitude(x)) < silence_thresh
+    n_silent = len(silent) if silent.all() else int(np.argmin(silent))
+    return n_silent * chunk_size
+
+
+def detect_silence(
+    x: np.ndarray, sr: int, min_silence_len: int = 1000, silence_thresh: float = -16, seek_step: int = 1
+) -> np.ndarray:
+    """Find silent sections (pydub.silence.detect_silence on a NumPy waveform).
+
+    seek_step(ms)ごとに長さmin_silence_len(ms)の窓のRMSを一度に求め,
+    無音と判定された窓の開始位置の連続(run)をまとめて区間にする.
+
+    Args:
+        x: Waveform of shape (T,).
+        sr: Sampling rate.
+        min_silence_len: Minimum length of a silent section in milliseconds.
+        silence_thresh: Threshold in dBFS.
+        seek_step: Step size in milliseconds.
+
+    Returns:
+        np.ndarray: Silent sections of shape (N, 2) as [start, end] in milliseconds.
+    """
+    len_ms = duration_ms(x, sr)
+    if len_ms < min_silence_len:
+        return np.zeros((0, 2), dtype=np.int64)
+    last_start = len_ms - min_silence_len
+    starts_ms = np.arange(0, last_start + 1, seek_step)
+    if last_start % seek_step:
+        starts_ms = np.append(starts_ms, last_start)
+
+    thresh = 10 ** (silence_thresh / 20) * max_amplitude(x)
+    starts_ms = starts_ms[window_rms(x, sr, starts_ms, starts_ms + min_silence_len) <= thresh]
+    if len(starts_ms) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # 連続しておらず, かつ前の窓と重ならないところで区間を切る.
+    gap = (starts_ms[1:] != starts_ms[:-1] + seek_step) & (starts_ms[1:] > starts_ms[:-1] + min_silence_len)
+    run_starts = np.concatenate([[0], np.flatnonzero(gap) + 1])
+    run_ends = np.append(run_starts[1:], len(starts_ms)) - 1
+    return np.stack([starts_ms[run_starts], starts_ms[run_ends] + min_silence_len], axis=1)
+
+
+def slice_ms(x: np.ndarray, sr: int, start_ms: int, end_ms: int) -> np.ndarray:
+    """``audio[start_ms:end_ms]`` of pydub on a NumPy waveform.
+
+    終わりが波形の外に出た分(丸めによる高々数sample)は0で埋める.
+    """
+    len_ms = duration_ms(x, sr)
+    start, end = ms_to_samples([min(start_ms, len_ms), min(end_ms, len_ms)], sr)
+    y = x[start:end]
+    missing = max(end - start, 0) - len(y)
+    if missing > 0:
+        y = np.concatenate([y, np.zeros(missing, dtype=x.dtype)])
+    return y
+
+
+def trim_silence(
+    x: np.ndarray, sr: int, silence_thresh_h: float, silence_thresh_t: float, chunk_size: int = 10
+) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """Trim leading and trailing silence.
+
+    Args:
+        x: Waveform of shape (T,).
+        sr: Sampling rate.
+        silence_thresh_h: Threshold of the head in dBFS.
+        silence_thresh_t: Threshold of the tail in dBFS.
+        chunk_size: Chunk size in milliseconds.
+
+    Returns:
+        tuple: Trimmed waveform and the trimmed lengths (head, tail) in milliseconds.
+    """
+    start_trim = detect_leading_silence(x, sr, silence_thresh_h, chunk_size)
+    end_trim = detect_leading_silence(x[::-1], sr, silence_thresh_t, chunk_size)
+    return slice_ms(x, sr, start_trim, duration_ms(x, sr) - end_trim), (start_trim, end_trim)
+
+
+def zero_sections(x: np.ndarray, sr: int, sections_ms: np.ndarray) -> np.ndarray:
+    """Set sections given in milliseconds to zero.
+
+    区間をmsで持つので, detect_silenceを別のsampling rateの波形で求めた区間にも使える.
+
+    Args:
+        x: Waveform of shape (T,).
+        sr: Sampling rate.
+        sections_ms: Sections of shape (N, 2) as [start, end] in milliseconds.
+
+    Returns:
+        np.ndarray: Waveform of the same length.
+    """
+    y = np.array(x)
+    len_ms = duration_ms(x, sr)
+    for start, end in ms_to_samples(np.minimum(sections_ms, len_ms), sr):
+        y[start:end] = 0
+    return y
+
+
+def zero_silence(x: np.ndarray, sr: int, silence_thresh: float, min_silence_len: int) -> np.ndarray:
+    """Set silent sections to zero.
+
+    Args:
+        x: Waveform of shape (T,).
+        sr: Sampling rate.
+        silence_thresh: Threshold in dBFS.
+        min_silence_len: Minimum length of a silent section in milliseconds.
+
+    Returns:
+        np.ndarray: Waveform of the same length.
+    """
+    silences = detect_silence(x, sr, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
+    return zero_sections(x, sr, silences)
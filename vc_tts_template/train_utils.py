@@ -3,7 +3,6 @@ import shutil
 from pathlib import Path
 from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
-import optuna
 import hydra
 import joblib
 import matplotlib.pyplot as plt
@@ -16,7 +15,12 @@ from omegaconf import OmegaConf
 from torch.utils import data as data_utils
 from torch.utils.tensorboard import SummaryWriter
 
+from vc_tts_template.checkpoint import CheckpointManager
+from vc_tts_template.distributed import is_main_process, wrap_model
 from vc_tts_template.logger import getLogger
+from vc_tts_template.normalization import get_normalized_collate_fn
+from vc_tts_template.packed import PackedFeatures
+from vc_tts_template.sampler import get_data_loader
 from vc_tts_template.utils import (adaptive_load_state_dict, init_seed,
                                    load_utt_list)
 
@@ -27,62 +31,6 @@ def free_tensors_memory(x: List[torch.Tensor]):
     torch.cuda.empty_cache()
 
 
-class check_grad_flow():
-    """AMP実装の為に, grad_infのparamを特定できるようにするクラス
-    仮定(設計)
-        - (train step内) grad norm が NaNとなっていいのは, AMP時だけ.
-            それ以外はモデルのバグなのでraise error
-        - (self.report内) paramsが記録されていないのにreport呼び出し(つまりgrad norm is None)は,
-            lossにNaNがあったということ.
-            - これに関しては, AMPだとしてもよろしくないので, raise error.
-            - 但し, optuna中であれば, パラメタが悪い(lossが発散に向かっているということ)なので, pruned
-            - optunaだとしても致命的なエラーの可能性は十分あるため, warningでlog報告.
-                発見次第確認した方が良さそう.
-    """
-    def __init__(self, logger, only_inf_grad=True) -> None:
-        self.model_params: Dict[str, np.ndarray] = {}
-        self.logger = logger
-        self.num_step = 0
-        self.only_inf_grad = only_inf_grad
-
-    def set_params(self, named_parameters):
-        self.num_step += 1
-        for n, p in named_parameters:
-            if p.requires_grad is True:
-                p = p.grad.abs().mean().cpu().numpy()
-                if (self.only_inf_grad is False) or (p == np.inf):
-                    n = f"steps: {self.num_step}, param_name: " + n
-                    self.model_params[n] = p
-
-    def report(self, loss_values=None, trial=False):
-        if (len(self.model_params) == 0) and (loss_values is not None):
-            self.logger.warning(
-                "Maybe the losses is NaN!! check log"
-            )
-            self._report_dict(loss_values, add_step=True)
-            if trial is False:
-                raise ValueError("loss value error")
-            else:
-                raise optuna.TrialPruned()
-
-        self._report_dict(loss_values)
-        self._report_dict(self.model_params)
-        self._reset()
-
-    def _reset(self):
-        self.model_params = {}
-
-    def _report_dict(self, dict_, add_step=False, mode="debug"):
-        if dict_ is not None:
-            for k, v in dict_.items():
-                if add_step is True:
-                    k = f"steps: {self.num_step}, " + k
-                if mode == "debug":
-                    self.logger.debug(f"{k}: {v}")
-                else:
-                    self.logger.info(f"{k}: {v}")
-
-
 def get_epochs_with_optional_tqdm(tqdm_mode: str, nepochs: int, last_epoch: int = 0) -> Iterable:
     """Get epochs with optional progress bar.
 
@@ -157,6 +105,8 @@ def save_checkpoint(
 ) -> None:
     """Save a checkpoint.
 
+    書き終わるまで待つ. 学習中はCheckpointManagerで別threadに書かせる.
+
     Args:
         logger: Logger.
         out_dir: Output directory.
@@ -167,49 +117,8 @@ def save_checkpoint(
             Defaults to False.
         postfix: Postfix. Defaults to "".
     """
-    if isinstance(model, dict):
-        for key in model.keys():
-            if isinstance(model[key], nn.DataParallel):
-                model[key] = model[key].module
-    else:
-        if isinstance(model, nn.DataParallel):
-            model = model.module
-
-    out_dir.mkdir(parents=True, exist_ok=True)
-    if is_best:
-        path = out_dir / f"best_loss{postfix}.pth"
-    else:
-        path = out_dir / "epoch{:04d}{}.pth".format(epoch, postfix)
-
-    if isinstance(model, dict):
-        model_state_dict = {
-            k: v.state_dict() for k, v in model.items()
-        }
-        torch.save(
-            {
-                "state_dict": model_state_dict,
-                "optimizer_state": optimizer.state_dict(),
-                "lr_scheduler_state": lr_scheduler.state_dict(),
-                "last_epoch": epoch,
-                "last_train_iter": train_iter
-            },
-            path,
-        )
-    else:
-        torch.save(
-            {
-                "state_dict": model.state_dict(),
-                "optimizer_state": optimizer.state_dict(),
-                "lr_scheduler_state": lr_scheduler.state_dict(),
-                "last_epoch": epoch,
-                "last_train_iter": train_iter
-            },
-            path,
-        )
-
-    logger.info(f"Saved checkpoint at {path}")
-    if not is_best:
-        shutil.copyfile(path, out_dir / f"latest{postfix}.pth")
+    manager = CheckpointManager(out_dir, logger, async_save=False, postfix=postfix)  # type: ignore
+    manager.save(model, optimizer, lr_scheduler, epoch, train_iter, is_best=bool(is_best))
 
 
 def ensure_divisible_by(feats: np.ndarray, N: int) -> np.ndarray:
@@ -417,6 +326,28 @@ class _Dataset(data_utils.Dataset):  # type: ignore
         return len(self.in_paths)
 
 
+class _PackedDataset(data_utils.Dataset):  # type: ignore
+    """Dataset for packed shards made by recipes/common/pack_dump.py
+
+    Args:
+        utt_ids: List of utterance ids
+        in_feats: Packed input features
+        out_feats: Packed output features
+    """
+
+    def __init__(self, utt_ids: List[str], in_feats: PackedFeatures, out_feats: PackedFeatures):
+        self.utt_ids = utt_ids
+        self.in_feats = in_feats
+        self.out_feats = out_feats
+
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        utt_id = self.utt_ids[idx]
+        return self.in_feats[utt_id], self.out_feats[utt_id]
+
+    def __len__(self):
+        return len(self.utt_ids)
+
+
 def _get_data_loaders(data_config: Dict, collate_fn: Callable) -> Dict[str, data_utils.DataLoader]:
     """Get data loaders for training and validation.
 
@@ -434,18 +365,19 @@ def _get_data_loaders(data_config: Dict, collate_fn: Callable) -> Dict[str, data
         in_dir = Path(to_absolute_path(data_config[phase].in_dir))
         out_dir = Path(to_absolute_path(data_config[phase].out_dir))
 
-        in_feats_paths = [in_dir / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-        out_feats_paths = [out_dir / f"{utt_id}-feats.npy" for utt_id in utt_ids]
-
-        dataset = _Dataset(in_feats_paths, out_feats_paths)
-        data_loaders[phase] = data_utils.DataLoader(
-            dataset,
-            batch_size=data_config.batch_size * data_config.group_size,  # type: ignore
-            collate_fn=collate_fn,
-            pin_memory=True,
-            num_workers=data_config.num_workers,  # type: ignore
-            shuffle=phase.startswith("train"),  # trainならTrue
-        )
+        if data_config.get("packed", False):  # type: ignore
+            dataset = _PackedDataset(utt_ids, PackedFeatures(in_dir), PackedFeatures(out_dir))
+        else:
+            in_feats_paths = [in_dir / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+            out_feats_paths = [out_dir / f"{utt_id}-feats.npy" for utt_id in utt_ids]
+
+            dataset = _Dataset(in_feats_paths, out_feats_paths)
+        # scaler_dirがあれば, orgの特徴量をcollateでまとめて正規化する.
+        # 波形やtextなど, data.normalized_streamsに含めなかったものはそのまま.
+        streams = data_config.get("normalized_streams", ["in", "out"])  # type: ignore
+        names = {pos: d.name for pos, (key, d) in enumerate([("in", in_dir), ("out", out_dir)]) if key in streams}
+        phase_collate_fn = get_normalized_collate_fn(data_config, collate_fn, names)
+        data_loaders[phase] = get_data_loader(data_config, dataset, phase_collate_fn, phase)
 
     return data_loaders
 
@@ -462,9 +394,8 @@ def _several_model_loader(config, device, logger, checkpoint):
         )
         if checkpoint is not None:
             adaptive_load_state_dict(model, checkpoint["state_dict"][model_name], logger)
-        if config.data_parallel:
-            model = nn.DataParallel(model)
-        model_dict[model_name] = model
+        # 複数 GPU 対応. modelごとにwrapする.
+        model_dict[model_name] = wrap_model(model, config, device)
 
     return model_dict
 
@@ -490,7 +421,8 @@ def setup(
         書籍に記載のコードは、この関数を一部簡略化しています。
     """
     # NOTE: hydra は内部で stream logger を追加するので、二重に追加しないことに注意
-    logger = getLogger(config.verbose, add_stream_handler=False)  # type: ignore
+    # distributedならrank 0以外はwarning以上だけ出す.
+    logger = getLogger(config.verbose if is_main_process() else 0, add_stream_handler=False)  # type: ignore
 
     logger.info(f"PyTorch version: {torch.__version__}")
 
@@ -530,17 +462,12 @@ def setup(
         if checkpoint is not None:
             adaptive_load_state_dict(model, checkpoint["state_dict"], logger)
 
-        # 複数 GPU 対応
-        if config.data_parallel:  # type: ignore
-            model = nn.DataParallel(model)
+        # 複数 GPU 対応 (data_parallel または distributed)
+        model = wrap_model(model, config, device)
 
     else:
         model = _several_model_loader(config, device, logger, checkpoint)
 
-    # 複数 GPU 対応
-    if config.data_parallel:  # type: ignore
-        model = nn.DataParallel(model)
-
     # Optimizer
     # 例: config.train.optim.optimizer.name = "Adam"なら,
     # optim.Adamをしていることと等価.
@@ -596,19 +523,22 @@ def setup(
         config.train, len(data_loaders["train"])*config.data.group_size, logger  # type: ignore
     )
 
-    # Tensorboard の設定
-    writer_tr = SummaryWriter(to_absolute_path(config.train.log_dir + "/train"))  # type: ignore
-    writer_dv = SummaryWriter(to_absolute_path(config.train.log_dir + "/dev"))  # type: ignore
-    writers = {"train": writer_tr, "dev": writer_dv}
-
-    # config ファイルを保存しておく
-    out_dir = Path(to_absolute_path(config.train.out_dir))  # type: ignore
-    out_dir.mkdir(parents=True, exist_ok=True)
-
-    with open(out_dir / "model.yaml", "w") as f:
-        OmegaConf.save(config.model, f)  # type: ignore
-    with open(out_dir / "config.yaml", "w") as f:
-        OmegaConf.save(config, f)
+    # distributedならTensorboardとconfigはrank 0だけが書く. 他のrankのwriterはNone.
+    writers = {"train": None, "dev": None}
+    if is_main_process():
+        # Tensorboard の設定
+        writer_tr = SummaryWriter(to_absolute_path(config.train.log_dir + "/train"))  # type: ignore
+        writer_dv = SummaryWriter(to_absolute_path(config.train.log_dir + "/dev"))  # type: ignore
+        writers = {"train": writer_tr, "dev": writer_dv}
+
+        # config ファイルを保存しておく
+        out_dir = Path(to_absolute_path(config.train.out_dir))  # type: ignore
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        with open(out_dir / "model.yaml", "w") as f:
+            OmegaConf.save(config.model, f)  # type: ignore
+        with open(out_dir / "config.yaml", "w") as f:
+            OmegaConf.save(config, f)
 
     return model, optimizer, lr_scheduler, loss, data_loaders, writers, logger, last_epoch, last_train_iter
 
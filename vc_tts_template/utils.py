@@ -1,4 +1,4 @@
-from typing import List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 import torch
 import random
 import numpy as np
@@ -137,6 +137,35 @@ def init_seed(seed: int) -> None:
         torch.cuda.manual_seed_all(seed)
 
 
+def get_rng_state() -> Dict[str, Any]:
+    """States of the python, numpy and torch (CPU, CUDA) random number generators.
+
+    checkpointに保存できるよう, numpyのstateはlistにしておく.
+
+    Returns:
+        dict: RNG states. :func:`set_rng_state` で元に戻せる.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        "numpy": (name, keys.tolist(), pos, has_gauss, cached_gaussian),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: Dict[str, Any]) -> None:
+    """Restore RNG states returned by :func:`get_rng_state`."""
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
 def pad_1d(x: Union[np.ndarray, List], max_len: Optional[int] = None, constant_values: Optional[int] = 0) -> np.ndarray:
     """Pad a 1d-tensor.
 
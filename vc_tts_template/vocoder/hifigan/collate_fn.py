@@ -1,25 +1,25 @@
 import random
 from pathlib import Path
-from typing import Callable, Dict
+from typing import Callable, Dict, Tuple
 import warnings
 import sys
 
-import librosa
 import numpy as np
 import torch
 from hydra.utils import to_absolute_path
 from librosa.filters import mel as librosa_mel_fn
-from scipy.io import wavfile
 from torch.utils import data as data_utils
 
 sys.path.append("../..")
+from vc_tts_template.audio_cache import AudioCache, load_wav
+from vc_tts_template.sampler import get_data_loader
 from vc_tts_template.utils import load_utt_list
 
 warnings.simplefilter('ignore', UserWarning)
 
 
 class hifigan_Dataset(data_utils.Dataset):
-    def __init__(self, in_feats_paths, sampling_rate, n_cashe_reuse, split, segment_size=None):
+    def __init__(self, in_feats_paths, sampling_rate, n_cashe_reuse, split, segment_size=None, audio_cache=None):
         self.audio_files = in_feats_paths  # wav_path
         self.sampling_rate = sampling_rate
         self._cache_ref_count = 0
@@ -27,15 +27,36 @@ class hifigan_Dataset(data_utils.Dataset):
         self.segment_size = segment_size
         # validationでは特にn_cashe_reuse = 0 推奨.
         self.n_cache_reuse = n_cashe_reuse
+        # resample済みの波形のstore. ある場合はn_cashe_reuseは使わない.
+        self.audio_cache = audio_cache
+
+    def _getitem_from_cache(self, index):
+        wav_path = self.audio_files[index]
+        filename = wav_path.name.replace(".wav", "")
+        # memmapなので, 切り出した部分しか読まない.
+        audio = self.audio_cache.load(wav_path)
+
+        if self.split:
+            if len(audio) >= self.segment_size:
+                audio_start = random.randint(0, len(audio) - self.segment_size)
+                audio = torch.from_numpy(np.array(audio[audio_start:audio_start+self.segment_size]))
+            else:
+                audio = torch.nn.functional.pad(
+                    torch.from_numpy(np.array(audio)), (0, self.segment_size - len(audio)), 'constant'
+                )
+        else:
+            audio = torch.from_numpy(np.array(audio))
+
+        return filename, audio
 
     def __getitem__(self, index):
+        if self.audio_cache is not None:
+            return self._getitem_from_cache(index)
+
         wav_path = self.audio_files[index]
         filename = wav_path.name.replace(".wav", "")
         if self._cache_ref_count == 0:
-            _sr, x = wavfile.read(wav_path)
-            if x.dtype in [np.int16, np.int32]:
-                x = (x / np.iinfo(x.dtype).max).astype(np.float64)
-            audio = librosa.resample(x, _sr, self.sampling_rate)
+            audio = load_wav(wav_path, self.sampling_rate)
 
             self.cached_wav = audio
             self._cache_ref_count = self.n_cache_reuse
@@ -72,6 +93,12 @@ def hifigan_get_data_loaders(data_config: Dict, collate_fn: Callable) -> Dict[st
     """
     data_loaders = {}
 
+    audio_cache_dir = data_config.get("audio_cache_dir", None)  # type: ignore
+    if audio_cache_dir is not None:
+        audio_cache = AudioCache(to_absolute_path(audio_cache_dir), data_config.sampling_rate)  # type: ignore
+    else:
+        audio_cache = None
+
     for phase in ["train", "dev"]:
         utt_ids = load_utt_list(to_absolute_path(data_config[phase].utt_list))
         in_dir = Path(to_absolute_path(data_config[phase].in_dir))
@@ -84,31 +111,27 @@ def hifigan_get_data_loaders(data_config: Dict, collate_fn: Callable) -> Dict[st
                 data_config.sampling_rate,  # type: ignore
                 data_config.n_cache_reuse,  # type: ignore
                 split=True,
-                segment_size=data_config.segment_size  # type: ignore
+                segment_size=data_config.segment_size,  # type: ignore
+                audio_cache=audio_cache,
             )
         else:
             dataset = hifigan_Dataset(
                 in_feats_paths,
                 data_config.sampling_rate,  # type: ignore
                 data_config.n_cache_reuse,  # type: ignore
-                split=False
+                split=False,
+                audio_cache=audio_cache,
             )
 
-        batch_size = data_config.batch_size * data_config.group_size  # type: ignore
-        data_loaders[phase] = data_utils.DataLoader(
-            dataset,
-            batch_size=batch_size,
-            collate_fn=collate_fn,
-            pin_memory=True,
-            num_workers=data_config.num_workers,  # type: ignore
-            shuffle=phase.startswith("train"),  # trainならTrue
-        )
+        data_loaders[phase] = get_data_loader(data_config, dataset, collate_fn, phase)
 
     return data_loaders
 
 
-mel_basis = {}
-hann_window = {}
+# (sampling_rate, n_fft, num_mels, fmin, fmax, device) -> mel filterbank
+mel_basis: Dict[Tuple, torch.Tensor] = {}
+# (win_size, device) -> hann window
+hann_window: Dict[Tuple, torch.Tensor] = {}
 
 
 def spectral_normalize_torch(magnitudes):
@@ -118,55 +141,96 @@ def spectral_normalize_torch(magnitudes):
     return output
 
 
-def mel_spectrogram(y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax,
-                    center=False, max_audio_len=None):
-    if torch.min(y) < -1.:
-        print('min value is ', torch.min(y))
-    if torch.max(y) > 1.:
-        print('max value is ', torch.max(y))
-    if max_audio_len is not None:
-        y = y[:, :max_audio_len]
-    global mel_basis, hann_window
-    if fmax not in mel_basis:
-        mel = librosa_mel_fn(sampling_rate, n_fft, num_mels, fmin, fmax)
-        mel_basis[str(fmax)+'_'+str(y.device)] = torch.from_numpy(mel).float().to(y.device)
-        hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
+def _get_mel_basis(sampling_rate, n_fft, num_mels, fmin, fmax, device):
+    # 以前は fmax だけで存在checkをしつつ fmax_device で保存していたため, 毎回作り直していた.
+    key = (sampling_rate, n_fft, num_mels, fmin, fmax, str(device))
+    if key not in mel_basis:
+        mel = librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)
+        mel_basis[key] = torch.from_numpy(mel).float().to(device)
+    return mel_basis[key]
 
+
+def _get_hann_window(win_size, device):
+    key = (win_size, str(device))
+    if key not in hann_window:
+        hann_window[key] = torch.hann_window(win_size).to(device)
+    return hann_window[key]
+
+
+def _magnitude_spectrogram(y, n_fft, hop_size, win_size, center=False):
     y = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
     y = y.squeeze(1)
 
-    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[str(y.device)],
-                      center=center, pad_mode='reflect', normalized=False, onesided=True)
+    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=_get_hann_window(win_size, y.device),
+                      center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex=True)
+
+    return torch.sqrt(torch.view_as_real(spec).pow(2).sum(-1)+(1e-9))
 
-    spec = torch.sqrt(spec.pow(2).sum(-1)+(1e-9))
 
-    spec = torch.matmul(mel_basis[str(fmax)+'_'+str(y.device)], spec)
+def mel_spectrogram(y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax,
+                    center=False, max_audio_len=None):
+    if max_audio_len is not None:
+        y = y[:, :max_audio_len]
+
+    spec = _magnitude_spectrogram(y, n_fft, hop_size, win_size, center)
+    spec = torch.matmul(_get_mel_basis(sampling_rate, n_fft, num_mels, fmin, fmax, y.device), spec)
     spec = spectral_normalize_torch(spec)
 
     return spec
 
 
-def collate_fn_hifigan(batch, config):
-    ids = []
-    audios = []
-    mels = []
-    mel_losses = []
-    for data in batch:
-        filename, audio = data
-        audio = audio.unsqueeze(0)
+def hifigan_mel_spectrograms(audios, config):
+    """Compute the input mel and the loss mel of HiFi-GAN at once.
+
+    入力用のmelと, loss用(fmax_loss)のmelはfilterbankが違うだけなので, STFTは1回で済ませる.
+    audiosが全て同じ長さ(trainのsegment)ならbatchでまとめて1回のSTFTにする.
+    長さが異なる場合(dev)はpaddingの影響を避けるため1発話ずつ計算する.
+    CPU上(collate)でも, to_device後の学習deviceでも使える.
+
+    Args:
+        audios: Tensor of shape (B, T) or list of tensors of shape (T,).
+        config: Data configuration.
 
-        mel = mel_spectrogram(audio, config.n_fft, config.num_mels,
-                              config.sampling_rate, config.hop_size, config.win_size, config.fmin, config.fmax,
-                              center=False)
+    Returns:
+        tuple: mels and loss mels. Tensors of shape (B, num_mels, T') if audios is a tensor, otherwise lists.
+    """
+    if isinstance(audios, torch.Tensor):
+        spec = _magnitude_spectrogram(audios, config.n_fft, config.hop_size, config.win_size)
+        mel_fb = _get_mel_basis(
+            config.sampling_rate, config.n_fft, config.num_mels, config.fmin, config.fmax, audios.device
+        )
+        mel_loss_fb = _get_mel_basis(
+            config.sampling_rate, config.n_fft, config.num_mels, config.fmin, config.fmax_loss, audios.device
+        )
+        return (
+            spectral_normalize_torch(torch.matmul(mel_fb, spec)),
+            spectral_normalize_torch(torch.matmul(mel_loss_fb, spec)),
+        )
+
+    mels, mel_losses = [], []
+    for audio in audios:
+        mel, mel_loss = hifigan_mel_spectrograms(audio.unsqueeze(0), config)
+        mels.append(mel.squeeze(0))
+        mel_losses.append(mel_loss.squeeze(0))
+    return mels, mel_losses
+
+
+def collate_fn_hifigan(batch, config):
+    ids = [filename for filename, _ in batch]
+    audios = [audio for _, audio in batch]
 
-        mel_loss = mel_spectrogram(audio, config.n_fft, config.num_mels,
-                                   config.sampling_rate, config.hop_size, config.win_size,
-                                   config.fmin, config.fmax_loss)
+    if config.get("mel_on_device", False):
+        # melはto_deviceの後, 学習device上でbatchでまとめて計算する.
+        return [[ids, [audio.numpy() for audio in audios], None, None]]
 
-        ids.append(filename)
-        audios.append(audio.squeeze(0).numpy())
-        mels.append(mel.squeeze().numpy())
-        mel_losses.append(mel_loss.squeeze().numpy())
+    if len(set(audio.size(0) for audio in audios)) == 1:
+        audios = torch.stack(audios)
+    mels, mel_losses = hifigan_mel_spectrograms(audios, config)
 
     # group化をdefaultとしているので.
-    return [[ids, audios, mels, mel_losses]]
+    return [[
+        ids,
+        [audio.numpy() for audio in audios],
+        [mel.numpy() for mel in mels],
+        [mel_loss.numpy() for mel_loss in mel_losses],
+    ]]
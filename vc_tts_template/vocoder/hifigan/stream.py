@@ -0,0 +1,75 @@
+import math
+from typing import Iterator, Optional
+
+import numpy as np
+import torch
+from torch.nn import Conv1d
+
+from .models import Generator
+
+
+def hop_size(generator: Generator) -> int:
+    """Number of output samples per mel frame."""
+    return int(np.prod([up.stride[0] for up in generator.ups]))
+
+
+def receptive_field_frames(generator: Generator) -> int:
+    """One-sided receptive field of the generator in mel frames.
+
+    各層の片側の受容野を, その層の解像度(1frameあたりのsample数)で割って足し合わせる.
+    resblockは並列に足されるので最大のものを, resblock内のconvは直列なので和を取る.
+
+    Args:
+        generator: HiFi-GAN generator.
+
+    Returns:
+        int: Number of frames which affect one output sample on each side.
+    """
+    def conv_radius(conv):
+        return (conv.kernel_size[0] - 1) // 2 * conv.dilation[0]
+
+    frames = conv_radius(generator.conv_pre)
+    resolution = 1
+    for i, up in enumerate(generator.ups):
+        # ConvTranspose1dの出力1点は, 入力のceil(kernel/stride)点から計算される.
+        frames += math.ceil(up.kernel_size[0] / up.stride[0]) / resolution
+        resolution *= up.stride[0]
+        resblocks = generator.resblocks[i*generator.num_kernels:(i+1)*generator.num_kernels]
+        frames += max(
+            sum(conv_radius(m) for m in resblock.modules() if isinstance(m, Conv1d))
+            for resblock in resblocks
+        ) / resolution
+    frames += conv_radius(generator.conv_post) / resolution
+
+    return math.ceil(frames)
+
+
+@torch.no_grad()
+def vocode_stream(
+    generator: Generator, mel: torch.Tensor, chunk_frames: int = 64, context_frames: Optional[int] = None,
+) -> Iterator[torch.Tensor]:
+    """Vocode a mel-spectrogram chunk by chunk.
+
+    各chunkの前後に受容野分のmelを足して生成し, 足した分の出力を捨てる.
+    捨てる部分にしかchunk端のzero paddingの影響は及ばないので,
+    連結した波形は全体を一度に生成した場合と(浮動小数点の誤差を除き)一致する.
+
+    Args:
+        generator: HiFi-GAN generator.
+        mel: Mel-spectrogram of shape (1, mel_dim, T), as passed to ``Generator.forward``.
+        chunk_frames: Number of frames vocoded per chunk.
+        context_frames: Frames added on each side of a chunk. The receptive field if None.
+
+    Yields:
+        torch.Tensor: Waveform of ``chunk_frames * hop_size`` samples (shorter for the last chunk).
+    """
+    hop = hop_size(generator)
+    context = receptive_field_frames(generator) if context_frames is None else context_frames
+    n_frames = mel.size(-1)
+
+    for start in range(0, n_frames, chunk_frames):
+        end = min(start + chunk_frames, n_frames)
+        ctx_start = max(start - context, 0)
+        ctx_end = min(end + context, n_frames)
+        wav = generator(mel[..., ctx_start:ctx_end]).view(-1)
+        yield wav[(start - ctx_start) * hop:(end - ctx_start) * hop]
@@ -24,47 +24,50 @@ class Conv1d(nn.Conv1d):
         if self.training:
             raise RuntimeError("incremental_forward only supports eval mode")
 
-        # run forward pre hooks (e.g., weight norm)
-        for hook in self._forward_pre_hooks.values():
-            hook(self, input)
-
         # reshape weight
-        weight = self._get_linearized_weight()
+        # weight normなどのforward pre hookは, 線形化したweightを作るとき(clear_buffer後の最初の1回)だけ実行する.
+        weight = self._get_linearized_weight(input)
         kw = self.kernel_size[0]
         dilation = self.dilation[0]
 
         bsz = input.size(0)  # input: bsz x len x dim
         if kw > 1:
             input = input.data
+            buffer_len = kw + (kw - 1) * (dilation - 1)
             if self.input_buffer is None:
-                self.input_buffer = input.new(
-                    bsz, kw + (kw - 1) * (dilation - 1), input.size(2)
-                )
-                self.input_buffer.zero_()
-            else:
-                # shift buffer
-                self.input_buffer[:, :-1, :] = self.input_buffer[:, 1:, :].clone()
+                # ring buffer. 毎時刻shiftする代わりに書き込み位置を1つずつ進める.
+                self.input_buffer = input.new_zeros(bsz, buffer_len, input.size(2))
+                self._buffer_pos = -1
+                # 書き込み位置posのとき, 各tap(古い順)がbufferのどこにあるか.
+                taps = torch.arange(kw, device=input.device) * dilation
+                self._tap_indices = (
+                    torch.arange(buffer_len, device=input.device).unsqueeze(1) + 1 + taps
+                ) % buffer_len
+            self._buffer_pos = (self._buffer_pos + 1) % buffer_len
             # append next input
-            self.input_buffer[:, -1, :] = input[:, -1, :]
-            input = self.input_buffer
-            if dilation > 1:
-                input = input[:, 0::dilation, :].contiguous()
+            self.input_buffer[:, self._buffer_pos, :] = input[:, -1, :]
+            input = self.input_buffer.index_select(1, self._tap_indices[self._buffer_pos])
         with torch.no_grad():
-            output = F.linear(input.view(bsz, -1), weight, self.bias)
+            output = F.linear(input.reshape(bsz, -1), weight, self.bias)
         return output.view(bsz, 1, -1)
 
     def clear_buffer(self):
         self.input_buffer = None
+        # 推論sessionごとにweightを線形化し直す.
+        self._linearized_weight = None
 
-    def _get_linearized_weight(self):
+    def _get_linearized_weight(self, input):
         # 2次元のweightにする. これによって畳み込み計算ができる.
         if self._linearized_weight is None:
+            # run forward pre hooks (e.g., weight norm)
+            for hook in self._forward_pre_hooks.values():
+                hook(self, input)
             kw = self.kernel_size[0]
             # nn.Conv1d
             assert self.weight.size() == (self.out_channels, self.in_channels, kw)
             weight = self.weight.transpose(1, 2).contiguous()
             assert weight.size() == (self.out_channels, kw, self.in_channels)
-            self._linearized_weight = weight.view(self.out_channels, -1)
+            self._linearized_weight = weight.view(self.out_channels, -1).detach()
         return self._linearized_weight
 
     def _clear_linearized_weight(self, *args):
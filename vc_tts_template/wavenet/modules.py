@@ -1,7 +1,7 @@
 import torch
 from torch import nn
 
-import conv
+from . import conv
 
 
 def Conv1d(in_channels, out_channels, kernel_size, *args, **kwargs):
@@ -77,19 +77,20 @@ class ResSkipBlock(nn.Module):
         """
         return self._forward(x, c, False)
 
-    def incremental_forward(self, x, c):
+    def incremental_forward(self, x, c, c_projected=False):
         """Incremental forward
 
         Args:
             x (torch.Tensor): Input signal.
             c (torch.Tensor): Local conditioning signal.
+            c_projected (bool): If True, c is already projected by conv1x1c.
 
         Returns:
             tuple: Tuple of output signal and skip connection signal
         """
-        return self._forward(x, c, True)
+        return self._forward(x, c, True, c_projected)
 
-    def _forward(self, x, c, is_incremental):
+    def _forward(self, x, c, is_incremental, c_projected=False):
         # 残差接続用に入力を保持
         residual = x
 
@@ -109,7 +110,8 @@ class ResSkipBlock(nn.Module):
         a, b = x.split(x.size(splitdim) // 2, dim=splitdim)
 
         # local conditioning
-        c = self._conv1x1_forward(self.conv1x1c, c, is_incremental)
+        if not c_projected:
+            c = self._conv1x1_forward(self.conv1x1c, c, is_incremental)
         ca, cb = c.split(c.size(splitdim) // 2, dim=splitdim)
         a, b = a + ca, b + cb
 
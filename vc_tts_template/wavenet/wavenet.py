@@ -131,10 +131,11 @@ class WaveNet(nn.Module):
         B = c.shape[0]
         # (B, C, T)
         c = self.upsample_net(c)
-        # (B, C, T) -> (B, T, C)
-        c = c.transpose(1, 2).contiguous()
+        # 条件付け特徴量の1x1畳み込みは自己回帰に依存しないので, cond_chunk時刻分ずつまとめて計算しておく.
+        cond_chunk = 1024
 
-        outputs = []
+        # 出力は予め確保しておき, 各時刻の結果を書き込む. (B, C, T)
+        outputs = c.new_zeros(B, self.out_channels, num_time_steps)
 
         # 自己回帰生成における初期値
         current_input = torch.zeros(B, 1, self.out_channels).to(c.device)
@@ -149,19 +150,19 @@ class WaveNet(nn.Module):
         # 一見毎回1時刻しか入れていなく, HMMやん! になっているけど,
         # そのためのincremental. 今までの入力を覚えておくということ.
         for t in ts:  # num_time_stepsだけ本当に生成する.
-            # 時刻 t における入力は、時刻 t-1 における出力
-            if t > 0:
-                current_input = outputs[-1]
-
             # 時刻 t における条件付け特徴量
             # upsample済み.
-            ct = c[:, t, :].unsqueeze(1)
+            if t % cond_chunk == 0:
+                c_chunk = c[:, :, t:t + cond_chunk]
+                # 各層の (B, cond_chunk, gate_channels)
+                c_projs = [f.conv1x1c(c_chunk).transpose(1, 2) for f in self.main_conv_layers]
 
             x = current_input
             x = self.first_conv.incremental_forward(x)
             skips = 0
-            for f in self.main_conv_layers:
-                x, h = f.incremental_forward(x, ct)
+            for f, c_proj in zip(self.main_conv_layers, c_projs):
+                ct = c_proj[:, t % cond_chunk].unsqueeze(1)
+                x, h = f.incremental_forward(x, ct, c_projected=True)
                 skips = skips + h
             x = skips
             for f in self.last_conv_layers:
@@ -174,13 +175,9 @@ class WaveNet(nn.Module):
             # カテゴリカル分布からサンプリング
             # サンプリングするのほんとにおもしろい. argmaxじゃないんだね.
             x = torch.distributions.OneHotCategorical(x).sample()
-            outputs += [x.data]
-
-        # T x B x C
-        # 各時刻における出力を結合
-        outputs = torch.stack(outputs)
-        # B x C x T
-        outputs = outputs.transpose(0, 1).transpose(1, 2).contiguous()
+            outputs[:, :, t] = x
+            # 時刻 t+1 における入力は、時刻 t における出力
+            current_input = x.unsqueeze(1)
 
         self.clear_buffer()  # 綺麗にしておく.
         return outputs